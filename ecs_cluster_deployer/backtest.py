@@ -0,0 +1,281 @@
+"""
+
+Scaling Backtest
+Replays cluster history through the spot scaler's decisions offline, so the
+thresholds and cooldown can be tuned against last week instead of against
+production.
+
+History is the tasks the cluster wanted each minute, read from the snapshots
+the metrics lambda records (record_snapshots) or from a CSV of
+timestamp,demand rows. Every minute the simulated scaler sees the Schedulable
+Cluster Tasks the simulated fleet would report and decides with the same
+decide() and target_capacity() the lambda uses. Capacity it adds only takes
+tasks after the boot delay. Capacity it removes goes straight away, booting
+capacity first.
+
+A week of minutes replays in milliseconds, and a sweep over a grid of
+policies runs across every core:
+
+    python -m ecs_cluster_deployer.backtest \\
+        --snapshots ./snapshots/cluster=prod --threshold-in 5,7,9 --threshold-out 1,2,3
+
+The fleet is modelled in capacity units (spot fleet weight), each running
+tasks_per_unit tasks, which is read from the history when it isn't given.
+Spot interruptions and partially full instances aren't modelled. This is a
+tool for the deployer's side and isn't shipped in the lambda package.
+
+"""
+
+import os
+import csv
+import sys
+import gzip
+import json
+import math
+import argparse
+import datetime
+import itertools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from ecs_cluster_deployer.lambdas.scaling.scale_spot import decide, target_capacity
+
+# how long new spot capacity takes to register with the cluster
+BOOT_MINUTES = 3
+
+
+# the scaler's settings, with the same defaults as its env vars
+POLICY_DEFAULTS = {
+    'threshold_in': 7,
+    'threshold_out': 2,
+    'scale_in': 1,
+    'scale_out': 2,
+    'cooldown': 300,
+    'min_weight': 1,
+    'max_weight': 10
+}
+
+
+class Policy(namedtuple('Policy', list(POLICY_DEFAULTS), defaults=tuple(POLICY_DEFAULTS.values()))):
+    """ the scaler's settings; cooldown is in seconds """
+    __slots__ = ()
+
+
+class Result(namedtuple('Result', [
+        'policy', 'capacity', 'unschedulable_minutes', 'instance_hours', 'scale_events'
+])):
+    """ the capacity in service each minute and what it cost """
+    __slots__ = ()
+
+    def summary(self):
+        """ the result without the capacity curve """
+        return {
+            'policy': self.policy._asdict(),
+            'unschedulable_minutes': self.unschedulable_minutes,
+            'instance_hours': round(self.instance_hours, 2),
+            'scale_events': self.scale_events,
+            'peak_capacity': max(self.capacity) if self.capacity else 0,
+        }
+
+
+def simulate(demand, policy, tasks_per_unit, boot_minutes=BOOT_MINUTES, initial_capacity=None): #pylint: disable=R0913,R0914
+    """
+    replays a minute by minute series of desired tasks through the policy.
+    Capacity starts at initial_capacity, or at whatever fits the first
+    minute's demand.
+    """
+    if initial_capacity is None:
+        initial_capacity = math.ceil(demand[0] / tasks_per_unit) if demand else policy.min_weight
+    target = ready = target_capacity(initial_capacity, 0, policy.min_weight, policy.max_weight)
+    booting = []
+    cooldown_minutes = policy.cooldown / 60.0
+    cooldown_until = 0
+    capacity = []
+    unschedulable = 0
+    unit_minutes = 0
+    events = 0
+    for minute, desired in enumerate(demand):
+        while booting and booting[0][0] <= minute:
+            ready += booting.pop(0)[1]
+        capacity.append(ready)
+        unit_minutes += target
+        schedulable = ready * tasks_per_unit - desired
+        if schedulable < 0:
+            unschedulable += 1
+        if minute < cooldown_until:
+            continue
+        amount = decide(
+            schedulable, policy.threshold_in, policy.threshold_out, policy.scale_in, policy.scale_out
+        )
+        if not amount:
+            continue
+        new_target = target_capacity(target, amount, policy.min_weight, policy.max_weight)
+        if new_target == 0 and desired > 0:
+            # the scaler won't empty a cluster that still has tasks
+            new_target = target
+        if new_target > target:
+            booting.append((minute + boot_minutes, new_target - target))
+        elif new_target < target:
+            removed = target - new_target
+            while removed and booting:
+                taken = min(removed, booting[-1][1])
+                removed -= taken
+                booting[-1] = (booting[-1][0], booting[-1][1] - taken)
+                if not booting[-1][1]:
+                    booting.pop()
+            ready -= removed
+        if new_target != target:
+            events += 1
+        target = new_target
+        # the lambda sets the cooldown whether or not the fleet changed
+        cooldown_until = minute + cooldown_minutes
+    return Result(policy, capacity, unschedulable, unit_minutes / 60.0, events)
+
+
+def sweep(demand, policies, tasks_per_unit, processes=None, **kwargs):
+    """ simulates every policy, in parallel across processes """
+    run = partial(_simulate, demand=demand, tasks_per_unit=tasks_per_unit, **kwargs)
+    # a few chunks per process keeps the pickling of the demand series down
+    chunksize = max(len(policies) // (4 * (processes or os.cpu_count() or 1)), 1)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(run, policies, chunksize=chunksize))
+
+
+def _simulate(policy, demand, tasks_per_unit, **kwargs):
+    # summaries only, the capacity curves would all be pickled back
+    return simulate(demand, policy, tasks_per_unit, **kwargs).summary()
+
+
+def policy_grid(base=None, **values):
+    """ every combination of the given policy fields, e.g. threshold_in=[5, 7] """
+    base = base or Policy()
+    names = sorted(values)
+    return [
+        base._replace(**dict(zip(names, combination)))
+        for combination in itertools.product(*(values[name] for name in names))
+    ]
+
+
+History = namedtuple('History', ['timestamps', 'demand', 'tasks_per_unit'])
+
+
+def per_minute(points):
+    """
+    resamples (timestamp, demand, spaces, instances) points to one per minute,
+    keeping the last of each minute and carrying it over gaps
+    """
+    by_minute = {}
+    for point in sorted(points, key=lambda point: point[0]):
+        by_minute[point[0].replace(second=0, microsecond=0)] = point
+    if not by_minute:
+        return History([], [], None)
+    minutes = sorted(by_minute)
+    timestamps, demand, ratios = [], [], []
+    current = minutes[0]
+    last = by_minute[current]
+    while current <= minutes[-1]:
+        last = by_minute.get(current, last)
+        timestamps.append(current)
+        demand.append(last[1])
+        if last[2] is not None and last[3]:
+            ratios.append((last[1] + last[2]) / float(last[3]))
+        current += datetime.timedelta(minutes=1)
+    ratios.sort()
+    return History(timestamps, demand, ratios[len(ratios) // 2] if ratios else None)
+
+
+def load_snapshots(directory):
+    """ reads the history from the snapshots recorded under a directory """
+    points = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.json.gz'):
+                points.append(_snapshot_point(os.path.join(root, name)))
+    return per_minute(points)
+
+
+def _snapshot_point(path):
+    timestamp = None
+    desired = instances = 0
+    spaces = None
+    with gzip.open(path, 'rt') as stream:
+        for line in stream:
+            block = json.loads(line)
+            timestamp = block['timestamp']
+            if block['kind'] == 'instance':
+                instances += block['rows']
+            elif block['kind'] == 'service':
+                desired += sum(block['desired'])
+            elif block['kind'] == 'metric':
+                for metric, value, dimensions in zip(block['metric'], block['value'], block['dimensions']):
+                    if metric == 'Schedulable Cluster Tasks' and not dimensions:
+                        spaces = value
+    return (_parse_timestamp(timestamp), desired, spaces, instances)
+
+
+def load_csv(path):
+    """ reads the history from timestamp,demand rows, with optional spaces and instances """
+    with open(path, encoding='utf-8', newline='') as stream:
+        return per_minute([
+            (
+                _parse_timestamp(row['timestamp']),
+                float(row['demand']),
+                float(row['spaces']) if row.get('spaces') else None,
+                int(row['instances']) if row.get('instances') else None
+            ) for row in csv.DictReader(stream)
+        ])
+
+
+def _parse_timestamp(text):
+    return datetime.datetime.fromisoformat(text).replace(tzinfo=None)
+
+
+def _numbers(text):
+    return [float(value) if '.' in value else int(value) for value in text.split(',')]
+
+
+def main(argv=None):
+    """ sweeps the policy grid over the history and prints the results as JSON """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1].strip())
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--snapshots', help='directory of recorded snapshots')
+    source.add_argument('--csv', help='file of timestamp,demand[,spaces,instances] rows')
+    for field in Policy._fields:
+        parser.add_argument('--' + field.replace('_', '-'), type=_numbers,
+                            default=[POLICY_DEFAULTS[field]], help='comma separated values to sweep')
+    parser.add_argument('--tasks-per-unit', type=float, help='tasks each unit of capacity runs')
+    parser.add_argument('--boot-minutes', type=int, default=BOOT_MINUTES)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--curve', action='store_true', help="include the best policy's capacity each minute")
+    args = parser.parse_args(argv)
+
+    history = load_snapshots(args.snapshots) if args.snapshots else load_csv(args.csv)
+    tasks_per_unit = args.tasks_per_unit or history.tasks_per_unit
+    if not history.demand or not tasks_per_unit:
+        parser.error("the history is empty or doesn't say how many tasks a unit runs, pass --tasks-per-unit")
+    policies = policy_grid(**{field: getattr(args, field) for field in Policy._fields})
+    results = sweep(
+        history.demand, policies, tasks_per_unit,
+        processes=args.processes, boot_minutes=args.boot_minutes
+    )
+    results.sort(key=lambda result: (result['unschedulable_minutes'], result['instance_hours']))
+    output = {
+        'minutes': len(history.demand),
+        'tasks_per_unit': tasks_per_unit,
+        'results': results
+    }
+    if args.curve:
+        best = simulate(
+            history.demand, Policy(**results[0]['policy']), tasks_per_unit, boot_minutes=args.boot_minutes
+        )
+        output['capacity'] = [
+            [timestamp.isoformat(), demand, capacity]
+            for timestamp, demand, capacity in zip(history.timestamps, history.demand, best.capacity)
+        ]
+    json.dump(output, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,7 @@
 import json
 import boto3
 
-from troposphere import Parameter, Ref, Sub, GetAtt, Output, Export
+from troposphere import Parameter, Ref, Sub, GetAtt, Output, Export, Tags
 from troposphere.iam import Role, InstanceProfile, Policy
 from troposphere.awslambda import Function, Code, Environment, Permission
 from troposphere.ecs import Cluster, TaskDefinition, ContainerDefinition, LogConfiguration
@@ -14,6 +14,15 @@ from troposphere.ecs import Environment as ECSEnvironment
 from ecs_cluster_deployer.cluster.asg_cleanup import add_asg_cleanup
 from ecs_cluster_deployer.utils import sanitize_cfn_resource_name
 
+# clusters carrying this tag are collected by the account level metrics lambda
+# of the cluster the tag's value names
+METRICS_OWNER_TAG = 'ecs-maestro:metrics'
+
+def scaler_collects_metrics(base):
+    """ whether there is a spot fleet scaling lambda to collect the cluster metrics """
+    instances = base.get('ec2_instances') or {}
+    return bool(instances.get('autoscaling') and instances.get('spot_fleets'))
+
 class ECSCluster: #pylint: disable=R0903
     """  Build cluster cloudformation """
     def __init__(self, ecs_obj):
@@ -27,9 +36,23 @@ class ECSCluster: #pylint: disable=R0903
 
     def scaffold(self):
         """ Create long lived stack resources for the cluster """
+        collector = self.cluster_vars.get('metrics_collector', 'cluster')
+        if collector == 'scaler' and not scaler_collects_metrics(self.ecs_obj.base):
+            # nothing would collect them, so the cluster keeps its metrics lambda
+            collector = 'cluster'
+        if collector == 'shared' and not self.cluster_vars.get('metrics_owner'):
+            # without an account collector named, nothing would collect them
+            collector = 'cluster'
+        cluster_options = {}
+        if collector == 'account':
+            # an account collector owns itself, and only collects what it owns
+            cluster_options["Tags"] = Tags(**{METRICS_OWNER_TAG: self.cluster_vars['name']})
+        elif collector == 'shared':
+            cluster_options["Tags"] = Tags(**{METRICS_OWNER_TAG: self.cluster_vars['metrics_owner']})
         self.t.add_resource(Cluster(
             "Cluster",
-            ClusterName=self.cluster_vars['name']
+            ClusterName=self.cluster_vars['name'],
+            **cluster_options
         ))
         OUTPUT_SG = ["ALB", "DB", "Cache", "Aux"]
         for sg in OUTPUT_SG:
@@ -51,7 +74,58 @@ class ECSCluster: #pylint: disable=R0903
         ### removing this because it's in the agent now
         add_asg_cleanup(self.t, sanitize_cfn_resource_name(self.cluster_vars['name']))
 
-        # add metric lambda
+        # shared clusters are collected by another cluster's account collector,
+        # and a scaler collector by the spot scaler as it decides
+        if collector not in ('shared', 'scaler'):
+            self.add_metric_lambda(account=collector == 'account')
+
+    def add_metric_lambda(self, account=False):
+        """ Add the lambda that sends the cluster metrics every minute """
+        metric_variables = {
+            "CLUSTER": Sub("${ClusterName}"),
+            "ASGPREFIX": Sub("${ClusterName}-asg-"),
+            "REGION": Ref("AWS::Region"),
+            "TASK_DEFINITION_CACHE_FILE": "/tmp/task-definitions.json"
+        }
+        memory_size = 128
+        if account:
+            # collect every shared cluster this one owns, this one included
+            metric_variables.pop("CLUSTER")
+            metric_variables["CLUSTER_TAG"] = "{}={}".format(METRICS_OWNER_TAG, self.cluster_vars['name'])
+            memory_size = 512
+        metric_lambda_options = {}
+        if self.cluster_vars.get('metrics_sample_interval'):
+            metric_variables["SAMPLE_INTERVAL"] = str(self.cluster_vars['metrics_sample_interval'])
+        if self.cluster_vars.get('metrics_backend'):
+            metric_variables["METRICS_BACKEND"] = self.cluster_vars['metrics_backend']
+        if self.cluster_vars.get('event_driven_metrics'):
+            # events and ticks must land on the same warm container
+            metric_variables["EVENT_DRIVEN"] = "true"
+            metric_lambda_options["ReservedConcurrentExecutions"] = 1
+        lambda_statements = [{
+            "Effect": "Allow",
+            "Action": [
+                "logs:*"
+            ],
+            "Resource": "arn:aws:logs:*:*:*"
+        }, {
+            "Effect": "Allow",
+            "Action": [
+                "ec2:DescribeAutoScalingGroups",
+                "ec2:UpdateAutoScalingGroup",
+                "ec2:DescribeInstanceTypes",
+                "ecs:*",
+                "cloudwatch:PutMetricData"
+            ],
+            "Resource": "*"
+        }]
+        if self.cluster_vars.get('record_snapshots'):
+            metric_variables["SNAPSHOT_DESTINATION"] = Sub("s3://${S3Bucket}/snapshots")
+            lambda_statements.append({
+                "Effect": "Allow",
+                "Action": ["s3:PutObject"],
+                "Resource": Sub("arn:aws:s3:::${S3Bucket}/snapshots/*")
+            })
         self.t.add_resource(Function(
             "ECSMetricLambda",
             Code=Code(
@@ -61,17 +135,15 @@ class ECSCluster: #pylint: disable=R0903
             Handler="metrics.cluster_metrics.lambda_handler",
             Role=GetAtt("CronLambdaRole", "Arn"),
             Runtime="python3.7",
-            MemorySize=128,
+            MemorySize=memory_size,
             Timeout=300,
             Environment=Environment(
-                Variables={
-                    "CLUSTER": Sub("${ClusterName}"),
-                    "ASGPREFIX": Sub("${ClusterName}-asg-"),
-                    "REGION": Ref("AWS::Region")
-                }
-
-            )
+                Variables=metric_variables
+            ),
+            **metric_lambda_options
         ))
+        if self.cluster_vars.get('event_driven_metrics'):
+            self.add_metric_events(all_clusters=account)
 
         self.t.add_resource(Role(
             "CronLambdaRole",
@@ -86,22 +158,7 @@ class ECSCluster: #pylint: disable=R0903
                 Policy(
                     PolicyName="logs-and-stuff",
                     PolicyDocument={
-                        "Statement": [{
-                            "Effect": "Allow",
-                            "Action": [
-                                "logs:*"
-                            ],
-                            "Resource": "arn:aws:logs:*:*:*"
-                        }, {
-                            "Effect": "Allow",
-                            "Action": [
-                                "ec2:DescribeAutoScalingGroups",
-                                "ec2:UpdateAutoScalingGroup",
-                                "ecs:*",
-                                "cloudwatch:PutMetricData"
-                            ],
-                            "Resource": "*"
-                        }]
+                        "Statement": lambda_statements
                     }
                 )
             ]
@@ -124,3 +181,36 @@ class ECSCluster: #pylint: disable=R0903
             Principal="events.amazonaws.com",
             SourceArn=GetAtt("CronStats", "Arn")
         ))
+
+    def add_metric_events(self, all_clusters=False):
+        """ Feed the cluster's ECS events to the metric lambda """
+        event_pattern = {
+            "source": ["aws.ecs"],
+            "detail-type": [
+                "ECS Container Instance State Change",
+                "ECS Task State Change",
+                "ECS Service Action",
+                "ECS Deployment State Change"
+            ]
+        }
+        if not all_clusters:
+            event_pattern["detail"] = {
+                "clusterArn": [GetAtt("Cluster", "Arn")]
+            }
+        self.t.add_resource(Rule(
+            "ClusterStateEvents",
+            Description="ECS events that keep the cluster stats up to date",
+            EventPattern=event_pattern,
+            Targets=[
+                Target(
+                    Id="1",
+                    Arn=GetAtt("ECSMetricLambda", "Arn"))
+            ]
+        ))
+        self.t.add_resource(Permission(
+            "ClusterStateEventsPerm",
+            Action="lambda:InvokeFunction",
+            FunctionName=GetAtt("ECSMetricLambda", "Arn"),
+            Principal="events.amazonaws.com",
+            SourceArn=GetAtt("ClusterStateEvents", "Arn")
+        ))
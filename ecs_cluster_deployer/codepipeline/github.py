@@ -1,17 +1,17 @@
 '''
 Class for setting github hooks into codepipeline
 '''
-import boto3
 import botocore #pylint: disable=unused-import
 from troposphere.codepipeline import Webhook, WebhookAuthConfiguration, WebhookFilterRule
 from troposphere import Ref, GetAtt
+from ecs_cluster_deployer.lambdas.common import clients
 
 class GithubSecret():
     '''
     This class will allow folks to use github saas to hook up their code pipelines
     '''
     def __init__(self):
-        self.sm = boto3.client('secretsmanager') #pylint: disable=C0103
+        self.sm = clients.client('secretsmanager') #pylint: disable=C0103
 
 
     def check_github_secret(self, sm_secret_name='GithubToken', kms_key=None):
@@ -49,9 +49,9 @@ from troposphere.applicationautoscaling import (
     StepScalingPolicyConfiguration
 )
 import botocore
-import boto3
 from jinja2 import Template as J2Template #pylint: disable=E0401
 
+from ecs_cluster_deployer.lambdas.common import clients
 from ecs_cluster_deployer.compute.lambda_scaler import add_scaling
 from ecs_cluster_deployer.utils import sanitize_cfn_resource_name
 from ecs_cluster_deployer.iam.instance_profile import add_instance_profile_to_template
@@ -63,8 +63,8 @@ logger.setLevel(logging.INFO)
 class EC2Instances: #pylint: disable=R0902
     """ Creates spot fleets and ASGs for the ECS Cluster """
     def __init__(self, ecs_obj):
-        self.ec2 = boto3.client('ec2', region_name=ecs_obj.region)
-        self.ssm = boto3.client('ssm', region_name=ecs_obj.region)
+        self.ec2 = clients.client('ec2', region_name=ecs_obj.region)
+        self.ssm = clients.client('ssm', region_name=ecs_obj.region)
         self.region = ecs_obj.region
         self.template = ecs_obj.template
         self.version = ecs_obj.version
@@ -423,7 +423,20 @@ class EC2Instances: #pylint: disable=R0902
 
         self.template.add_resource(spot_resource)
         if self.instance_base.get('autoscaling'):
-            add_scaling(spot_fleet, self.template, self.cluster.get('name'))
+            controller = self.cluster if self.cluster.get('metrics_collector') == 'scaler' else None
+            # a controller collects the cluster once, from the first fleet's scaler, and scales them all
+            if controller is not None and spot_fleet is not self.spot_fleets[0]:
+                return
+            add_scaling(
+                spot_fleet,
+                self.template,
+                self.cluster.get('name'),
+                metric_period=self.cluster.get('metrics_sample_interval'),
+                forecast_minutes=self.cluster.get('scaling_forecast_minutes'),
+                scaler_state=self.cluster.get('scaler_state'),
+                controller=controller,
+                spot_fleets=self.spot_fleets if controller is not None else None
+            )
 
 
     def get_cloudformation(self):
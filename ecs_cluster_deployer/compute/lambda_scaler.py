@@ -1,15 +1,27 @@
 """
 Adds troposphere methods for adding scaling to a cluster
 """
+import json
 from troposphere.awslambda import Function, Code, Environment, Permission
-from troposphere import Ref, Sub, GetAtt
+from troposphere import Join, Ref, Sub, GetAtt
 from troposphere.iam import Role, Policy
 from troposphere.events import Target, Rule
 from troposphere.ssm import Parameter
+from troposphere.dynamodb import Table, AttributeDefinition, KeySchema
 from ecs_cluster_deployer.utils import sanitize_cfn_resource_name
 
-def add_scaling(spot_fleet, template, cluster_name):
-    """ Add scaling resources to a cluster """
+def add_scaling(spot_fleet, template, cluster_name, metric_period=None, forecast_minutes=None, #pylint: disable=R0913,R0914
+                scaler_state=None, controller=None, spot_fleets=None):
+    """
+    Add scaling resources to a cluster. metric_period (seconds) reads the
+    high resolution metrics of a sampling metrics lambda. forecast_minutes
+    scales out ahead of the demand forecast for that many minutes.
+    scaler_state 'dynamodb' keeps the cooldown in a table of its own instead
+    of the scaletime parameter. controller is the cluster config when the
+    scaler collects the cluster metrics itself, in place of a metrics lambda.
+    spot_fleets are every fleet a controller scales, it collects the cluster
+    once and splits each decision between them.
+    """
     ssm_param = Parameter(
         'Scale{}'.format(sanitize_cfn_resource_name(spot_fleet.get('name'))),
         Type="String",
@@ -36,11 +48,12 @@ def add_scaling(spot_fleet, template, cluster_name):
                         "Action": [
                             "cloudwatch:Get*",
                             "ec2:DescribeSpotFleetRequests",
+                            "ec2:DescribeInstanceTypes",
                             "ec2:ModifySpotFleetRequest",
                             "logs:*",
                             "ecs:ListContainerInstances",
                             "ecs:Update*",
-                            "ecs:ListTasks",
+                            "ecs:DescribeContainerInstances",
                             "s3:GetEncryptionConfiguration"
                         ],
                         "Resource": "*"
@@ -72,7 +85,19 @@ def add_scaling(spot_fleet, template, cluster_name):
             )
         ]
     )
+    state_table = None
+    if scaler_state == 'dynamodb':
+        state_table = add_state_table(spot_fleet, template, autoscaling_role)
+    autoscaling_role.Policies.extend(scaler_policies(spot_fleet, controller))
     template.add_resource(autoscaling_role)
+    scaling_variables = scaling_environment(
+        spot_fleet, metric_period, forecast_minutes, state_table, controller
+    )
+    if controller is not None and spot_fleets:
+        scaling_variables["SPOT_FLEETS"] = Join(",", [
+            Ref("SpotFleet{}".format(sanitize_cfn_resource_name(fleet.get('name'))))
+            for fleet in spot_fleets
+        ])
     scaling_lambda = Function(
         'ScalingLambda{}'.format(sanitize_cfn_resource_name(spot_fleet.get('name'))),
         Code=Code(
@@ -82,22 +107,7 @@ def add_scaling(spot_fleet, template, cluster_name):
         Handler="scaling.scale_spot.lambda_handler",
         Role=GetAtt(autoscaling_role, "Arn"),
         Environment=Environment(
-            Variables={
-                "CLUSTER_NAME": Sub("${ClusterName}"),
-                "SPOT_FLEET": Ref(
-                    "SpotFleet{}".format(
-                        sanitize_cfn_resource_name(
-                            spot_fleet.get('name')
-                        )
-                    )
-                ),
-                "STATUS": Sub("${Status}"),
-                "VERSION": Sub("${Version}"),
-                "SCALE_IN_THRESHOLD": Sub("${SpotTaskThresholdIn}"),
-                "SCALE_OUT_THRESHOLD": Sub("${SpotTaskThresholdOut}"),
-                "MAX_WEIGHT": Sub("${SpotMaxWeight}"),
-                "MIN_WEIGHT": Sub("${SpotMinWeight}")
-            }
+            Variables=scaling_variables
         ),
         Timeout=900,
         MemorySize=128,
@@ -127,3 +137,165 @@ def add_scaling(spot_fleet, template, cluster_name):
         SourceArn=GetAtt(CronScaling, "Arn")
     )
     template.add_resource(ScalingPerm)
+    if spot_fleet.get('placement_scaling'):
+        add_placement_failures(spot_fleet, template, scaling_lambda)
+
+
+def add_state_table(spot_fleet, template, autoscaling_role):
+    """ Keep the scaler's cooldown in a DynamoDB table the scaler can read and swap """
+    state_table = Table(
+        'ScalerState{}'.format(sanitize_cfn_resource_name(spot_fleet.get('name'))),
+        BillingMode="PAY_PER_REQUEST",
+        AttributeDefinitions=[AttributeDefinition(AttributeName="key", AttributeType="S")],
+        KeySchema=[KeySchema(AttributeName="key", KeyType="HASH")]
+    )
+    template.add_resource(state_table)
+    autoscaling_role.Policies.append(Policy(
+        PolicyName="scaler-state",
+        PolicyDocument={
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:GetItem",
+                    "dynamodb:PutItem"
+                ],
+                "Resource": [GetAtt(state_table, "Arn")]
+            }]
+        }
+    ))
+    return state_table
+
+
+def scaler_policies(spot_fleet, controller=None):
+    """ The policies the spot fleet's scaling options need on top of scaling it """
+    policies = []
+    if controller is not None:
+        controller_statements = [{
+            "Effect": "Allow",
+            "Action": [
+                "ecs:ListServices",
+                "ecs:DescribeServices",
+                "ecs:DescribeContainerInstances",
+                "ecs:DescribeTaskDefinition",
+                "ec2:DescribeInstanceTypes",
+                "cloudwatch:PutMetricData"
+            ],
+            "Resource": "*"
+        }]
+        if controller.get('record_snapshots'):
+            controller_statements.append({
+                "Effect": "Allow",
+                "Action": ["s3:PutObject"],
+                "Resource": Sub("arn:aws:s3:::${S3Bucket}/snapshots/*")
+            })
+        policies.append(Policy(
+            PolicyName="cluster-metrics",
+            PolicyDocument={"Statement": controller_statements}
+        ))
+    if spot_fleet.get('placement_scaling'):
+        policies.append(Policy(
+            PolicyName="placement-failures",
+            PolicyDocument={
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Action": [
+                        "ecs:DescribeServices",
+                        "ecs:DescribeTaskDefinition"
+                    ],
+                    "Resource": "*"
+                }]
+            }
+        ))
+    if spot_fleet.get('drain_scale_in'):
+        policies.append(Policy(
+            PolicyName="drain-scale-in",
+            PolicyDocument={
+                "Statement": [{
+                    "Effect": "Allow",
+                    "Action": [
+                        "ecs:PutAttributes",
+                        "ecs:DeregisterContainerInstance",
+                        "ec2:DescribeSpotFleetInstances",
+                        "ec2:TerminateInstances"
+                    ],
+                    "Resource": "*"
+                }]
+            }
+        ))
+    return policies
+
+
+def scaling_environment(spot_fleet, metric_period=None, forecast_minutes=None, state_table=None, controller=None):
+    """ The scaling lambda's environment variables """
+    scaling_variables = {
+        "CLUSTER_NAME": Sub("${ClusterName}"),
+        "SPOT_FLEET": Ref(
+            "SpotFleet{}".format(
+                sanitize_cfn_resource_name(
+                    spot_fleet.get('name')
+                )
+            )
+        ),
+        "STATUS": Sub("${Status}"),
+        "VERSION": Sub("${Version}"),
+        "SCALE_IN_THRESHOLD": Sub("${SpotTaskThresholdIn}"),
+        "SCALE_OUT_THRESHOLD": Sub("${SpotTaskThresholdOut}"),
+        "MAX_WEIGHT": Sub("${SpotMaxWeight}"),
+        "MIN_WEIGHT": Sub("${SpotMinWeight}")
+    }
+    if metric_period:
+        scaling_variables["METRIC_PERIOD"] = str(metric_period)
+    if forecast_minutes:
+        scaling_variables["FORECAST_MINUTES"] = str(forecast_minutes)
+    if state_table is not None:
+        scaling_variables["SCALER_STATE"] = Sub("dynamodb:${%s}" % state_table.title)
+    if controller is not None:
+        scaling_variables["CONTROLLER"] = "true"
+        scaling_variables["TASK_DEFINITION_CACHE_FILE"] = "/tmp/task-definitions.json"
+        if controller.get('metrics_backend'):
+            scaling_variables["METRICS_BACKEND"] = controller['metrics_backend']
+        if controller.get('record_snapshots'):
+            scaling_variables["SNAPSHOT_DESTINATION"] = Sub("s3://${S3Bucket}/snapshots")
+    if spot_fleet.get('drain_scale_in'):
+        scaling_variables["DRAIN_SCALE_IN"] = "true"
+    if any(spot_fleet.get(key) for key in ('step_scaling', 'placement_scaling', 'drain_scale_in')):
+        scaling_variables["FLEET_BIDS"] = json.dumps([
+            {"instance_type": bid.get('instance_type'), "weight": bid.get('weight', 1)}
+            for bid in spot_fleet.get('bids', [])
+        ])
+    if spot_fleet.get('placement_max_step'):
+        scaling_variables["PLACEMENT_MAX_STEP"] = str(spot_fleet['placement_max_step'])
+    if spot_fleet.get('step_scaling'):
+        scaling_variables["STEP_SCALING"] = "true"
+        if spot_fleet.get('target_headroom') is not None:
+            scaling_variables["TARGET_HEADROOM"] = str(spot_fleet['target_headroom'])
+    return scaling_variables
+
+
+def add_placement_failures(spot_fleet, template, scaling_lambda):
+    """ Send the cluster's task placement failures to the scaling lambda """
+    placement_rule = Rule(
+        "PlacementFailures{}".format(sanitize_cfn_resource_name(spot_fleet.get('name'))),
+        Description="ECS task placement failures that scale the spot fleet out",
+        EventPattern={
+            "source": ["aws.ecs"],
+            "detail-type": ["ECS Service Action"],
+            "detail": {
+                "eventName": ["SERVICE_TASK_PLACEMENT_FAILURE"],
+                "clusterArn": [Sub("arn:aws:ecs:${AWS::Region}:${AWS::AccountId}:cluster/${ClusterName}")]
+            }
+        },
+        Targets=[
+            Target(
+                Id="1",
+                Arn=GetAtt(scaling_lambda, "Arn"))
+        ]
+    )
+    template.add_resource(placement_rule)
+    template.add_resource(Permission(
+        "PlacementPerm{}".format(sanitize_cfn_resource_name(spot_fleet.get('name'))),
+        Action="lambda:InvokeFunction",
+        FunctionName=GetAtt(scaling_lambda, "Arn"),
+        Principal="events.amazonaws.com",
+        SourceArn=GetAtt(placement_rule, "Arn")
+    ))
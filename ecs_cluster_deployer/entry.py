@@ -3,6 +3,7 @@ Entrypoint for the cluster deployer
 
 This file orchestrates the higher level functions
 """
+import os
 import sys
 import logging
 from ecs_cluster_deployer.cluster import ECSCluster
@@ -10,6 +11,7 @@ from ecs_cluster_deployer.vars import ECSVars
 from ecs_cluster_deployer.compute import EC2Instances
 from ecs_cluster_deployer.healthcheck import HealthCheck
 from ecs_cluster_deployer.codepipeline import AWSCodePipeline
+from ecs_cluster_deployer.lambdas.common import clients
 
 
 logger = logging.getLogger()
@@ -23,6 +25,20 @@ def put_pipeline():
     pipeline.deploy()
 
 def deploy():
+    """ Deploys the ECS cluster, then reports the api calls it took """
+    try:
+        deploy_cluster()
+    finally:
+        report_api_calls()
+
+def report_api_calls():
+    """ logs the deploy's api calls, publishing them with API_METRICS on """
+    def publish(metrics):
+        cw = clients.client('cloudwatch', region_name=os.environ.get('AWS_DEFAULT_REGION'))
+        cw.put_metric_data(Namespace='AWS/ECS', MetricData=metrics)
+    clients.report('Deploy API calls', publish, {'Stage': 'Deploy'})
+
+def deploy_cluster():
     """ Deploys the ECS cluster """
     cluster_obj = ECSVars()
 
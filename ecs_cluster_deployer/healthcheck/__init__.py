@@ -19,8 +19,8 @@ from troposphere.ecs import (
     TaskDefinition,
     ContainerDefinition
 )
-import boto3
 import botocore
+from ecs_cluster_deployer.lambdas.common import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -32,8 +32,8 @@ class HealthCheck:
     cloudformation stacks as inactive or active based on if that task ran
     """
     def __init__(self, ecs_obj):
-        self.ecs = boto3.client('ecs')
-        self.cf = boto3.client('cloudformation')
+        self.ecs = clients.client('ecs')
+        self.cf = clients.client('cloudformation')
         self.t = Template()
         self.t.add_parameter(Parameter(
             "Version",
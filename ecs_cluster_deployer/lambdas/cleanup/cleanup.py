@@ -2,7 +2,10 @@
 This function will remove the stack from the event that has been sent.
 """
 import logging
-import boto3
+try:
+    from ..common import clients
+except (ImportError, ValueError):
+    from common import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -13,7 +16,7 @@ def lambda_handler(event, context): #pylint: disable=W0613
     Lambda handler
     """
     logger.info(event)
-    cf = boto3.client('cloudformation')
+    cf = clients.client('cloudformation')
     res = cf.delete_stack(
         StackName=event['asg_stack']
     )
@@ -0,0 +1,292 @@
+"""
+
+AWS Clients
+Every boto3 client is created here so that it can be instrumented and reused.
+Clients are cached per service and region for the life of the process, so a
+warm lambda keeps its connection pools, and they all share one botocore config
+with adaptive retries, timeouts and a pool sized for the concurrency. Every
+attempt they send goes through the process wide rate limiter in limits.py. Hooks on
+botocore's events record, per operation, the number of calls, a latency
+histogram, errors, retries and throttles. The summary is logged at the end of
+a deploy or lambda invocation and can also be sent as metrics, which shows
+where the time goes in production without touching the calling code.
+
+This module is shared by the deployer and the lambdas, so it only depends on
+boto3.
+
+"""
+
+import os
+import time
+import logging
+import threading
+import boto3
+from botocore.config import Config
+from .limits import THROTTLE_CODES, RATE_LIMITER, limit
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# connections each client keeps open, override with MAX_POOL_CONNECTIONS.
+# Callers that fan out further ask for a bigger pool.
+MAX_POOL_CONNECTIONS = 50
+
+MAX_ATTEMPTS = 8
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# keys the start time and operation are kept under in the botocore request context
+START_KEY = 'api_stats_start'
+OPERATION_KEY = 'api_stats_operation'
+
+
+class OperationStats:
+    """ counters for a single service operation """
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.total_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        """ records the latency of one call """
+        self.calls += 1
+        self.total_seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def percentile(self, percent):
+        """ returns the bucket bound the percentile of calls falls under """
+        target = self.calls * percent / 100.0
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.histogram):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+    def as_dict(self):
+        """ returns the counters as plain values """
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'total_seconds': round(self.total_seconds, 3),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'histogram': dict(zip(
+                [str(bound) for bound in LATENCY_BUCKETS] + ['inf'], self.histogram
+            )),
+        }
+
+
+class ApiStats:
+    """ thread safe per operation statistics for every instrumented client """
+    def __init__(self):
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def _operation(self, service, operation):
+        key = (service, operation)
+        if key not in self._operations:
+            self._operations[key] = OperationStats()
+        return self._operations[key]
+
+    def before_call(self, model, context=None, **kwargs): #pylint: disable=W0613
+        """ before-call hook, stamps the start of the call """
+        if context is not None:
+            context[OPERATION_KEY] = (model.service_model.service_name, model.name)
+            context[START_KEY] = time.perf_counter()
+
+    def after_call(self, model, context=None, http_response=None, parsed=None, **kwargs): #pylint: disable=W0613
+        """ after-call hook, records latency, retries and errors """
+        start = (context or {}).get(START_KEY)
+        seconds = time.perf_counter() - start if start is not None else 0.0
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        with self._lock:
+            stats = self._operation(model.service_model.service_name, model.name)
+            stats.observe(seconds)
+            stats.retries += metadata.get('RetryAttempts', 0)
+            if http_response is not None and http_response.status_code >= 300:
+                stats.errors += 1
+
+    def after_call_error(self, context=None, **kwargs): #pylint: disable=W0613
+        """ after-call-error hook, for calls that never got a response """
+        context = context or {}
+        if OPERATION_KEY not in context:
+            return
+        seconds = time.perf_counter() - context[START_KEY]
+        with self._lock:
+            stats = self._operation(*context[OPERATION_KEY])
+            stats.observe(seconds)
+            stats.errors += 1
+
+    def needs_retry(self, operation, response=None, **kwargs): #pylint: disable=W0613
+        """ needs-retry hook, counts every throttled attempt """
+        if response is None:
+            return
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self._lock:
+                self._operation(operation.service_model.service_name, operation.name).throttles += 1
+
+    def summary(self):
+        """ returns the statistics keyed by service.Operation """
+        with self._lock:
+            return {
+                "{}.{}".format(service, operation): stats.as_dict()
+                for (service, operation), stats in sorted(self._operations.items())
+            }
+
+    def log_summary(self, title='API calls'):
+        """ logs the operations, slowest in total first """
+        summary = self.summary()
+        if not summary:
+            return summary
+        calls = sum(stats['calls'] for stats in summary.values())
+        seconds = sum(stats['total_seconds'] for stats in summary.values())
+        logger.info("%s: %s calls in %.2fs", title, calls, seconds)
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]['total_seconds']):
+            logger.info(
+                "  %s calls=%s total=%.3fs p50<=%ss p99<=%ss retries=%s throttles=%s errors=%s",
+                name, stats['calls'], stats['total_seconds'], stats['p50'], stats['p99'],
+                stats['retries'], stats['throttles'], stats['errors']
+            )
+        return summary
+
+    def metric_data(self, dimensions=None, timestamp=None):
+        """ returns the statistics as put_metric_data entries per operation """
+        metrics = []
+        for name, stats in self.summary().items():
+            service, _, operation = name.partition('.')
+            metric_dimensions = [
+                {"Name": key, "Value": value} for key, value in (dimensions or {}).items()
+            ] + [
+                {"Name": "Service", "Value": service},
+                {"Name": "Operation", "Value": operation},
+            ]
+            for metric_name, value, unit in (
+                    ("API Calls", stats['calls'], "Count"),
+                    ("API Latency", stats['total_seconds'] / max(stats['calls'], 1), "Seconds"),
+                    ("API Retries", stats['retries'], "Count"),
+                    ("API Throttles", stats['throttles'], "Count"),
+                    ("API Errors", stats['errors'], "Count")):
+                metric = {
+                    "MetricName": metric_name,
+                    "Dimensions": metric_dimensions,
+                    "Value": value,
+                    "Unit": unit
+                }
+                if timestamp:
+                    metric["Timestamp"] = timestamp
+                metrics.append(metric)
+        return metrics
+
+    def reset(self):
+        """ drops everything recorded so far """
+        with self._lock:
+            self._operations = {}
+
+
+API_STATS = ApiStats()
+
+
+def api_metrics_enabled():
+    """ true when the API_METRICS env var asks for the stats as metrics too """
+    return os.environ.get('API_METRICS', 'false').lower() in ("yes", "true", "t", "1")
+
+
+def instrument(aws_client, stats=None):
+    """ hooks the client's events so its calls are recorded """
+    stats = stats or API_STATS
+    events = aws_client.meta.events
+    events.register('before-call', stats.before_call)
+    events.register('after-call', stats.after_call)
+    events.register('after-call-error', stats.after_call_error)
+    events.register('needs-retry', stats.needs_retry)
+    return aws_client
+
+
+# {(service, region): (client, max_pool_connections)}
+CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def pool_size(max_pool_connections=None):
+    """ the connection pool a client is created with, at least MAX_POOL_CONNECTIONS """
+    return max(
+        max_pool_connections or 0,
+        int(os.environ.get('MAX_POOL_CONNECTIONS', MAX_POOL_CONNECTIONS))
+    )
+
+
+def client_config(max_pool_connections=None):
+    """ the botocore config every client is created with """
+    return Config(
+        max_pool_connections=pool_size(max_pool_connections),
+        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS},
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT
+    )
+
+
+def client(service, region_name=None, max_pool_connections=None):
+    """
+    returns the instrumented client for the service and region, creating it
+    on first use. A request for a bigger pool than the cached client has
+    replaces it.
+    """
+    region_name = region_name or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    key = (service, region_name)
+    pool = pool_size(max_pool_connections)
+    with _CLIENTS_LOCK:
+        cached, cached_pool = CLIENTS.get(key, (None, 0))
+        if cached is None or cached_pool < pool:
+            # boto3's default session isn't safe to create clients from concurrently
+            cached = limit(instrument(
+                boto3.client(service, region_name=region_name, config=client_config(pool))
+            ))
+            CLIENTS[key] = (cached, pool)
+        return cached
+
+
+def resource(service, region_name=None):
+    """
+    creates a boto3 resource whose client is instrumented. Resources aren't
+    thread safe, so they aren't cached.
+    """
+    with _CLIENTS_LOCK:
+        aws_resource = boto3.resource(service, region_name=region_name, config=client_config())
+    limit(instrument(aws_resource.meta.client))
+    return aws_resource
+
+
+def clear():
+    """ drops the cached clients """
+    with _CLIENTS_LOCK:
+        CLIENTS.clear()
+
+def report(title, publish=None, dimensions=None):
+    """
+    logs the summary and, with API_METRICS on, hands the stats to publish
+    as metric data, then starts over for the next deploy or invocation
+    """
+    API_STATS.log_summary(title)
+    for name, stats in RATE_LIMITER.stats().items():
+        if stats['throttles'] or stats['waited_seconds']:
+            logger.info("  rate limit %s: %s", name, stats)
+    if publish is not None and api_metrics_enabled():
+        metrics = API_STATS.metric_data(dimensions)
+        if metrics:
+            publish(metrics)
+    API_STATS.reset()
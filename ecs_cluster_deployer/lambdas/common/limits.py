@@ -0,0 +1,260 @@
+"""
+
+Rate Limits
+Every attempt an instrumented client sends takes a token from the bucket of
+its API family first, so clusters collected, health checked and deployed at
+the same time share one budget per process instead of each running into the
+account's throttling on its own.
+
+Families are per service, reads (Describe*, List*, Get*) and writes apart.
+Each one starts at its configured rate and concurrency and backs off like
+AIMD: a throttled attempt halves both, once per congestion, every attempt that goes through adds a
+little back until they are at the configured limits again.
+
+Override the limits with API_RATE_LIMITS, for example
+ecs.read=20/50/40,cloudformation.read=4/8 (rate per second / burst / in flight).
+
+"""
+
+import os
+import time
+import threading
+
+THROTTLE_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException',
+])
+
+READ_PREFIXES = ('Describe', 'List', 'Get')
+
+# (rate per second, burst, attempts in flight) per family. Families that
+# aren't listed aren't limited.
+LIMITS = {
+    'ecs.read': (20.0, 50, 40),
+    'ecs.write': (10.0, 20, 10),
+    'cloudformation.read': (4.0, 8, 4),
+    'cloudformation.write': (2.0, 4, 2),
+}
+
+# the slowest a family backs off to
+MIN_RATE = 0.5
+
+# throttles within this many seconds of a back off are part of the same
+# congestion, so they don't halve the limits again
+DECREASE_COOLDOWN = 1.0
+
+# rate added back per attempt that isn't throttled, divided by the current rate
+ADDITIVE_INCREASE = 1.0
+
+
+def family(service, operation):
+    """ returns the API family an operation is limited under """
+    kind = 'read' if operation.startswith(READ_PREFIXES) else 'write'
+    return "{}.{}".format(service, kind)
+
+
+def configured_limits():
+    """ the default limits with API_RATE_LIMITS applied on top """
+    limits = dict(LIMITS)
+    for entry in os.environ.get('API_RATE_LIMITS', '').split(','):
+        if not entry.strip():
+            continue
+        name, _, values = entry.partition('=')
+        parts = values.split('/')
+        rate = float(parts[0])
+        burst = int(parts[1]) if len(parts) > 1 else max(int(rate), 1)
+        in_flight = int(parts[2]) if len(parts) > 2 else burst
+        limits[name.strip()] = (rate, burst, in_flight)
+    return limits
+
+
+class TokenBucket:
+    """ thread safe token bucket, take() blocks until a token is free """
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+        """ changes the refill rate from now on """
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def take(self):
+        """ takes a token, returns how long it waited for it """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                # allow for float error, or a refill of exactly the wait could fall short
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(self.tokens - 1, 0.0)
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
+
+
+class FamilyLimiter:
+    """
+    a token bucket and a window of attempts in flight for one API family,
+    both shrinking multiplicatively on throttles and growing back additively
+    """
+    def __init__(self, rate, burst, max_in_flight, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.window = float(max_in_flight)
+        self.in_flight = 0
+        self.throttles = 0
+        self.waited = 0.0
+        self._clock = clock
+        self._decreased_at = None
+        self._window_changed = threading.Condition()
+
+    @property
+    def rate(self):
+        """ the rate tokens are currently refilled at """
+        return self.bucket.rate
+
+    def acquire(self):
+        """ blocks until the attempt fits both the window and the rate """
+        with self._window_changed:
+            while self.in_flight >= max(int(self.window), 1):
+                self._window_changed.wait()
+            self.in_flight += 1
+        try:
+            waited = self.bucket.take()
+        except BaseException:
+            self.abandon()
+            raise
+        with self._window_changed:
+            self.waited += waited
+
+    def abandon(self):
+        """ ends an attempt that never got a response, leaving the limits alone """
+        with self._window_changed:
+            self.in_flight = max(self.in_flight - 1, 0)
+            self._window_changed.notify_all()
+
+    def release(self, throttled=False):
+        """ ends an attempt, backing off when it was throttled """
+        with self._window_changed:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if throttled:
+                self.throttles += 1
+                now = self._clock()
+                if self._decreased_at is None or now - self._decreased_at >= DECREASE_COOLDOWN:
+                    self._decreased_at = now
+                    self.bucket.set_rate(max(self.rate / 2, MIN_RATE))
+                    self.window = max(self.window / 2, 1.0)
+            elif self.rate < self.max_rate or self.window < self.max_in_flight:
+                self.bucket.set_rate(min(self.rate + ADDITIVE_INCREASE / self.rate, self.max_rate))
+                self.window = min(self.window + 1 / self.window, float(self.max_in_flight))
+            self._window_changed.notify_all()
+
+
+class RateLimiter:
+    """ the family limiters of a process, hooked into each client's send """
+    def __init__(self, limits=None):
+        self.limits = configured_limits() if limits is None else limits
+        self.families = {}
+        self._lock = threading.Lock()
+        # the limiters each thread's attempts hold a slot of until they're answered
+        self._held = threading.local()
+
+    def limiter(self, name):
+        """ returns the family's limiter, None when the family isn't limited """
+        if name not in self.limits:
+            return None
+        with self._lock:
+            if name not in self.families:
+                self.families[name] = FamilyLimiter(*self.limits[name])
+            return self.families[name]
+
+    def _family_limiter(self, event_name):
+        # event names look like before-send.ecs.DescribeServices
+        _, service, operation = event_name.split('.', 2)
+        return self.limiter(family(service, operation))
+
+    def _held_limiters(self):
+        if not hasattr(self._held, 'limiters'):
+            self._held.limiters = []
+        return self._held.limiters
+
+    def before_send(self, event_name, **kwargs): #pylint: disable=W0613
+        """ before-send hook, waits for the family's token """
+        limiter = self._family_limiter(event_name)
+        if limiter is not None:
+            limiter.acquire()
+            self._held_limiters().append(limiter)
+
+    def response_received(self, event_name, parsed_response=None, **kwargs): #pylint: disable=W0613
+        """
+        response-received hook, fires after an attempt that was sent or failed
+        to send, but not when its response couldn't be parsed
+        """
+        limiter = self._family_limiter(event_name)
+        held = self._held_limiters()
+        if limiter is None or limiter not in held:
+            return
+        held.remove(limiter)
+        if parsed_response is None:
+            limiter.abandon()
+            return
+        code = parsed_response.get('Error', {}).get('Code')
+        limiter.release(throttled=code in THROTTLE_CODES)
+
+    def after_call(self, **kwargs): #pylint: disable=W0613
+        """
+        after-call and after-call-error hook, frees the slots of attempts
+        that never got to response-received, like one whose response
+        couldn't be parsed
+        """
+        held = self._held_limiters()
+        while held:
+            held.pop().abandon()
+
+    def stats(self):
+        """ returns each family's current limits and how often it backed off """
+        with self._lock:
+            return {
+                name: {
+                    'rate': round(limiter.rate, 2),
+                    'window': int(limiter.window),
+                    'throttles': limiter.throttles,
+                    'waited_seconds': round(limiter.waited, 3),
+                } for name, limiter in sorted(self.families.items())
+            }
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def limit(aws_client, limiter=None):
+    """ sends every attempt of the client through the rate limiter """
+    limiter = limiter or RATE_LIMITER
+    events = aws_client.meta.events
+    events.register('before-send', limiter.before_send)
+    events.register('response-received', limiter.response_received)
+    events.register('after-call', limiter.after_call)
+    events.register('after-call-error', limiter.after_call)
+    return aws_client
@@ -0,0 +1,214 @@
+"""
+
+Cluster Capacity
+Works out how many more tasks of each shape fit on the cluster's container
+instances in a single pass. Remaining cpu and memory are held as arrays and
+every distinct task shape is measured against every instance at once.
+
+Extra resources like GPU get a dense array each, zero on the instances that
+don't have them. A shape that needs some is (cpu, memory, ((name, amount),))
+and is bound by those too.
+
+NumPy is used when it is installed. The lambda runtime doesn't ship it, so a
+pure python fallback gives the same answers there. It sorts the instances
+once by their cpu to memory ratio: a shape is cpu bound on the instances
+below its own ratio and memory bound on the rest, so each shape only needs a
+bisect and two sums, or two prefix sums when partial spaces are kept.
+
+"""
+
+import math
+import bisect
+from itertools import accumulate, repeat
+from operator import floordiv
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# bounds the instances x shapes matrices to a few MB each
+BLOCK_SIZE = 256
+
+class CapacityEngine:
+    """
+    Holds the remaining cpu, memory and extra resources of each container
+    instance and measures task shapes, given as (cpu, memory) pairs, against
+    them. resources maps each extra resource to its amount per instance.
+    """
+    def __init__(self, cpu, memory, use_numpy=True, resources=None):
+        self.use_numpy = bool(use_numpy and np is not None)
+        if self.use_numpy:
+            self.cpu = np.asarray(cpu, dtype=np.float64)
+            self.memory = np.asarray(memory, dtype=np.float64)
+            self.resources = {
+                name: np.asarray(amounts, dtype=np.float64)
+                for name, amounts in (resources or {}).items()
+            }
+        else:
+            self.cpu = [float(value) for value in cpu]
+            self.memory = [float(value) for value in memory]
+            self.resources = {
+                name: [float(value) for value in amounts]
+                for name, amounts in (resources or {}).items()
+            }
+        self._by_ratio = None
+
+    @classmethod
+    def from_container_instances(cls, container_instances, use_numpy=True):
+        """ builds the engine from InstanceRecords """
+        container_instances = list(container_instances)
+        per_instance = [dict(ci.resources) for ci in container_instances]
+        names = sorted({name for resources in per_instance for name in resources})
+        return cls(
+            [ci.available_cpu for ci in container_instances],
+            [ci.available_memory for ci in container_instances],
+            use_numpy=use_numpy,
+            resources={
+                name: [resources.get(name, 0) for resources in per_instance]
+                for name in names
+            }
+        )
+
+    def available(self, name):
+        """ returns the amount of an extra resource left on each instance """
+        if name in self.resources:
+            return self.resources[name]
+        if self.use_numpy:
+            return np.zeros(len(self.cpu))
+        return [0.0] * len(self.cpu)
+
+    def spaces(self, shapes, whole=True):
+        """
+        returns the number of tasks of each shape that fit on the cluster.
+
+        A shape that asks for no cpu or memory is only bound by the other
+        dimension, the same way the original per instance loop treated it.
+        With whole=False the partial spaces on each instance are kept, which
+        is what the Schedulable Cluster Tasks metric has always reported.
+        """
+        shapes = list(shapes)
+        if not shapes:
+            return []
+        if any(len(shape) > 2 for shape in shapes):
+            # shapes with extra resources are measured one at a time
+            return [self._total(self.instance_spaces(shape, whole), whole) for shape in shapes]
+        if self.use_numpy:
+            return self._spaces_numpy(shapes, whole)
+        return self._spaces_python(shapes, whole)
+
+    def instance_spaces(self, shape, whole=True):
+        """
+        returns the tasks of one shape that fit on each instance, as an array
+        when numpy is used and a list otherwise
+        """
+        shape_cpu, shape_memory = shape[:2]
+        extra = [
+            (self.available(name), amount)
+            for name, amount in (shape[2] if len(shape) > 2 else ()) if amount > 0
+        ]
+        if self.use_numpy:
+            per_instance = np.minimum(
+                self._ratio(self.cpu[:, None], np.asarray([shape_cpu], dtype=np.float64)),
+                self._ratio(self.memory[:, None], np.asarray([shape_memory], dtype=np.float64))
+            )[:, 0]
+            for available, amount in extra:
+                per_instance = np.minimum(per_instance, available / amount)
+            return np.floor(per_instance) if whole else per_instance
+        per_instance = []
+        for i, (cpu, memory) in enumerate(zip(self.cpu, self.memory)):
+            cpu_spaces = cpu / shape_cpu if shape_cpu > 0 else cpu
+            mem_spaces = memory / shape_memory if shape_memory > 0 else memory
+            instance_spaces = min(
+                [cpu_spaces, mem_spaces] + [available[i] / amount for available, amount in extra]
+            )
+            per_instance.append(math.floor(instance_spaces) if whole else instance_spaces)
+        return per_instance
+
+    def headroom(self, shapes):
+        """ returns whole task spaces per shape and the worst case across them """
+        shapes = list(shapes)
+        per_shape = dict(zip(shapes, self.spaces(shapes)))
+        if not per_shape:
+            return {'per_shape': {}, 'worst_shape': None, 'worst_case': None}
+        worst_shape = min(per_shape, key=per_shape.get)
+        return {
+            'per_shape': per_shape,
+            'worst_shape': worst_shape,
+            'worst_case': per_shape[worst_shape]
+        }
+
+    def _spaces_numpy(self, shapes, whole):
+        requirements = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+        totals = np.empty(len(requirements))
+        cpu = self.cpu[:, None]
+        memory = self.memory[:, None]
+        for start in range(0, len(requirements), BLOCK_SIZE):
+            block = requirements[start:start + BLOCK_SIZE]
+            per_instance = np.minimum(
+                self._ratio(cpu, block[:, 0]),
+                self._ratio(memory, block[:, 1])
+            )
+            if whole:
+                np.floor(per_instance, out=per_instance)
+            totals[start:start + BLOCK_SIZE] = per_instance.sum(axis=0)
+        if whole:
+            return [int(total) for total in totals]
+        return totals.tolist()
+
+    @staticmethod
+    def _ratio(available, required):
+        ratio = np.broadcast_to(available, (available.shape[0], required.shape[0])).copy()
+        np.divide(available, required, out=ratio, where=required > 0)
+        return ratio
+
+    def _spaces_python(self, shapes, whole):
+        if min(self.cpu + self.memory, default=0) < 0:
+            # overcommitted instances break the ratio ordering
+            return [self._total(self.instance_spaces(shape, whole), whole) for shape in shapes]
+        ratios, cpu, memory, cpu_sums, memory_sums = self._sorted_by_ratio()
+        totals = []
+        for shape in shapes:
+            shape_cpu, shape_memory = shape
+            if shape_cpu <= 0 or shape_memory <= 0:
+                totals.append(self._total(self.instance_spaces(shape, whole), whole))
+                continue
+            # instances up to split run out of cpu first, the rest memory
+            split = bisect.bisect_right(ratios, shape_cpu / float(shape_memory))
+            if whole:
+                totals.append(int(
+                    sum(map(floordiv, cpu[:split], repeat(shape_cpu))) +
+                    sum(map(floordiv, memory[split:], repeat(shape_memory)))
+                ))
+            else:
+                totals.append(
+                    cpu_sums[split] / shape_cpu +
+                    (memory_sums[-1] - memory_sums[split]) / shape_memory
+                )
+        return totals
+
+    def _sorted_by_ratio(self):
+        """
+        returns the instances' cpu to memory ratios in ascending order, their
+        cpu and memory in that order and the prefix sums of both
+        """
+        if self._by_ratio is None:
+            order = sorted(
+                zip(self.cpu, self.memory),
+                key=lambda pair: pair[0] / pair[1] if pair[1] > 0 else math.inf
+            )
+            cpu = [pair[0] for pair in order]
+            memory = [pair[1] for pair in order]
+            self._by_ratio = (
+                [c / m if m > 0 else math.inf for c, m in order],
+                cpu,
+                memory,
+                [0.0] + list(accumulate(cpu)),
+                [0.0] + list(accumulate(memory))
+            )
+        return self._by_ratio
+
+    @staticmethod
+    def _total(per_instance, whole):
+        total = float(sum(per_instance))
+        return int(total) if whole else total
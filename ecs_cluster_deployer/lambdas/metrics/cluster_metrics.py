@@ -7,23 +7,252 @@ resources that the cluster is using.
 """
 
 import os
+import time
 import logging
 import datetime
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import dateutil
+import botocore
+from .task_definitions import TASK_DEFINITIONS
+from .cluster_state import ClusterState
+from .capacity import CapacityEngine
+from .snapshot import ClusterSnapshot
+from .placement import PlacementSimulator
+from .instance_types import load_eni_limits
+from .publishers import metric_publisher
+from .recorder import snapshot_recorder
+from .resources import parse_resources, requirement_amount
+try:
+    from ..common import clients
+except (ImportError, ValueError):
+    from common import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
+# ECS throttles Describe* calls per account, so keep the fan out well under
+# the sustained rate. Override with the MAX_IN_FLIGHT env var.
+MAX_IN_FLIGHT = 10
+
+# how many clusters one invocation collects at the same time, when it collects
+# more than one. Each of them still fans out up to MAX_IN_FLIGHT describes.
+MAX_CLUSTERS_IN_FLIGHT = 4
+
+# per service and per instance type metrics, on unless DETAILED_METRICS is false
+DETAILED_METRICS = True
+
+# with SAMPLE_INTERVAL set (seconds), one invocation collects every interval
+# for SAMPLE_DURATION seconds and publishes high resolution metrics
+SAMPLE_DURATION = 60
+
+# stop sampling this long before the lambda would time out
+SAMPLE_TIMEOUT_MARGIN = 10
+
+# cluster state survives warm invocations so events can be applied between ticks
+CLUSTER_STATES = {}
+
 def lambda_handler(event, context): #pylint: disable=W0613
     """
     This lambda handler handles cluster analytics.
 
     These are used for scaling the cluster and watching memory / cpu requirements.
+    With EVENT_DRIVEN set, ECS events update the cluster state in memory and the
+    scheduled tick only describes what changed since the last one.
+
+    CLUSTERS (comma separated) or CLUSTER_TAG (key=value) collects many
+    clusters from one invocation instead of the single CLUSTER.
+
+    SAMPLE_INTERVAL collects every few seconds for the length of the run.
     """
-    agg = ClusterStats(os.environ['CLUSTER'])
-    agg.send_cluster_metrics()
+    if event_driven() and event.get('source') == 'aws.ecs':
+        cluster_arn = event.get('detail', {}).get('clusterArn', '')
+        state = CLUSTER_STATES.get(cluster_arn.split('/')[-1])
+        # unknown clusters are reconciled in full on their first tick anyway
+        if state:
+            state.apply(event)
+        return
+    collector = AccountCollector(
+        clusters=[
+            name.strip() for name in os.environ.get('CLUSTERS', os.environ.get('CLUSTER', '')).split(',')
+            if name.strip()
+        ],
+        tag=os.environ.get('CLUSTER_TAG')
+    )
+    interval = int(os.environ.get('SAMPLE_INTERVAL', 0))
+    if interval:
+        collector.sample(interval, sample_duration(context))
+    else:
+        collector.collect()
+    TASK_DEFINITIONS.save()
+    logger.info("Task definition cache: %s", TASK_DEFINITIONS.stats())
+    collector.send_cache_metrics()
+    TASK_DEFINITIONS.reset_stats()
+    collector.send_api_metrics()
+
+def event_driven():
+    """ true when ECS events keep the cluster state up to date """
+    return os.environ.get('EVENT_DRIVEN', 'false').lower() in ("yes", "true", "t", "1")
+
+def sample_duration(context):
+    """ how long to keep sampling, bounded by the time the lambda has left """
+    duration = float(os.environ.get('SAMPLE_DURATION', SAMPLE_DURATION))
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining:
+        duration = min(duration, remaining() / 1000.0 - SAMPLE_TIMEOUT_MARGIN)
+    return duration
+
+def cluster_state(cluster_name, ecs=None, cw=None, ec2=None):
+    """ returns the warm cluster state for the cluster, creating it if needed """
+    if cluster_name not in CLUSTER_STATES:
+        CLUSTER_STATES[cluster_name] = ClusterState(
+            ClusterStats(cluster_name, ecs=ecs, cw=cw, ec2=ec2)
+        )
+    return CLUSTER_STATES[cluster_name]
+
+class AccountCollector:
+    """
+    Collects and sends metrics for one or many clusters in a single
+    invocation. The clients and task definition cache are shared between
+    the clusters and they are collected concurrently.
+    """
+    def __init__(self, clusters=None, tag=None, max_in_flight=None):
+        self.clusters = clusters or []
+        self.tag = tag
+        self.max_in_flight = int(
+            max_in_flight or os.environ.get('MAX_CLUSTERS_IN_FLIGHT', MAX_CLUSTERS_IN_FLIGHT)
+        )
+        # every cluster collected at once fans out its own describes
+        pool = self.max_in_flight * int(os.environ.get('MAX_IN_FLIGHT', MAX_IN_FLIGHT))
+        self.ecs = clients.client('ecs', max_pool_connections=pool)
+        self.cw = clients.client('cloudwatch', max_pool_connections=self.max_in_flight)
+        self.ec2 = clients.client('ec2')
+        self.publisher = metric_publisher(self.cw)
+        # each cluster's state while sampling, kept from one sample to the next
+        self._sample_states = None
+
+    @property
+    def cluster_names(self):
+        """ returns the named clusters, or every cluster carrying the tag """
+        if not self.tag:
+            return list(self.clusters)
+        key, _, value = self.tag.partition('=')
+        cluster_arns = []
+        for page in self.ecs.get_paginator('list_clusters').paginate():
+            cluster_arns.extend(page['clusterArns'])
+        names = []
+        for i in range(0, len(cluster_arns), 100):
+            res = self.ecs.describe_clusters(clusters=cluster_arns[i:i + 100], include=['TAGS'])
+            for cluster in res['clusters']:
+                tags = {tag['key']: tag['value'] for tag in cluster.get('tags', [])}
+                if key in tags and (not value or tags[key] == value):
+                    names.append(cluster['clusterName'])
+        return sorted(set(names) | set(self.clusters))
+
+    def stats(self, cluster_name):
+        """ returns the ClusterStats for a cluster, sharing this collector's clients """
+        if event_driven():
+            return cluster_state(cluster_name, ecs=self.ecs, cw=self.cw, ec2=self.ec2).sync()
+        if self._sample_states is not None:
+            return self.sample_state(cluster_name).sync()
+        return ClusterStats(cluster_name, ecs=self.ecs, cw=self.cw, ec2=self.ec2)
+
+    def sample_state(self, cluster_name):
+        """
+        returns the cluster's state for this sampling run. The first sample
+        lists the cluster, the rest describe the container instances and
+        services it found again without listing them.
+        """
+        state = self._sample_states.get(cluster_name)
+        if state is None:
+            state = self._sample_states[cluster_name] = ClusterState(
+                ClusterStats(cluster_name, ecs=self.ecs, cw=self.cw, ec2=self.ec2)
+            )
+        else:
+            state.touch()
+        return state
+
+    def collect(self, names=None):
+        """
+        sends every cluster's metrics, a failing cluster doesn't stop the rest.
+        Every cluster publishes to the same publisher, which is flushed once.
+        """
+        names = self.cluster_names if names is None else names
+        if len(names) <= 1 or self.max_in_flight <= 1:
+            results = [self._collect(name) for name in names]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(names))) as pool:
+                results = list(pool.map(self._collect, names))
+        self.publisher.flush()
+        return dict(zip(names, results))
+
+    def sample(self, interval, duration):
+        """
+        collects every interval seconds until duration runs out, publishing
+        one second resolution metrics. The cluster list is only looked up
+        once, and so are each cluster's container instances and services:
+        later samples describe the ones the first found again, and task
+        definitions come from the cache. Instances and services added during
+        the run are picked up by the next invocation.
+        Returns the number of samples taken.
+        """
+        names = self.cluster_names
+        # only the sampled metrics are high resolution, not what's published after
+        storage_resolution = self.publisher.storage_resolution
+        self.publisher.storage_resolution = 1
+        self._sample_states = {}
+        start = time.time()
+        samples = 0
+        try:
+            while True:
+                self.collect(names)
+                samples += 1
+                next_sample = start + samples * interval
+                if next_sample - start >= duration:
+                    return samples
+                time.sleep(max(0, next_sample - time.time()))
+        finally:
+            self.publisher.storage_resolution = storage_resolution
+            self._sample_states = None
+
+    def _collect(self, cluster_name):
+        try:
+            self.stats(cluster_name).send_cluster_metrics(self.publisher)
+            return True
+        except Exception: #pylint: disable=W0703
+            logger.exception("Failed to collect metrics for %s", cluster_name)
+            return False
+
+    def send_cache_metrics(self):
+        """ sends the task definition cache hits and misses for this invocation """
+        dimensions = [{
+            "Name": "FunctionName",
+            "Value": os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        }]
+        timestamp = datetime.datetime.now(dateutil.tz.tzlocal())
+        self.publisher.publish([{
+            "MetricName": "Task Definition Cache Hits",
+            "Dimensions": dimensions,
+            "Timestamp": timestamp,
+            "Value": TASK_DEFINITIONS.hits,
+            "Unit": "Count"
+        }, {
+            "MetricName": "Task Definition Cache Misses",
+            "Dimensions": dimensions,
+            "Timestamp": timestamp,
+            "Value": TASK_DEFINITIONS.misses,
+            "Unit": "Count"
+        }])
+        self.publisher.flush()
+
+    def send_api_metrics(self):
+        """ logs this invocation's api calls, publishing them with API_METRICS on """
+        def publish(metrics):
+            self.publisher.publish(metrics)
+            self.publisher.flush()
+        clients.report('Metrics API calls', publish, {
+            'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        })
 
 class ContainerStats:
     """
@@ -52,14 +281,48 @@ class ContainerStats:
             )
         )
 
+    @property
+    def resource_requirements(self):
+        """ returns the extra resources the container asks for, like GPU, by name """
+        requirements = {}
+        for requirement in self._container.get('resourceRequirements', []):
+            requirements[requirement['type']] = \
+                requirements.get(requirement['type'], 0) + requirement_amount(requirement)
+        return requirements
+
+    def host_ports(self, network_mode='bridge'):
+        """
+        returns the static host ports the container binds as port/protocol.
+        Dynamic bridge ports and awsvpc tasks don't take ports on the host.
+        """
+        if network_mode == 'awsvpc':
+            return []
+        ports = []
+        for mapping in self._container.get('portMappings', []):
+            if network_mode == 'host':
+                port = mapping.get('hostPort') or mapping.get('containerPort')
+            else:
+                port = mapping.get('hostPort')
+            if port:
+                ports.append("{}/{}".format(port, mapping.get('protocol', 'tcp').lower()))
+        return ports
+
 class ServiceStats:
     """ Object for service stats """
-    def __init__(self, service):
+    def __init__(self, service, ecs=None, container_definitions=None, task_definition_doc=None):
         self._svc = service
         self.task_definition = service["taskDefinition"]
-        self._task_definitions = []
+        self._task_definition_doc = task_definition_doc
+        if task_definition_doc is None and container_definitions:
+            self._task_definition_doc = {'containerDefinitions': container_definitions}
+        self._containers = None
         self.desired = service["desiredCount"]
-        self.ecs = boto3.client('ecs')
+        self.ecs = ecs or clients.client('ecs')
+
+    @property
+    def name(self):
+        """ returns the service name """
+        return self._svc.get('serviceName')
 
     @property
     def cpu_per_pod(self):
@@ -84,74 +347,189 @@ class ServiceStats:
         """ returns memory needed for the service to run on the cluster """
         return self.memory_per_pod * self.desired
 
+    @property
+    def resources_per_pod(self):
+        """ returns the extra resources the pod needs, like GPU, by name """
+        resources = {}
+        for container in self.containers:
+            for name, amount in container.resource_requirements.items():
+                resources[name] = resources.get(name, 0) + amount
+        return resources
+
+    @property
+    def task_definition_doc(self):
+        """ the compacted task definition, from the cache or described once """
+        if self._task_definition_doc is None:
+            task_definition = TASK_DEFINITIONS.get(self.task_definition)
+            if task_definition is None:
+                task_definition = TASK_DEFINITIONS.put(
+                    self.task_definition,
+                    self.ecs.describe_task_definition(
+                        taskDefinition=self.task_definition
+                    )['taskDefinition']
+                )
+            self._task_definition_doc = task_definition
+        return self._task_definition_doc
+
     @property
     def containers(self):
         """ Set the container definitions """
-        if not self._task_definitions:
-            self._task_definitions = self.ecs.describe_task_definition(
-                taskDefinition=self.task_definition
-            )['taskDefinition']['containerDefinitions']
-        return [ContainerStats(container) for container in self._task_definitions]
+        if self._containers is None:
+            self._containers = [
+                ContainerStats(container)
+                for container in self.task_definition_doc.get('containerDefinitions', [])
+            ]
+        return self._containers
+
+    @property
+    def placement_constraints(self):
+        """ the service's placement constraints followed by the task definition's """
+        return self._svc.get('placementConstraints', []) + \
+            self.task_definition_doc.get('placementConstraints', [])
+
+    @property
+    def network_mode(self):
+        """ the task definition's network mode, bridge when it isn't set """
+        return self.task_definition_doc.get('networkMode') or 'bridge'
+
+    @property
+    def host_ports(self):
+        """ every static host port a task of the service binds """
+        network_mode = self.network_mode
+        return sorted({
+            port for container in self.containers for port in container.host_ports(network_mode)
+        })
 
     @property
     def running(self):
         """ get the number of running pods in the service """
-        return self._svc['runningCount'] + self._svc['pendingCount']
+        return self._svc.get('runningCount', 0) + self._svc.get('pendingCount', 0)
 
 class ContainerInstanceStats:
     """ class for container instance statistics """
     def __init__(self, container_instance):
         self._ci = container_instance
+        self._registered = None
+        self._remaining = None
+
+    @property
+    def registered(self):
+        """ registered cpu and memory, and the extra resources, parsed once """
+        if self._registered is None:
+            self._registered = parse_resources(self._ci["registeredResources"])
+        return self._registered
+
+    @property
+    def remaining(self):
+        """ remaining cpu and memory, and the extra resources, parsed once """
+        if self._remaining is None:
+            self._remaining = parse_resources(self._ci["remainingResources"])
+        return self._remaining
+
+    @property
+    def total_resources(self):
+        """ the extra resources the instance registered, like GPU, by name """
+        return self.registered[1]
+
+    @property
+    def available_resources(self):
+        """ the extra resources still free on the instance, by name """
+        return self.remaining[1]
+
+    @property
+    def used_ports(self):
+        """
+        returns the host ports that are taken, as port/protocol. ECS lists
+        the reserved ports and the ones tasks bind under the remaining
+        PORTS and PORTS_UDP resources.
+        """
+        used = []
+        for resource in self._ci.get("remainingResources", []):
+            if resource["name"] in ("PORTS", "PORTS_UDP"):
+                protocol = 'udp' if resource["name"] == "PORTS_UDP" else 'tcp'
+                used.extend(
+                    "{}/{}".format(port, protocol) for port in resource.get("stringSetValue", [])
+                )
+        return frozenset(used)
+
+    @property
+    def arn(self):
+        """ returns the container instance arn """
+        return self._ci.get('containerInstanceArn')
+
+    @property
+    def ec2_instance_id(self):
+        """ returns the ec2 instance id of the container instance """
+        return self._ci.get('ec2InstanceId')
+
+    @property
+    def tasks(self):
+        """ returns the running and pending tasks on the container instance """
+        return self._ci.get('runningTasksCount', 0) + self._ci.get('pendingTasksCount', 0)
+
+    @property
+    def instance_type(self):
+        """ returns the ec2 instance type ECS reports in the instance attributes """
+        for attribute in self._ci.get('attributes', []):
+            if attribute['name'] == 'ecs.instance-type':
+                return attribute.get('value')
+        return None
+
+    @property
+    def attributes(self):
+        """ returns the instance attributes as sorted (name, value) pairs """
+        return tuple(sorted(
+            (attribute['name'], attribute.get('value'))
+            for attribute in self._ci.get('attributes', [])
+        ))
 
     @property
     def available_cpu(self):
         """ Return the available cpu of the container instance """
-        return [
-            item["integerValue"] \
-            for item in self._ci["remainingResources"] if item["name"] == "CPU"
-        ][0]
+        return self.remaining[0]["CPU"]
 
     @property
     def total_cpu(self):
         """ returns the nodes total cpu - this is the amount that it has minus daemons """
-        return [
-            item["integerValue"] \
-            for item in self._ci["registeredResources"] if item["name"] == "CPU"
-        ][0]
+        return self.registered[0]["CPU"]
 
     @property
     def available_memory(self):
         """ returns the total available memory of the container instance """
-        return [
-            item["integerValue"] \
-            for item in self._ci["remainingResources"] if item["name"] == "MEMORY"
-        ][0]
+        return self.remaining[0]["MEMORY"]
 
     @property
     def total_memory(self):
         """  returns total memory of the node minus daemon sets """
-        return [
-            item["integerValue"] \
-            for item in self._ci["registeredResources"] if item["name"] == "MEMORY"
-        ][0]
+        return self.registered[0]["MEMORY"]
 
 
-class ClusterStats():
+class ClusterStats(): #pylint: disable=R0902,R0904
     """
     Cluster stats object that sets up the information needed to pass to cloudwatch
     """
-    def __init__(self, cluster_name):
-        self._container_instances = []
-        self._services = []
-        self.ecs = boto3.client('ecs')
-        self.cw = boto3.client('cloudwatch')
+    def __init__(self, cluster_name, max_in_flight=None, ecs=None, cw=None, ec2=None): #pylint: disable=R0913
+        self._container_instances = None
+        self._services = None
+        self._capacity = None
+        self._placement = None
+        self._placeable = None
+        self._snapshot = None
         self.cluster_name = cluster_name
+        self.max_in_flight = int(
+            max_in_flight or os.environ.get('MAX_IN_FLIGHT', MAX_IN_FLIGHT)
+        )
+        self.ecs = ecs or clients.client('ecs', max_pool_connections=self.max_in_flight)
+        self.cw = cw or clients.client('cloudwatch')
+        self.ec2 = ec2 or clients.client('ec2')
+        self.publisher = metric_publisher(self.cw)
+        self.recorder = snapshot_recorder()
 
 
     @property
     def services(self):
         """ returns services for the cluster """
-        if not self._services:
+        if self._services is None:
             self._services = list(self._resolve_ecs_services())
         return self._services
 
@@ -160,18 +538,32 @@ class ClusterStats():
         """ returns services that are desired, not if services re inactive """
         return list(filter(None, [service for service in self.services if service.desired > 0]))
 
+    @property
+    def snapshot(self):
+        """
+        returns the immutable snapshot of the cluster, built once per
+        collection. The derived metrics below all read from it.
+        """
+        if self._snapshot is None:
+            self._snapshot = ClusterSnapshot.from_stats(
+                self.cluster_name,
+                self.container_instances,
+                self.services
+            )
+        return self._snapshot
+
     @property
     def service_requirements(self):
         """ returns all the services requirements for memory and cpu """
         return  {
-            'cpu': sum((service.cpu_requirement for service in self.active_services)),
-            'memory': sum((service.memory_requirement for service in self.active_services)),
+            'cpu': self.snapshot.cpu_requirement,
+            'memory': self.snapshot.memory_requirement,
         }
 
     @property
     def desired_pods(self):
         """ returns total desired pods """
-        return sum((service.desired for service in self.active_services))
+        return self.snapshot.desired_pods
 
     @property
     def largest_pod(self):
@@ -179,17 +571,61 @@ class ClusterStats():
         returns largest memory pod in cluster
         if we can't schedule these, we need to scale
         """
-        try:
-            return list(
-                reversed(
-                    sorted(
-                        self.active_services,
-                        key=lambda svc: svc.memory_per_pod
+        return self.snapshot.largest_pod
+
+    @property
+    def task_shapes(self):
+        """ returns every distinct (cpu, memory) pod shape of the active services """
+        return list(self.snapshot.task_shapes)
+
+    @property
+    def capacity(self):
+        """ returns the capacity engine for the cluster's remaining resources """
+        if self._capacity is None:
+            self._capacity = CapacityEngine.from_container_instances(self.snapshot.instances)
+        return self._capacity
+
+    @property
+    def placement(self):
+        """ returns a placement simulator over the cluster's container instances """
+        if self._placement is None:
+            awsvpc = [service for service in self.snapshot.services if service.network_mode == 'awsvpc']
+            if awsvpc:
+                try:
+                    load_eni_limits(
+                        [instance.instance_type for instance in self.snapshot.instances], self.ec2
                     )
-                )
-            )[0]
-        except IndexError:
-            return None
+                except botocore.exceptions.ClientError:
+                    logger.exception("Couldn't look up the ENI limits, awsvpc tasks aren't bound by them")
+            self._placement = PlacementSimulator(
+                self.snapshot.instances,
+                capacity=self.capacity,
+                eni_in_use=sum(service.running for service in awsvpc)
+            )
+        return self._placement
+
+    @property
+    def placeable_tasks(self):
+        """
+        returns how many more tasks of each active service can be placed
+        given its placement constraints, and the service with the least room
+        """
+        if self._placeable is None:
+            self._placeable = self.placement.placeable_tasks(self.snapshot.services)
+        return self._placeable
+
+    @property
+    def bottleneck_tasks(self):
+        """ returns the fewest tasks of any active service each resource allows """
+        return self.placement.bottleneck_tasks(self.snapshot.services)
+
+    @property
+    def shape_headroom(self):
+        """
+        returns how many whole tasks of every distinct shape still fit,
+        along with the shape that has the least room
+        """
+        return self.capacity.headroom(self.task_shapes)
 
     @property
     def cluster_pod_dimensions(self):
@@ -198,22 +634,12 @@ class ClusterStats():
             total_number_spaces
             percentage_occupied
         """
-        if self.largest_pod:
-            total_spaces = 0
-            for ci in self.container_instances:
-                # gather available spaces in cpu and memory
-                try:
-                    cpu_spaces = ci.available_cpu / self.largest_pod.cpu_per_pod
-                except:
-                    cpu_spaces = ci.available_cpu
-                try:
-                    mem_spaces = ci.available_memory / self.largest_pod.memory_per_pod
-                except:
-                    mem_spaces = ci.available_memory
-                instance_spaces = min(cpu_spaces, mem_spaces)
-                total_spaces += instance_spaces
-
-            return total_spaces, float(self.desired_pods) / (self.desired_pods + total_spaces)
+        largest_pod = self.largest_pod
+        if largest_pod:
+            # only the instances the pod is allowed on count
+            total_spaces = self.placement.placeable(largest_pod, whole=False)
+            desired_pods = self.desired_pods
+            return total_spaces, float(desired_pods) / (desired_pods + total_spaces)
 
         logger.info("No active services on this cluster")
         return 999999, 0
@@ -221,61 +647,179 @@ class ClusterStats():
     @property
     def container_instances(self):
         """ returns container instances for the cluster """
-        if not self._container_instances:
+        if self._container_instances is None:
             self._container_instances = self._list_container_instances()
         return self._container_instances
 
     @property
     def available_memory(self):
         """ returns total cluster memory available """
-        return sum([ci.available_memory for ci in self.container_instances])
+        return self.snapshot.available_memory
 
     @property
     def total_memory(self):
         """ return total memory of cluster """
-        return sum([ci.total_memory for ci in self.container_instances])
+        return self.snapshot.total_memory
 
     @property
     def available_cpu(self):
         """ returns cpu that is left after daemonsets """
-        return sum([ci.available_cpu for ci in self.container_instances])
+        return self.snapshot.available_cpu
 
     @property
     def total_cpu(self):
         """ returns total cpu of the cluster """
-        return sum([ci.total_cpu for ci in self.container_instances])
+        return self.snapshot.total_cpu
 
-    def send_cluster_metrics(self):
+    def send_cluster_metrics(self, publisher=None):
         """
         This method collects the container instances and gets all the service
         information. It then calculates the usage info from those services.
-        It will then write that metric data to CloudWatch.
+        It will then hand that metric data to the publisher and return it.
+        """
+        timestamp = datetime.datetime.now(dateutil.tz.tzlocal())
+        metrics = self.metric_data(timestamp)
+        self.publish(metrics, timestamp, publisher)
+        return metrics
+
+    def publish(self, metrics, timestamp, publisher=None):
+        """
+        hands the metrics to the publisher. A publisher passed in is shared,
+        so flushing it is left to the caller. With SNAPSHOT_DESTINATION set
+        the snapshot is recorded along with them.
         """
+        if publisher:
+            publisher.publish(metrics)
+        else:
+            self.publisher.publish(metrics)
+            self.publisher.flush()
+        if self.recorder:
+            self.record_snapshot(metrics, timestamp)
+
+    def record_snapshot(self, metrics, timestamp):
+        """ records the snapshot, a failure is logged and doesn't stop the metrics """
+        try:
+            location = self.recorder.record(self.snapshot, metrics, timestamp)
+            logger.info("Recorded snapshot of %s to %s", self.cluster_name, location)
+        except Exception: #pylint: disable=W0703
+            logger.exception("Couldn't record the snapshot of %s", self.cluster_name)
+
+    def metric_data(self, timestamp=None):
+        """ returns every metric for the cluster as put_metric_data entries """
+        timestamp = timestamp or datetime.datetime.now(dateutil.tz.tzlocal())
+        metrics = self.cluster_metrics(timestamp)
+        if os.environ.get('DETAILED_METRICS', str(DETAILED_METRICS)).lower() in ("yes", "true", "t", "1"):
+            metrics.extend(self.service_metrics(timestamp))
+            metrics.extend(self.instance_type_metrics(timestamp))
+        return metrics
+
+    def cluster_metrics(self, timestamp):
+        """ the metrics the cluster is scaled on """
         cluster_dimensions = self.cluster_pod_dimensions
-        self.cw.put_metric_data(
-            Namespace='AWS/ECS',
-            MetricData=[{
-                "MetricName": "Schedulable Cluster Tasks",
-                "Dimensions": [{
-                    "Name": "ClusterName",
-                    "Value": self.cluster_name
-                }],
-                "Timestamp": datetime.datetime.now(dateutil.tz.tzlocal()),
-                "Value": cluster_dimensions[0]
-            }, {
-                "MetricName": "Scheduled Percentage",
-                "Dimensions": [{
-                    "Name": "ClusterName",
-                    "Value": self.cluster_name
-                }],
-                "Timestamp": datetime.datetime.now(dateutil.tz.tzlocal()),
-                "Value": cluster_dimensions[1]
-            }]
-        )
+        worst_case = self.placeable_tasks['worst_case']
+        metrics = [
+            self._metric("Schedulable Cluster Tasks", cluster_dimensions[0], timestamp),
+            self._metric("Scheduled Percentage", cluster_dimensions[1], timestamp),
+            self._metric(
+                "Worst Case Schedulable Tasks",
+                999999 if worst_case is None else worst_case,
+                timestamp
+            ),
+            # the demand the spot scaler forecasts
+            self._metric("Desired Cluster Tasks", self.desired_pods, timestamp, "Count")
+        ]
+        # the shape Schedulable Cluster Tasks counts, which the spot scaler sizes its steps by
+        largest_pod = self.largest_pod
+        if largest_pod:
+            metrics.extend([
+                self._metric("Largest Task CPU", largest_pod.cpu_per_pod, timestamp, "None"),
+                self._metric("Largest Task Memory", largest_pod.memory_per_pod, timestamp, "Megabytes")
+            ])
+        # which resource runs out first: cpu, memory, host ports or ENIs
+        for resource, tasks in sorted(self.bottleneck_tasks.items()):
+            if tasks is not None:
+                metrics.append(self._metric(
+                    "Bottleneck Schedulable Tasks", tasks, timestamp, "Count", {'Resource': resource}
+                ))
+        return metrics
+
+    def service_metrics(self, timestamp):
+        """ desired, running and reserved resources of each active service """
+        per_service = self.placeable_tasks['per_service']
+        metrics = []
+        for service in self.snapshot.services:
+            dimensions = {'ServiceName': service.name}
+            metrics.extend([
+                self._metric("Desired Tasks", service.desired, timestamp, "Count", dimensions),
+                self._metric("Running Tasks", service.running, timestamp, "Count", dimensions),
+                self._metric("CPU Reserved", service.cpu_requirement, timestamp, "None", dimensions),
+                self._metric(
+                    "Memory Reserved", service.memory_requirement, timestamp, "Megabytes", dimensions
+                ),
+                self._metric(
+                    "Schedulable Tasks", per_service.get(service.name, 0), timestamp, "Count", dimensions
+                )
+            ])
+        return metrics
+
+    def instance_type_metrics(self, timestamp):
+        """ instance count and cpu / memory totals per instance type """
+        totals = {}
+        for instance in self.snapshot.instances:
+            total = totals.setdefault(instance.instance_type or 'unknown', [0, 0, 0, 0, 0])
+            total[0] += 1
+            total[1] += instance.total_cpu
+            total[2] += instance.available_cpu
+            total[3] += instance.total_memory
+            total[4] += instance.available_memory
+
+        metrics = []
+        for instance_type, total in sorted(totals.items()):
+            dimensions = {'InstanceType': instance_type}
+            metrics.extend([
+                self._metric("Container Instances", total[0], timestamp, "Count", dimensions),
+                self._metric("Total CPU", total[1], timestamp, "None", dimensions),
+                self._metric("Available CPU", total[2], timestamp, "None", dimensions),
+                self._metric("Total Memory", total[3], timestamp, "Megabytes", dimensions),
+                self._metric("Available Memory", total[4], timestamp, "Megabytes", dimensions)
+            ])
+        return metrics
+
+    def _metric(self, name, value, timestamp, unit=None, dimensions=None): #pylint: disable=R0913
+        metric = {
+            "MetricName": name,
+            "Dimensions": [{
+                "Name": "ClusterName",
+                "Value": self.cluster_name
+            }] + [
+                {"Name": key, "Value": dimension} for key, dimension in (dimensions or {}).items()
+            ],
+            "Timestamp": timestamp,
+            "Value": value
+        }
+        if unit:
+            metric["Unit"] = unit
+        return metric
 
-    def _list_container_instances(self):
+    def load(self, container_instances, services):
+        """
+        Sets the stats from container instances and services that have
+        already been described, instead of listing the cluster
+        """
+        self._container_instances = [
+            ContainerInstanceStats(container_instance) \
+            for container_instance in container_instances
+        ]
+        self._services = self._service_stats(services)
+        self._capacity = None
+        self._placement = None
+        self._placeable = None
+        self._snapshot = None
+        return self
+
+    def list_container_instance_arns(self):
+        """ returns every active container instance arn in the cluster """
         container_instance_arns = []
-        container_instances = []
         pager = self.ecs.get_paginator("list_container_instances")
         iterator = pager.paginate(
             cluster=self.cluster_name,
@@ -283,36 +827,91 @@ class ClusterStats():
         )
         for page in iterator:
             container_instance_arns.extend(page["containerInstanceArns"])
+        return container_instance_arns
 
-        for arns in self._chunk(container_instance_arns, 50):
-            res = self.ecs.describe_container_instances(
-                cluster=self.cluster_name,
-                containerInstances=arns
-            )
-            for container_instance in res.get('containerInstances'):
-                container_instances.append(container_instance)
+    def describe_container_instances(self, arns):
+        """ describes container instances in concurrent chunks of 50 """
+        pages = self._fan_out(
+            self._describe_container_instance_chunk,
+            self._chunk(list(arns), 50)
+        )
+        return [container_instance for page in pages for container_instance in page]
+
+    def describe_services(self, arns):
+        """ describes services in concurrent batches of 10 """
+        batches = self._fan_out(self._describe_service_batch, self._chunk(list(arns), 10))
+        return [service for batch in batches for service in batch]
 
+    def _list_container_instances(self):
         return [
             ContainerInstanceStats(container_instance) \
-            for container_instance in container_instances
+            for container_instance in self.describe_container_instances(
+                self.list_container_instance_arns()
+            )
         ]
 
+    def _describe_container_instance_chunk(self, arns):
+        return self.ecs.describe_container_instances(
+            cluster=self.cluster_name,
+            containerInstances=arns
+        ).get('containerInstances')
+
+    def _fan_out(self, func, items):
+        """
+        maps func over items, using a thread pool bounded by max_in_flight
+        so describe calls overlap instead of running one after another
+        """
+        items = list(items)
+        if self.max_in_flight <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        workers = min(self.max_in_flight, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, items))
+
     @staticmethod
     def _chunk(l, n):
         for i in range(0, len(l), n):
             yield l[i:i + n]
 
+    def list_service_arns(self):
+        """ returns every service arn in the cluster """
+        return list(self._get_service_arns())
+
     def _get_service_arns(self):
         pager = self.ecs.get_paginator("list_services")
-        iterator = pager.paginate(cluster=self.cluster_name, PaginationConfig={'PageSize': 10})
+        iterator = pager.paginate(cluster=self.cluster_name, PaginationConfig={'PageSize': 100})
         for page in iterator:
             arns = page["serviceArns"]
             for arn in arns:
                 yield arn
 
+    def _describe_service_batch(self, arns):
+        return self.ecs.describe_services(cluster=self.cluster_name, services=arns)['services']
+
+    def _describe_task_definition(self, arn):
+        return TASK_DEFINITIONS.put(
+            arn,
+            self.ecs.describe_task_definition(taskDefinition=arn)['taskDefinition']
+        )
+
     def _resolve_ecs_services(self):
-        service_arns = list(self._get_service_arns())
-        for batch in self._chunk(service_arns, 10):
-            services = self.ecs.describe_services(cluster=self.cluster_name, services=batch)['services']
-            for service in services:
-                yield ServiceStats(service)
+        return self._service_stats(self.describe_services(self.list_service_arns()))
+
+    def _service_stats(self, services):
+        # only active services are ever measured, so skip the rest
+        task_definition_arns = sorted({
+            service['taskDefinition'] for service in services if service['desiredCount'] > 0
+        })
+        task_definitions = {arn: TASK_DEFINITIONS.get(arn) for arn in task_definition_arns}
+        missing = [arn for arn, task_definition in task_definitions.items() if task_definition is None]
+        task_definitions.update(zip(
+            missing,
+            self._fan_out(self._describe_task_definition, missing)
+        ))
+        return [
+            ServiceStats(
+                service,
+                ecs=self.ecs,
+                task_definition_doc=task_definitions.get(service['taskDefinition'])
+            ) for service in services
+        ]
@@ -0,0 +1,147 @@
+"""
+
+Cluster State
+Keeps an incremental view of the cluster's container instances and services,
+updated from ECS EventBridge events. Each tick only describes the instances
+and services that changed since the last one, so api calls scale with churn
+instead of cluster size. A full reconciliation still runs every
+RECONCILE_INTERVAL seconds to catch anything the events missed.
+
+"""
+
+import os
+import time
+import logging
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+RECONCILE_INTERVAL = 600
+
+class ClusterState:
+    """
+    Incremental cluster state. The stats object passed in is a ClusterStats,
+    which is used to describe the cluster and is loaded from this state.
+    """
+    def __init__(self, stats, reconcile_interval=None):
+        self.stats = stats
+        self.reconcile_interval = int(
+            reconcile_interval or os.environ.get('RECONCILE_INTERVAL', RECONCILE_INTERVAL)
+        )
+        self.container_instances = {}
+        self.services = {}
+        self.last_reconcile = None
+        self._dirty_instances = set()
+        self._dirty_services = set()
+
+    @property
+    def reconcile_due(self):
+        """ true on a cold start or when the last full reconcile is too old """
+        if self.last_reconcile is None:
+            return True
+        return time.time() - self.last_reconcile >= self.reconcile_interval
+
+    def apply(self, event):
+        """ applies a single ECS EventBridge event to the state """
+        detail_type = event.get('detail-type')
+        detail = event.get('detail', {})
+        if detail_type == 'ECS Container Instance State Change':
+            self._container_instance_changed(detail)
+        elif detail_type == 'ECS Task State Change':
+            self._task_changed(detail)
+        elif detail_type in ('ECS Service Action', 'ECS Deployment State Change'):
+            # these don't carry the desired count, so describe them next tick
+            self._dirty_services.update(event.get('resources', []))
+        else:
+            logger.info("Ignoring event %s", detail_type)
+
+    def replay(self, events):
+        """ applies recorded events in order """
+        for event in events:
+            self.apply(event)
+        return self
+
+    def touch(self):
+        """
+        marks every known container instance and service to be described
+        again on the next sync, for when there are no events to say what changed
+        """
+        self._dirty_instances.update(self.container_instances)
+        self._dirty_services.update(self.services)
+
+    def sync(self):
+        """ brings the state up to date and returns the stats loaded from it """
+        if self.reconcile_due:
+            self.reconcile()
+        else:
+            self.refresh()
+        return self.stats.load(
+            list(self.container_instances.values()),
+            list(self.services.values())
+        )
+
+    def reconcile(self):
+        """ lists and describes the whole cluster """
+        logger.info("Reconciling cluster state for %s", self.stats.cluster_name)
+        self.container_instances = {
+            container_instance['containerInstanceArn']: container_instance
+            for container_instance in self.stats.describe_container_instances(
+                self.stats.list_container_instance_arns()
+            )
+        }
+        self.services = {
+            service['serviceArn']: service
+            for service in self.stats.describe_services(self.stats.list_service_arns())
+        }
+        self._dirty_instances.clear()
+        self._dirty_services.clear()
+        self.last_reconcile = time.time()
+
+    def refresh(self):
+        """ describes only the container instances and services that changed """
+        if self._dirty_instances:
+            dirty = sorted(self._dirty_instances)
+            self._dirty_instances.clear()
+            described = self.stats.describe_container_instances(dirty)
+            for container_instance in described:
+                self._container_instance_changed(container_instance)
+            found = {ci['containerInstanceArn'] for ci in described}
+            for arn in dirty:
+                if arn not in found:
+                    self.container_instances.pop(arn, None)
+
+        if self._dirty_services:
+            dirty = sorted(self._dirty_services)
+            self._dirty_services.clear()
+            found = set()
+            for service in self.stats.describe_services(dirty):
+                found.update((service['serviceArn'], service.get('serviceName')))
+                if service.get('status') == 'INACTIVE':
+                    self.services.pop(service['serviceArn'], None)
+                else:
+                    self.services[service['serviceArn']] = service
+            missing = set(dirty) - found
+            self.services = {
+                arn: service for arn, service in self.services.items()
+                if arn not in missing and service.get('serviceName') not in missing
+            }
+
+    def _container_instance_changed(self, detail):
+        arn = detail['containerInstanceArn']
+        known = self.container_instances.get(arn)
+        if known and known.get('version', 0) > detail.get('version', 0):
+            # events can arrive out of order, keep the newest
+            return
+        if detail.get('status') == 'ACTIVE':
+            self.container_instances[arn] = detail
+        else:
+            self.container_instances.pop(arn, None)
+
+    def _task_changed(self, detail):
+        group = detail.get('group', '')
+        if group.startswith('service:'):
+            self._dirty_services.add(group[len('service:'):])
+        arn = detail.get('containerInstanceArn')
+        if arn and arn not in self.container_instances:
+            self._dirty_instances.add(arn)
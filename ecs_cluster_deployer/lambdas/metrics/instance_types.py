@@ -0,0 +1,36 @@
+"""
+
+Instance Types
+The most network interfaces each instance type can attach. With
+ECS_ENABLE_TASK_ENI every awsvpc task takes one of them and the instance keeps
+its primary interface, so an instance runs at most limit - 1 awsvpc tasks.
+
+The limits are read from describe_instance_types the first time a type is
+seen. ENI trunking raises them and isn't accounted for here. Types that
+couldn't be looked up are treated as having no limit.
+
+"""
+
+# network interfaces each instance type can attach, kept while the lambda is warm
+ENI_LIMITS = {}
+
+
+def load_eni_limits(instance_types, ec2):
+    """ looks up the limits of the instance types that aren't cached yet """
+    missing = sorted(set(filter(None, instance_types)) - set(ENI_LIMITS))
+    if not missing:
+        return
+    pager = ec2.get_paginator('describe_instance_types')
+    for page in pager.paginate(InstanceTypes=missing):
+        for instance_type in page['InstanceTypes']:
+            ENI_LIMITS[instance_type['InstanceType']] = (
+                instance_type['NetworkInfo']['MaximumNetworkInterfaces']
+            )
+
+
+def task_eni_slots(instance_type):
+    """ awsvpc tasks the instance type can run, None when it isn't known """
+    limit = ENI_LIMITS.get(instance_type)
+    if limit is None:
+        return None
+    return limit - 1
@@ -0,0 +1,416 @@
+"""
+
+Task Placement
+Works out how many more tasks of each service can actually be placed, taking
+the service's placement constraints into account instead of treating every
+instance as eligible.
+
+memberOf expressions are compiled once and evaluated once per distinct set of
+the attribute values they reference, so a cluster of thousands of instances
+built from a handful of launch configurations only evaluates a handful of
+times. distinctInstance limits a service to one task per instance.
+
+Static host ports and awsvpc network interfaces are counted too. A task with
+a static host port only fits on instances where the port is free, one per
+instance. awsvpc tasks are bound by the ENIs the instance types can attach.
+Extra resources such as GPU bind the tasks that ask for them. Each resource
+can also be measured on its own, to show which one runs out first.
+
+Placement strategies (binpack, spread, random) only decide which eligible
+instance a task lands on, never how many fit, so they don't change the count.
+
+"""
+
+import re
+import math
+import logging
+from collections import namedtuple
+from .capacity import CapacityEngine
+from .instance_types import task_eni_slots
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+TOKEN = re.compile(r"""\s*(?:
+    (?P<op>==|!=|=~|!~|>=|<=|>|<|&&|\|\||!)
+    |(?P<punct>[()\[\],])
+    |(?P<quoted>"[^"]*"|'[^']*')
+    |(?P<word>[^\s()\[\],!=<>~&|"']+)
+)""", re.VERBOSE)
+
+OPERATORS = {
+    '==': '==', 'equals': '==',
+    '!=': '!=', 'not_equals': '!=',
+    '>': '>', 'greater_than': '>',
+    '>=': '>=', 'greater_than_equal': '>=',
+    '<': '<', 'less_than': '<',
+    '<=': '<=', 'less_than_equal': '<=',
+    '=~': '=~', 'matches': '=~',
+    '!~': '!~', 'not_matches': '!~',
+    'in': 'in', 'not_in': 'not_in',
+    'exists': 'exists', 'not_exists': 'not_exists'
+}
+
+# always reported, extra resources like GPU are added when a service needs them
+RESOURCES = ('CPU', 'Memory', 'Ports', 'ENI')
+
+# operators that take the form !exists / !in
+NEGATED = {'exists': 'not_exists', 'in': 'not_in'}
+
+
+class Expression(namedtuple('Expression', ['text', 'predicate', 'attributes'])):
+    """ a compiled memberOf expression and the attribute names it reads """
+    __slots__ = ()
+
+    def __call__(self, attributes):
+        return self.predicate(attributes)
+
+
+def compile_expression(text):
+    """
+    compiles a cluster query language expression. Only attribute:<name>
+    subjects are supported, anything else raises a ValueError.
+    """
+    parser = _Parser(text)
+    predicate = parser.parse()
+    return Expression(text, predicate, tuple(sorted(parser.attributes)))
+
+
+class _Parser: #pylint: disable=R0903
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self._tokenize(text)
+        self.position = 0
+        self.attributes = set()
+
+    def _tokenize(self, text):
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if not match or match.end() == position:
+                raise ValueError("Can't parse {!r} at {}".format(text, position))
+            position = match.end()
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'quoted':
+                kind, value = 'word', value[1:-1]
+            tokens.append((kind, value))
+        return tokens
+
+    def parse(self):
+        """ parses the whole expression """
+        predicate = self._or()
+        if self._peek() is not None:
+            raise ValueError("Unexpected {!r} in {!r}".format(self._peek()[1], self.text))
+        return predicate
+
+    def _peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Unexpected end of {!r}".format(self.text))
+        self.position += 1
+        return token
+
+    def _accept(self, *values):
+        token = self._peek()
+        if token and token[1] in values:
+            self.position += 1
+            return True
+        return False
+
+    def _or(self):
+        predicates = [self._and()]
+        while self._accept('||', 'or'):
+            predicates.append(self._and())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda attributes: any(predicate(attributes) for predicate in predicates)
+
+    def _and(self):
+        predicates = [self._unary()]
+        while self._accept('&&', 'and'):
+            predicates.append(self._unary())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda attributes: all(predicate(attributes) for predicate in predicates)
+
+    def _unary(self):
+        if self._accept('!', 'not'):
+            predicate = self._unary()
+            return lambda attributes: not predicate(attributes)
+        if self._accept('('):
+            predicate = self._or()
+            if not self._accept(')'):
+                raise ValueError("Missing ) in {!r}".format(self.text))
+            return predicate
+        return self._comparison()
+
+    def _comparison(self):
+        kind, subject = self._next()
+        if kind != 'word' or not subject.startswith('attribute:'):
+            raise ValueError("Unsupported subject {!r} in {!r}".format(subject, self.text))
+        name = subject[len('attribute:'):]
+        self.attributes.add(name)
+
+        negate = self._accept('!')
+        _, operator = self._next()
+        operator = OPERATORS.get(operator)
+        if negate:
+            operator = NEGATED.get(operator)
+        if operator is None:
+            raise ValueError("Unsupported operator in {!r}".format(self.text))
+        if operator in ('exists', 'not_exists'):
+            return _predicate(name, operator, None)
+        return _predicate(name, operator, self._value())
+
+    def _value(self):
+        if self._accept('['):
+            values = [self._next()[1]]
+            while self._accept(','):
+                values.append(self._next()[1])
+            if not self._accept(']'):
+                raise ValueError("Missing ] in {!r}".format(self.text))
+            return values
+        return self._next()[1]
+
+
+def _predicate(name, operator, expected): #pylint: disable=R0911
+    if operator == 'exists':
+        return lambda attributes: attributes.get(name) is not None
+    if operator == 'not_exists':
+        return lambda attributes: attributes.get(name) is None
+    if operator in ('in', 'not_in'):
+        expected = set(expected if isinstance(expected, list) else [expected])
+        if operator == 'in':
+            return lambda attributes: attributes.get(name) in expected
+        return lambda attributes: attributes.get(name) not in expected
+    if operator in ('=~', '!~'):
+        pattern = re.compile(expected)
+        def matches(value):
+            return value is not None and pattern.fullmatch(value) is not None
+        if operator == '=~':
+            return lambda attributes: matches(attributes.get(name))
+        return lambda attributes: not matches(attributes.get(name))
+    if operator == '==':
+        return lambda attributes: attributes.get(name) == expected
+    if operator == '!=':
+        return lambda attributes: attributes.get(name) != expected
+    return lambda attributes: _compare(attributes.get(name), operator, expected)
+
+
+def _compare(value, operator, expected):
+    if value is None:
+        return False
+    try:
+        value, expected = float(value), float(expected)
+    except ValueError:
+        pass
+    if operator == '>':
+        return value > expected
+    if operator == '>=':
+        return value >= expected
+    if operator == '<':
+        return value < expected
+    return value <= expected
+
+
+EXPRESSIONS = {}
+
+def expression(text):
+    """ returns the compiled expression, compiling it on first use """
+    if text not in EXPRESSIONS:
+        EXPRESSIONS[text] = compile_expression(text)
+    return EXPRESSIONS[text]
+
+
+class PlacementSimulator:
+    """
+    Measures services against the container instances they are allowed to
+    run on. Instances are InstanceRecords and services are ServiceRecords.
+    eni_in_use is the number of awsvpc tasks already running on the cluster.
+    """
+    def __init__(self, instances, capacity=None, use_numpy=True, eni_in_use=0):
+        self.instances = tuple(instances)
+        self.capacity = capacity or CapacityEngine.from_container_instances(
+            self.instances, use_numpy=use_numpy
+        )
+        self.eni_in_use = eni_in_use
+        self._attributes = [dict(instance.attributes or ()) for instance in self.instances]
+        self._eni_slots = [task_eni_slots(instance.instance_type) for instance in self.instances]
+        self._masks = {}
+        self._port_masks = {}
+        self._spaces = {}
+
+    @property
+    def use_numpy(self):
+        """ true when the capacity engine holds numpy arrays """
+        return self.capacity.use_numpy
+
+    def eligible(self, constraints):
+        """
+        returns which instances satisfy every memberOf constraint, as a bool
+        array with numpy and a list otherwise. Expressions that can't be
+        evaluated are logged and left out, so they don't restrict anything.
+        """
+        expressions = tuple(sorted(
+            constraint[1] for constraint in constraints
+            if constraint[0] == 'memberOf' and constraint[1]
+        ))
+        if expressions not in self._masks:
+            mask = [True] * len(self.instances)
+            for text in expressions:
+                mask = [a and b for a, b in zip(mask, self._member_of(text))]
+            self._masks[expressions] = np.asarray(mask, dtype=bool) if self.use_numpy else mask
+        return self._masks[expressions]
+
+    def ports_free(self, host_ports):
+        """ returns which instances have every one of the host ports free """
+        host_ports = tuple(sorted(host_ports))
+        if host_ports not in self._port_masks:
+            mask = [
+                not instance.used_ports or instance.used_ports.isdisjoint(host_ports)
+                for instance in self.instances
+            ]
+            self._port_masks[host_ports] = np.asarray(mask, dtype=bool) if self.use_numpy else mask
+        return self._port_masks[host_ports]
+
+    def eni_available(self, mask):
+        """
+        returns the awsvpc tasks the eligible instances can still take, or
+        None when one of them is an instance type without a known limit.
+        Running awsvpc tasks are counted against them wherever they run.
+        """
+        slots = [slot for slot, allowed in zip(self._eni_slots, mask) if allowed]
+        if any(slot is None for slot in slots):
+            return None
+        return max(sum(slots) - self.eni_in_use, 0)
+
+    def _member_of(self, text):
+        try:
+            compiled = expression(text)
+        except ValueError as err:
+            logger.warning("Ignoring placement constraint: %s", err)
+            return [True] * len(self.instances)
+        results = {}
+        mask = []
+        for attributes in self._attributes:
+            signature = tuple(attributes.get(name) for name in compiled.attributes)
+            if signature not in results:
+                results[signature] = compiled(attributes)
+            mask.append(results[signature])
+        return mask
+
+    def instance_spaces(self, shape, whole=True):
+        """ per instance spaces for a shape, shared by services of the same shape """
+        key = (shape, whole)
+        if key not in self._spaces:
+            self._spaces[key] = self.capacity.instance_spaces(shape, whole=whole)
+        return self._spaces[key]
+
+    def placeable(self, service, whole=True):
+        """
+        returns how many more tasks of the service can be placed. With
+        distinctInstance every eligible instance takes at most one task, and
+        the service's running tasks are assumed to hold one instance each.
+        Static host ports also allow one task per instance, on the instances
+        where the ports are free.
+        """
+        constraints = service.placement_constraints or ()
+        host_ports = service.host_ports or ()
+        distinct = any(constraint[0] == 'distinctInstance' for constraint in constraints)
+        spaces = self.instance_spaces(service.shape, whole)
+        mask = self._and(self.eligible(constraints), self.ports_free(host_ports)) \
+            if host_ports else self.eligible(constraints)
+        one_per_instance = distinct or bool(host_ports)
+        if self.use_numpy:
+            eligible_spaces = spaces[mask]
+            if one_per_instance:
+                eligible_spaces = np.minimum(eligible_spaces, 1)
+            total = float(eligible_spaces.sum())
+            eligible_count = int(mask.sum())
+        else:
+            eligible_spaces = [space for space, allowed in zip(spaces, mask) if allowed]
+            if one_per_instance:
+                eligible_spaces = [min(space, 1) for space in eligible_spaces]
+            total = sum(eligible_spaces)
+            eligible_count = len(eligible_spaces)
+        # instances holding the service's ports are already left out
+        if distinct and not host_ports:
+            total = min(total, max(eligible_count - service.running, 0))
+        if service.network_mode == 'awsvpc':
+            eni = self.eni_available(mask)
+            if eni is not None:
+                total = min(total, eni)
+        return int(total) if whole else total
+
+    def bottlenecks(self, service):
+        """
+        returns the whole tasks of the service each resource would allow on
+        its own, on the instances its constraints allow. Resources the
+        service doesn't use are None.
+        """
+        mask = self.eligible(service.placement_constraints or ())
+        bottlenecks = dict.fromkeys(RESOURCES)
+        if service.cpu_per_pod > 0:
+            bottlenecks['CPU'] = self._whole_tasks(mask, self.capacity.cpu, service.cpu_per_pod)
+        if service.memory_per_pod > 0:
+            bottlenecks['Memory'] = self._whole_tasks(
+                mask, self.capacity.memory, service.memory_per_pod
+            )
+        if service.host_ports:
+            bottlenecks['Ports'] = int(sum(self._and(mask, self.ports_free(service.host_ports))))
+        if service.network_mode == 'awsvpc':
+            bottlenecks['ENI'] = self.eni_available(mask)
+        for name, amount in service.resources or ():
+            if amount > 0:
+                bottlenecks[name] = self._whole_tasks(mask, self.capacity.available(name), amount)
+        return bottlenecks
+
+    def bottleneck_tasks(self, services):
+        """ returns the fewest tasks each resource allows across the services """
+        worst = dict.fromkeys(RESOURCES)
+        for service in services:
+            for resource, tasks in self.bottlenecks(service).items():
+                if tasks is not None and (worst.get(resource) is None or tasks < worst[resource]):
+                    worst[resource] = tasks
+        return worst
+
+    def _and(self, mask, other):
+        if self.use_numpy:
+            return mask & other
+        return [a and b for a, b in zip(mask, other)]
+
+    def _whole_tasks(self, mask, available, required):
+        if self.use_numpy:
+            return int(np.floor(available[mask] / required).sum())
+        return int(sum(
+            math.floor(value / required) for value, allowed in zip(available, mask) if allowed
+        ))
+
+    def placeable_tasks(self, services):
+        """
+        returns whole placeable tasks per service name, along with the
+        service that has the least room
+        """
+        per_service = {service.name: self.placeable(service) for service in services}
+        if not per_service:
+            return {'per_service': {}, 'worst_service': None, 'worst_case': None}
+        worst_service = min(per_service, key=per_service.get)
+        return {
+            'per_service': per_service,
+            'worst_service': worst_service,
+            'worst_case': per_service[worst_service]
+        }
@@ -0,0 +1,148 @@
+"""
+
+Metric Publishers
+Metrics are built as put_metric_data MetricData entries and handed to a
+publisher, which buffers them until it is flushed.
+
+cloudwatch (the default) packs the buffer into as few put_metric_data calls
+as the api allows. emf writes CloudWatch Embedded Metric Format documents to
+the lambda's log stream instead, so publishing costs no api calls at all.
+Pick one with the METRICS_BACKEND env var.
+
+Either one tags the metrics with a StorageResolution when it is set, which is
+how the sampling loop publishes high resolution metrics.
+
+"""
+
+import os
+import sys
+import json
+import time
+import calendar
+import threading
+
+NAMESPACE = 'AWS/ECS'
+
+# put_metric_data accepts up to 1000 metrics per call
+MAX_METRICS_PER_CALL = 1000
+
+# an EMF document can declare up to 100 metrics
+MAX_METRICS_PER_DOCUMENT = 100
+
+
+class CloudWatchPublisher:
+    """ sends buffered metrics with as few put_metric_data calls as possible """
+    def __init__(self, cw, namespace=NAMESPACE, batch_size=MAX_METRICS_PER_CALL):
+        self.cw = cw
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.storage_resolution = None
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def publish(self, metrics):
+        """ buffers the metrics, sending full batches straight away """
+        with self._lock:
+            self._buffer.extend(_with_resolution(metrics, self.storage_resolution))
+            while len(self._buffer) >= self.batch_size:
+                self._send(self._buffer[:self.batch_size])
+                del self._buffer[:self.batch_size]
+
+    def flush(self):
+        """ sends whatever is left in the buffer """
+        with self._lock:
+            if self._buffer:
+                self._send(self._buffer)
+                self._buffer = []
+
+    def _send(self, metrics):
+        self.cw.put_metric_data(Namespace=self.namespace, MetricData=list(metrics))
+
+
+class EmfPublisher:
+    """
+    writes buffered metrics to the log stream in Embedded Metric Format.
+    Metrics sharing the same dimensions and timestamp share a document.
+    """
+    def __init__(self, stream=None, namespace=NAMESPACE):
+        self.stream = stream
+        self.namespace = namespace
+        self.storage_resolution = None
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def publish(self, metrics):
+        """ buffers the metrics until the next flush """
+        with self._lock:
+            self._buffer.extend(_with_resolution(metrics, self.storage_resolution))
+
+    def flush(self):
+        """ writes one log line per document """
+        with self._lock:
+            metrics, self._buffer = self._buffer, []
+        stream = self.stream or sys.stdout
+        for document in self.documents(metrics):
+            stream.write(json.dumps(document, separators=(',', ':')) + "\n")
+        stream.flush()
+
+    def documents(self, metrics):
+        """ groups the metrics into EMF documents """
+        groups = {}
+        for metric in metrics:
+            dimensions = tuple((d['Name'], d['Value']) for d in metric.get('Dimensions', []))
+            key = (dimensions, _epoch_millis(metric.get('Timestamp')))
+            groups.setdefault(key, []).append(metric)
+
+        for (dimensions, timestamp), grouped in groups.items():
+            for i in range(0, len(grouped), MAX_METRICS_PER_DOCUMENT):
+                yield self._document(dimensions, timestamp, grouped[i:i + MAX_METRICS_PER_DOCUMENT])
+
+    def _document(self, dimensions, timestamp, metrics):
+        document = dict(dimensions)
+        definitions = []
+        for metric in metrics:
+            definition = {'Name': metric['MetricName']}
+            if 'Unit' in metric:
+                definition['Unit'] = metric['Unit']
+            if 'StorageResolution' in metric:
+                definition['StorageResolution'] = metric['StorageResolution']
+            definitions.append(definition)
+            document[metric['MetricName']] = metric['Value']
+        document['_aws'] = {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [[name for name, _ in dimensions]],
+                'Metrics': definitions
+            }]
+        }
+        return document
+
+
+def _with_resolution(metrics, storage_resolution):
+    if not storage_resolution:
+        return metrics
+    return [
+        dict(metric, StorageResolution=metric.get('StorageResolution', storage_resolution))
+        for metric in metrics
+    ]
+
+
+def _epoch_millis(timestamp):
+    if timestamp is None:
+        return int(time.time() * 1000)
+    return calendar.timegm(timestamp.utctimetuple()) * 1000 + timestamp.microsecond // 1000
+
+
+BACKENDS = ('cloudwatch', 'emf')
+
+def metric_publisher(cw=None, backend=None):
+    """ returns the publisher for the METRICS_BACKEND env var """
+    backend = (backend or os.environ.get('METRICS_BACKEND', 'cloudwatch')).lower()
+    if backend == 'emf':
+        return EmfPublisher()
+    if backend != 'cloudwatch':
+        raise ValueError("Unknown metrics backend {}, expected one of {}".format(
+            backend, ", ".join(BACKENDS)
+        ))
+    return CloudWatchPublisher(cw)
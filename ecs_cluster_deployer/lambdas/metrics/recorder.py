@@ -0,0 +1,166 @@
+"""
+
+Snapshot Recorder
+Keeps every collected snapshot, so historical capacity can be analysed and a
+bad scaling decision can be debugged after the fact. Each snapshot's
+instances, services, task shapes and metrics are written as gzipped newline
+delimited JSON, one block of up to BLOCK_ROWS rows per line. A block holds its
+rows column by column, the way a parquet row group does, which keeps the
+files small and quick to write. Each column lines up with the record fields
+in snapshot.py, so a block loads straight into a table:
+
+    pandas.DataFrame({field: block[field] for field in InstanceRecord._fields})
+
+Objects are partitioned by cluster and hour, Hive style:
+
+    <prefix>/cluster=<name>/dt=<YYYY-MM-DD>/hour=<HH>/<HHMMSS>-<id>.json.gz
+
+Blocks are compressed as they are generated into a buffer that spills to disk
+past SPOOL_SIZE, so memory stays bounded however big the cluster is. Set
+SNAPSHOT_DESTINATION to s3://bucket/prefix, or to a local directory when
+testing.
+
+"""
+
+import os
+import gzip
+import json
+import uuid
+import datetime
+import tempfile
+try:
+    from ..common import clients
+except (ImportError, ValueError):
+    from common import clients
+
+# bytes of compressed blocks kept in memory before the buffer spills to /tmp
+SPOOL_SIZE = 1024 * 1024
+
+# columns of similar values compress well even at the fastest level
+COMPRESS_LEVEL = 1
+
+# rows per block, which bounds the memory a block takes however big the cluster is
+BLOCK_ROWS = 500
+
+ENCODER = json.JSONEncoder(separators=(',', ':'), default=str)
+
+# record fields that need converting before they encode as JSON
+CONVERTERS = {'used_ports': sorted}
+
+
+class SnapshotRecorder:
+    """ writes snapshots to s3://bucket/prefix or a local directory """
+    def __init__(self, destination, s3=None):
+        self.destination = destination
+        self._s3 = s3
+        if destination.startswith('s3://'):
+            self.bucket, _, self.prefix = destination[len('s3://'):].partition('/')
+        else:
+            self.bucket, self.prefix = None, destination
+        self.prefix = self.prefix.rstrip('/')
+
+    @property
+    def s3(self):
+        """ the s3 client, created on first upload """
+        if self._s3 is None:
+            self._s3 = clients.client('s3')
+        return self._s3
+
+    def key(self, cluster_name, timestamp):
+        """ the partitioned key, relative to the prefix, of a snapshot """
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+        return "cluster={}/dt={}/hour={}/{}-{}.json.gz".format(
+            cluster_name,
+            timestamp.strftime('%Y-%m-%d'),
+            timestamp.strftime('%H'),
+            timestamp.strftime('%H%M%S'),
+            uuid.uuid4().hex[:8]
+        )
+
+    def record(self, snapshot, metrics=(), timestamp=None):
+        """ writes the snapshot and its metrics, returns where they went """
+        timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+        key = self.key(snapshot.cluster_name, timestamp)
+        blocks = snapshot_blocks(snapshot, metrics, timestamp)
+        if self.bucket is None:
+            path = os.path.join(self.prefix, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open("{}.tmp".format(path), 'wb') as stream:
+                write_blocks(stream, blocks)
+            os.replace("{}.tmp".format(path), path)
+            return path
+        key = "{}/{}".format(self.prefix, key) if self.prefix else key
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as stream:
+            write_blocks(stream, blocks)
+            stream.seek(0)
+            self.s3.upload_fileobj(stream, self.bucket, key)
+        return "s3://{}/{}".format(self.bucket, key)
+
+
+def write_blocks(stream, blocks):
+    """ compresses the blocks into the stream, one line each """
+    with gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=COMPRESS_LEVEL) as compressed:
+        for block in blocks:
+            compressed.write((ENCODER.encode(block) + "\n").encode('utf-8'))
+
+
+def record_blocks(common, kind, records):
+    """ yields the instance or service records in blocks, column by column """
+    for i in range(0, len(records), BLOCK_ROWS):
+        chunk = records[i:i + BLOCK_ROWS]
+        block = dict(common, kind=kind, rows=len(chunk))
+        for field, values in zip(chunk[0]._fields, zip(*chunk)):
+            convert = CONVERTERS.get(field)
+            block[field] = [convert(value) for value in values] if convert else values
+        yield block
+
+
+def shape_blocks(common, task_shapes):
+    """ yields the task shapes in blocks, column by column """
+    shapes = [shape + ((),) if len(shape) == 2 else shape for shape in task_shapes]
+    for i in range(0, len(shapes), BLOCK_ROWS):
+        cpu, memory, resources = zip(*shapes[i:i + BLOCK_ROWS])
+        yield dict(common, kind='shape', rows=len(cpu), cpu=cpu, memory=memory, resources=resources)
+
+
+def metric_blocks(common, metrics):
+    """ yields the metric data in blocks, column by column """
+    metrics = list(metrics)
+    for i in range(0, len(metrics), BLOCK_ROWS):
+        chunk = metrics[i:i + BLOCK_ROWS]
+        yield dict(
+            common,
+            kind='metric',
+            rows=len(chunk),
+            metric=[metric['MetricName'] for metric in chunk],
+            value=[metric['Value'] for metric in chunk],
+            unit=[metric.get('Unit') for metric in chunk],
+            dimensions=[{
+                dimension['Name']: dimension['Value'] for dimension in metric.get('Dimensions', [])
+                if dimension['Name'] != 'ClusterName'
+            } for metric in chunk]
+        )
+
+
+def snapshot_blocks(snapshot, metrics, timestamp):
+    """
+    yields blocks of up to BLOCK_ROWS instances, services, task shapes and
+    metrics, each holding its rows column by column
+    """
+    common = {'cluster': snapshot.cluster_name, 'timestamp': timestamp.isoformat()}
+    for block in record_blocks(common, 'instance', snapshot.instances):
+        yield block
+    for block in record_blocks(common, 'service', snapshot.services):
+        yield block
+    for block in shape_blocks(common, snapshot.task_shapes):
+        yield block
+    for block in metric_blocks(common, metrics):
+        yield block
+
+
+def snapshot_recorder():
+    """ returns the recorder for SNAPSHOT_DESTINATION, None when it isn't set """
+    destination = os.environ.get('SNAPSHOT_DESTINATION')
+    if not destination:
+        return None
+    return SnapshotRecorder(destination)
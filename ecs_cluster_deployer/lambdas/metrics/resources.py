@@ -0,0 +1,52 @@
+"""
+
+Resources
+Container instances register cpu, memory, host ports and whatever devices the
+agent finds on them, such as GPUs. Everything other than cpu, memory and ports
+is an extra resource. Extra resources are counted the same way whatever they
+are called and matched by name against the resourceRequirements of the task's
+containers, so a new kind of device needs no code of its own.
+
+"""
+
+CORE_RESOURCES = ('CPU', 'MEMORY')
+PORT_RESOURCES = ('PORTS', 'PORTS_UDP')
+
+
+def resource_amount(resource):
+    """
+    returns how much of a resource there is. Device resources like GPU are
+    string sets of device ids, so they count as the number of ids.
+    """
+    kind = resource.get('type', 'INTEGER')
+    if kind == 'STRINGSET':
+        return len(resource.get('stringSetValue', []))
+    if kind == 'DOUBLE':
+        return resource.get('doubleValue', 0)
+    if kind == 'LONG':
+        return resource.get('longValue', 0)
+    return resource.get('integerValue', 0)
+
+
+def parse_resources(resources):
+    """ returns the core resources and the extra ones, each by name """
+    core = {}
+    extra = {}
+    for resource in resources:
+        name = resource['name']
+        if name in CORE_RESOURCES:
+            core[name] = resource.get('integerValue')
+        elif name not in PORT_RESOURCES:
+            extra[name] = resource_amount(resource)
+    return core, extra
+
+
+def requirement_amount(requirement):
+    """
+    returns how much of a resource a container asks for. Requirements whose
+    value isn't a count, like an accelerator's device name, count as one.
+    """
+    try:
+        return int(requirement.get('value'))
+    except (TypeError, ValueError):
+        return 1
@@ -0,0 +1,156 @@
+"""
+
+Cluster Snapshot
+An immutable view of the cluster built once per collection. Resources are
+parsed into fixed fields up front and the aggregates the metrics need are
+computed in a single pass, so reading them afterwards costs nothing.
+
+The records are slotted named tuples, which keeps them small and read only.
+
+"""
+
+from collections import namedtuple
+
+
+class InstanceRecord(namedtuple('InstanceRecord', [
+        'arn', 'total_cpu', 'total_memory', 'available_cpu', 'available_memory',
+        'instance_type', 'attributes', 'used_ports', 'resources'
+], defaults=(None, (), frozenset(), ()))):
+    """
+    a container instance's capacity, with the extra resources it has left,
+    like GPU, as sorted (name, amount) pairs
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_stats(cls, container_instance):
+        """ builds the record from ContainerInstanceStats """
+        return cls(
+            container_instance.arn,
+            container_instance.total_cpu,
+            container_instance.total_memory,
+            container_instance.available_cpu,
+            container_instance.available_memory,
+            container_instance.instance_type,
+            container_instance.attributes,
+            container_instance.used_ports,
+            tuple(sorted(container_instance.available_resources.items()))
+        )
+
+
+class ServiceRecord(namedtuple('ServiceRecord', [
+        'name', 'task_definition', 'desired', 'running', 'cpu_per_pod', 'memory_per_pod',
+        'placement_constraints', 'network_mode', 'host_ports', 'resources'
+], defaults=((), 'bridge', (), ()))):
+    """
+    a service's pod shape, desired count, (type, expression) placement
+    constraints, network mode, static host ports and the extra resources a
+    pod needs as sorted (name, amount) pairs
+    """
+    __slots__ = ()
+
+    @property
+    def shape(self):
+        """ (cpu, memory), followed by the extra resources when the pod needs any """
+        if self.resources:
+            return (self.cpu_per_pod, self.memory_per_pod, self.resources)
+        return (self.cpu_per_pod, self.memory_per_pod)
+
+    @property
+    def cpu_requirement(self):
+        """ required cpu needed for the service to run properly """
+        return self.cpu_per_pod * self.desired
+
+    @property
+    def memory_requirement(self):
+        """ returns memory needed for the service to run on the cluster """
+        return self.memory_per_pod * self.desired
+
+    @classmethod
+    def from_stats(cls, service):
+        """ builds the record from ServiceStats, reading the containers once """
+        cpu_per_pod = 0
+        memory_per_pod = 0
+        resources = {}
+        for container in service.containers:
+            cpu_per_pod += container.cpu
+            memory_per_pod += container.memory
+            for name, amount in container.resource_requirements.items():
+                resources[name] = resources.get(name, 0) + amount
+        return cls(
+            service.name,
+            service.task_definition,
+            service.desired,
+            service.running,
+            cpu_per_pod,
+            memory_per_pod,
+            tuple(
+                (constraint.get('type'), constraint.get('expression'))
+                for constraint in service.placement_constraints
+            ),
+            service.network_mode,
+            tuple(service.host_ports),
+            tuple(sorted(resources.items()))
+        )
+
+
+class ClusterSnapshot(namedtuple('ClusterSnapshot', [
+        'cluster_name', 'instances', 'services',
+        'total_cpu', 'total_memory', 'available_cpu', 'available_memory',
+        'desired_pods', 'cpu_requirement', 'memory_requirement',
+        'largest_pod', 'task_shapes'
+])):
+    """
+    Container instances and active services of a cluster, with the totals
+    the metrics are built from
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, cluster_name, instances, services):
+        """ builds the snapshot, computing every aggregate in one pass """
+        instances = tuple(instances)
+        services = tuple(service for service in services if service.desired > 0)
+
+        total_cpu = total_memory = available_cpu = available_memory = 0
+        for instance in instances:
+            total_cpu += instance.total_cpu
+            total_memory += instance.total_memory
+            available_cpu += instance.available_cpu
+            available_memory += instance.available_memory
+
+        desired_pods = cpu_requirement = memory_requirement = 0
+        largest_pod = None
+        task_shapes = set()
+        for service in services:
+            desired_pods += service.desired
+            cpu_requirement += service.cpu_per_pod * service.desired
+            memory_requirement += service.memory_per_pod * service.desired
+            # >= so ties go to the last service, like the original sort did
+            if largest_pod is None or service.memory_per_pod >= largest_pod.memory_per_pod:
+                largest_pod = service
+            task_shapes.add(service.shape)
+
+        return cls(
+            cluster_name,
+            instances,
+            services,
+            total_cpu,
+            total_memory,
+            available_cpu,
+            available_memory,
+            desired_pods,
+            cpu_requirement,
+            memory_requirement,
+            largest_pod,
+            tuple(sorted(task_shapes))
+        )
+
+    @classmethod
+    def from_stats(cls, cluster_name, container_instances, services):
+        """ builds the snapshot from ContainerInstanceStats and ServiceStats """
+        return cls.build(
+            cluster_name,
+            (InstanceRecord.from_stats(ci) for ci in container_instances),
+            (ServiceRecord.from_stats(svc) for svc in services if svc.desired > 0)
+        )
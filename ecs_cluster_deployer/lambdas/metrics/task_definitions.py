@@ -0,0 +1,127 @@
+"""
+
+Task Definition Cache
+Task definition revisions are immutable, so once one has been described it
+never needs to be described again. The cache lives at module scope so that it
+survives warm lambda invocations, and can optionally be written to /tmp.
+
+"""
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+logging.basicConfig()
+logger.setLevel(logging.INFO)
+
+# only these keys are kept, the rest of the describe response is dropped
+TASK_DEFINITION_KEYS = ('containerDefinitions', 'placementConstraints', 'networkMode')
+CONTAINER_KEYS = (
+    'name', 'cpu', 'memory', 'memoryReservation', 'portMappings', 'resourceRequirements'
+)
+
+
+def compact(task_definition):
+    """ strips a task definition down to what the metrics need """
+    compacted = {key: task_definition[key] for key in TASK_DEFINITION_KEYS if key in task_definition}
+    compacted['containerDefinitions'] = [
+        {key: container[key] for key in CONTAINER_KEYS if key in container}
+        for container in task_definition.get('containerDefinitions', [])
+    ]
+    return compacted
+
+
+def is_revision(arn):
+    """ only arns pinned to a revision are safe to cache """
+    _, _, revision = arn.rpartition(':')
+    return revision.isdigit()
+
+
+class TaskDefinitionCache:
+    """
+    LRU cache of compacted task definitions keyed by their full arn, which
+    includes the revision
+    """
+    def __init__(self, max_size=1024, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+
+    def get(self, arn):
+        """ returns the cached task definition, or None on a miss """
+        with self._lock:
+            self._load()
+            if arn in self._items:
+                self._items.move_to_end(arn)
+                self.hits += 1
+                return self._items[arn]
+            self.misses += 1
+            return None
+
+    def put(self, arn, task_definition):
+        """ compacts and stores a task definition, returns the compacted copy """
+        task_definition = compact(task_definition)
+        if not is_revision(arn):
+            return task_definition
+        with self._lock:
+            self._items[arn] = task_definition
+            self._items.move_to_end(arn)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            self._dirty = True
+        return task_definition
+
+    def stats(self):
+        """ hit / miss counts since the last reset """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+    def reset_stats(self):
+        """ resets the hit / miss counters, called once per invocation """
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """ drops everything in memory """
+        with self._lock:
+            self._items.clear()
+            self._loaded = False
+            self._dirty = False
+        self.reset_stats()
+
+    def save(self):
+        """ writes the cache to disk if it changed and a path is set """
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            tmp_path = "{}.tmp".format(self.path)
+            with open(tmp_path, 'w') as stream:
+                json.dump(list(self._items.items()), stream, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as stream:
+                for arn, task_definition in json.load(stream)[-self.max_size:]:
+                    self._items.setdefault(arn, task_definition)
+        except (OSError, ValueError) as err:
+            logger.warning("Couldn't load task definition cache: %s", err)
+
+
+TASK_DEFINITIONS = TaskDefinitionCache(
+    max_size=int(os.environ.get('TASK_DEFINITION_CACHE_SIZE', 1024)),
+    path=os.environ.get('TASK_DEFINITION_CACHE_FILE')
+)
@@ -0,0 +1,73 @@
+"""
+
+Drain Selection
+Picks which of the spot fleet's instances to drain when scaling in, instead
+of leaving it to the fleet, which terminates busy instances as readily as
+empty ones. Instances are taken cheapest first: the fewest tasks to restart,
+then the least cpu and memory to move. One is only taken when its tasks fit
+on the instances that stay, placed first fit at the instance's average task
+shape together with those of every instance already taken, so scaling in
+packs the cluster tighter instead of leaving tasks unschedulable.
+
+"""
+
+from collections import namedtuple
+
+
+class Candidate(namedtuple('Candidate', [
+        'arn', 'instance_id', 'weight', 'tasks', 'used_cpu', 'used_memory'
+])):
+    """ a fleet instance that could be drained, with what its tasks use """
+    __slots__ = ()
+
+    @property
+    def task_shape(self):
+        """ the (cpu, memory) of its average task """
+        return (self.used_cpu / float(self.tasks), self.used_memory / float(self.tasks))
+
+
+def repack_cost(candidate):
+    """ what draining the candidate costs, lowest first """
+    return (candidate.tasks, candidate.used_memory, candidate.used_cpu)
+
+
+def place(tasks, task, free):
+    """
+    places tasks of the (cpu, memory) shape first fit on the free
+    {arn: [cpu, memory]} of instances, taking what they use from it.
+    Returns whether all of them fit; free is only changed when they do.
+    """
+    placed = {arn: list(resources) for arn, resources in free.items()}
+    for _ in range(tasks):
+        for resources in placed.values():
+            if resources[0] >= task[0] and resources[1] >= task[1]:
+                resources[0] -= task[0]
+                resources[1] -= task[1]
+                break
+        else:
+            return False
+    free.update(placed)
+    return True
+
+
+def choose(candidates, free, units):
+    """
+    returns the candidates to drain that remove at most units of weight, with
+    free the {arn: [cpu, memory]} of every active instance in the cluster.
+    Every time one is added, the tasks of all the chosen ones are placed again
+    on the instances that stay, so none are moved onto an instance that is
+    drained later.
+    """
+    chosen = []
+    removed = 0
+    for candidate in sorted(candidates, key=repack_cost):
+        if removed + candidate.weight > units:
+            continue
+        drained = chosen + [candidate]
+        arns = set(c.arn for c in drained)
+        rest = {arn: list(resources) for arn, resources in free.items() if arn not in arns}
+        if not all(place(c.tasks, c.task_shape, rest) for c in drained if c.tasks):
+            continue
+        chosen = drained
+        removed += candidate.weight
+    return chosen
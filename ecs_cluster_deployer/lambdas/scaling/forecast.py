@@ -0,0 +1,214 @@
+"""
+
+Demand Forecast
+Fits Holt-Winters (additive level, trend and daily seasonality) to the
+cluster's Desired Cluster Tasks, so the spot scaler can add capacity for the
+tasks it expects in the next few minutes instead of waiting for them to show
+up as unschedulable.
+
+The history is read with get_metric_data, in the same call as the scaler's
+other metrics. The fitted model stays in the lambda's memory between
+invocations, so a warm invocation only reads and folds in the periods since
+the last one. A cold start reads
+HISTORY_SEASONS days and picks the smoothing factors with the smallest one
+step ahead error over them.
+
+"""
+
+import itertools
+from datetime import datetime, timedelta, timezone
+
+# seconds per period the demand is modelled at
+PERIOD = 300
+
+# days of history a cold start fits on
+HISTORY_SEASONS = 2
+
+# smoothing factors a cold start chooses between
+ALPHAS = (0.1, 0.3, 0.5, 0.8)
+BETAS = (0.01, 0.1)
+GAMMAS = (0.05, 0.2, 0.4)
+
+# fitted models by (cluster, metric, period), kept while the lambda is warm
+MODELS = {}
+
+
+class HoltWinters:
+    """
+    additive Holt-Winters over fixed periods. Each period's seasonal slot is
+    its period of the day, so the model picks up where it left off whatever
+    time it's next updated.
+    """
+    def __init__(self, period=PERIOD, alpha=0.3, beta=0.01, gamma=0.2):
+        self.period = period
+        self.season_length = 86400 // period
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.level = None
+        self.trend = 0.0
+        self.seasonal = [0.0] * self.season_length
+        self.updated = None
+        self.last = None
+        self.sse = 0.0
+
+    def _slot(self, timestamp):
+        return int(timestamp.timestamp()) // self.period % self.season_length
+
+    def initialise(self, points):
+        """
+        starts the trend at the change between the first two days' means and
+        the seasonal slots at each period's difference from the first day's
+        trend line. Needs a day of points, otherwise everything starts flat.
+        """
+        points = sorted(points)
+        first = points[:self.season_length]
+        if len(first) < self.season_length:
+            return
+        mean = sum(value for _, value in first) / len(first)
+        second = points[self.season_length:2 * self.season_length]
+        if len(second) == self.season_length:
+            self.trend = (sum(value for _, value in second) / len(second) - mean) / self.season_length
+        # the seasonal slots leave out the trend over the day
+        middle = (self.season_length - 1) / 2.0
+        for i, (timestamp, value) in enumerate(first):
+            self.seasonal[self._slot(timestamp)] = value - mean - self.trend * (i - middle)
+        # the level runs from the first point, where the updates start
+        self.level = mean - self.trend * middle
+
+    def update(self, timestamp, value):
+        """ folds in the value of the period starting at timestamp """
+        if self.level is None:
+            self.level = value
+        else:
+            if self.updated is not None:
+                # periods without a datapoint follow the trend
+                missing = int((timestamp - self.updated).total_seconds()) // self.period - 1
+                self.level += self.trend * min(max(missing, 0), self.season_length)
+            slot = self._slot(timestamp)
+            error = value - (self.level + self.trend + self.seasonal[slot])
+            self.sse += error * error
+            level = self.alpha * (value - self.seasonal[slot]) + (1 - self.alpha) * (self.level + self.trend)
+            self.trend = self.beta * (level - self.level) + (1 - self.beta) * self.trend
+            self.seasonal[slot] = self.gamma * (value - level) + (1 - self.gamma) * self.seasonal[slot]
+            self.level = level
+        self.updated = timestamp
+        self.last = value
+
+    def fit(self, points):
+        """ updates the model with (timestamp, value) points newer than it has seen """
+        for timestamp, value in sorted(points):
+            if self.updated is None or timestamp > self.updated:
+                self.update(timestamp, value)
+        return self
+
+    def forecast(self, steps):
+        """ the value expected steps periods after the last update """
+        slot = (self._slot(self.updated) + steps) % self.season_length
+        return self.level + steps * self.trend + self.seasonal[slot]
+
+    def peak(self, seconds):
+        """ the highest value expected over the next seconds """
+        steps = max(-(-int(seconds) // self.period), 1)
+        return max(self.forecast(step) for step in range(1, steps + 1))
+
+
+def fit(points, period=PERIOD):
+    """ fits a model to the history, choosing the smoothing factors that predict it best """
+    best = None
+    for alpha, beta, gamma in itertools.product(ALPHAS, BETAS, GAMMAS):
+        model = HoltWinters(period, alpha, beta, gamma)
+        model.initialise(points)
+        model.fit(points)
+        if best is None or model.sse < best.sse:
+            best = model
+    return best
+
+
+def history_query(cluster_name, metric_name, period=PERIOD):
+    """ the get_metric_data query for the metric's history """
+    return {
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/ECS',
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': 'ClusterName', 'Value': cluster_name}]
+            },
+            'Period': period,
+            'Stat': 'Average'
+        }
+    }
+
+
+def metric_history(cw, query, start, end):
+    """ returns (timestamp, value) points of one metric query, following NextToken """
+    points = []
+    kwargs = {
+        'MetricDataQueries': [dict(query, Id='history', ReturnData=True)],
+        'StartTime': start,
+        'EndTime': end,
+        'ScanBy': 'TimestampAscending'
+    }
+    while True:
+        res = cw.get_metric_data(**kwargs)
+        for result in res['MetricDataResults']:
+            points.extend(zip(result['Timestamps'], result['Values']))
+        if not res.get('NextToken'):
+            return points
+        kwargs['NextToken'] = res['NextToken']
+
+
+def _cached(cluster_name, metric_name, period, end):
+    # a model that hasn't been updated for a day has lost track, so it's refitted
+    model = MODELS.get((cluster_name, metric_name, period))
+    if model is not None and end - model.updated <= timedelta(days=1):
+        return model
+    return None
+
+
+def _period_end(now, period):
+    now = now or datetime.now(timezone.utc)
+    return datetime.fromtimestamp(int(now.timestamp()) // period * period, timezone.utc)
+
+
+def history_window(cluster_name, metric_name, period=PERIOD, now=None):
+    """
+    returns the (start, end) of the history the cached model hasn't seen, up
+    to the last whole period, or None when it's up to date. Without a warm
+    model that's HISTORY_SEASONS days.
+    """
+    end = _period_end(now, period)
+    model = _cached(cluster_name, metric_name, period, end)
+    if model is None:
+        return end - timedelta(days=HISTORY_SEASONS), end
+    start = model.updated + timedelta(seconds=period)
+    return (start, end) if start < end else None
+
+
+def update_model(cluster_name, metric_name, points, period=PERIOD, now=None):
+    """
+    folds the points read for history_window() into the cached model, or fits
+    a new one, and returns it. None when there's no history at all.
+    """
+    end = _period_end(now, period)
+    # the period that's still going would look like a drop in demand
+    points = [(timestamp, value) for timestamp, value in points if timestamp < end]
+    model = _cached(cluster_name, metric_name, period, end)
+    if model is not None:
+        return model.fit(points)
+    if not points:
+        return None
+    MODELS[(cluster_name, metric_name, period)] = model = fit(points, period)
+    return model
+
+
+def cached_model(cw, cluster_name, metric_name, period=PERIOD, now=None):
+    """
+    returns the model of the cluster's metric, up to the last whole period,
+    reading the history it needs with its own get_metric_data call
+    """
+    window = history_window(cluster_name, metric_name, period, now)
+    points = []
+    if window is not None:
+        points = metric_history(cw, history_query(cluster_name, metric_name, period), *window)
+    return update_model(cluster_name, metric_name, points, period, now)
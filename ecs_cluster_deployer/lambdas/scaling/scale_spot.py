@@ -1,48 +1,198 @@
 '''
 This is going to be simple.
 
-Pull ssm datetime.
-If difference(datetime, now) > scale_cooldown || error:
-    if schedulabletasks > threshold_in
-        scalein()
-        $?
-        ssm_date_set()
-    if schedulabletasks < threshold_out
-        scaleout()
-        $?
-        ssm_date_set()
+If schedulabletasks > threshold_in || schedulabletasks < threshold_out:
+    if take_cooldown()   # compare and swap, one invocation wins
+        scalein() / scaleout()
 
 Env vars:
 - CLUSTER_NAME
 - THRESHOLD_IN
 - THRESHOLD_OUT
 - SCALE_COOLDOWN
--
+- METRIC_PERIOD (seconds, 10 or 30 read high resolution metrics)
+- API_METRICS (also publish the invocation's api call stats)
+- FORECAST_MINUTES (scale out ahead of the demand forecast for this many minutes)
+- STEP_SCALING (size each step from the spare tasks instead of the fixed amounts)
+- TARGET_HEADROOM (spare tasks a step aims for, between the thresholds by default)
+- FLEET_BIDS (json list of the fleet's instance_type and weight)
+- SCALER_STATE (where the cooldown is kept, see state.py)
+- CONTROLLER (collect the cluster metrics in process and decide on them,
+  publishing them for dashboards, instead of reading them back from cloudwatch)
+- SPOT_FLEETS (comma separated spot fleets a controller scales, the metrics are
+  collected once and each decision is split between the fleets)
+- PLACEMENT_COOLDOWN (seconds a placement failure scale out waits for the next)
+- PLACEMENT_MAX_STEP (most weight units one placement failure adds)
+- DRAIN_SCALE_IN (scale in by draining the instances cheapest to repack)
+- DRAIN_TIMEOUT (seconds a drained instance gets to empty before it's terminated)
+
+ECS placement failure events skip the cooldown: they scale out straight away
+by enough capacity for the tasks that couldn't be placed, at most
+PLACEMENT_MAX_STEP and once per PLACEMENT_COOLDOWN however many arrive.
 
 '''
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import logging
 import json
+import math
+import time
 import os
-import boto3
 import botocore
+try:
+    from ..common import clients
+    from ..metrics.cluster_metrics import ClusterStats, ContainerInstanceStats, ServiceStats
+    from ..metrics.task_definitions import TASK_DEFINITIONS
+    from . import drain, forecast, state
+except (ImportError, ValueError):
+    from common import clients
+    from metrics.cluster_metrics import ClusterStats, ContainerInstanceStats, ServiceStats
+    from metrics.task_definitions import TASK_DEFINITIONS
+    from scaling import drain, forecast, state
 
 logger = logging.getLogger()
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
+def decide(metric, threshold_in, threshold_out, scale_in_amount, scale_out_amount, expected=None): #pylint: disable=R0913
+    """
+    returns how much to change the target capacity by for the metric, 0 to
+    hold. With the metric expected after the forecast horizon, it scales out
+    when either is under threshold_out and only scales in when both are over
+    threshold_in. The backtest replays history through this same function.
+    """
+    if metric > float(threshold_in) and (expected is None or expected > float(threshold_in)):
+        return -int(scale_in_amount)
+    if metric < float(threshold_out) or (expected is not None and expected < float(threshold_out)):
+        return int(scale_out_amount)
+    return 0
+
+def period_start(timestamp, period):
+    """ the start of the period the timestamp falls in, which cloudwatch labels the period's datapoint with """
+    return datetime.fromtimestamp(int(timestamp.timestamp()) // period * period, timezone.utc)
+
+def latest_value(points, period, now):
+    """
+    the value of the latest period that has ended, or of the one still going
+    when none has. None without points.
+    """
+    ended = [value for timestamp, value in points if timestamp + timedelta(seconds=period) <= now]
+    if ended:
+        return ended[-1]
+    return points[-1][1] if points else None
+
+def target_capacity(current, amount, min_weight, max_weight):
+    """ the new target capacity, kept between the min and max weights """
+    return min(max(current + amount, min_weight), max_weight)
+
+def split_amount(amount, fleets):
+    """ splits a scaling amount between the fleets, the first ones taking what's left over """
+    share, left = divmod(abs(int(amount)), fleets)
+    sign = 1 if amount > 0 else -1
+    return [sign * (share + (1 if i < left else 0)) for i in range(fleets)]
+
+def fleet_ids(value):
+    """ the spot fleet ids in a comma separated list """
+    return [fleet.strip() for fleet in value.split(',') if fleet.strip()]
+
+def str2bool(v):
+    """ cleans env vars """
+    return v.lower() in ("yes", "true", "t", "1")
+
+def tasks_per_instance(instance, task):
+    """ how many whole (cpu, memory) tasks fit on a (cpu, memory) instance """
+    fits = [
+        int(available // needed) for available, needed in zip(instance, task) if needed
+    ]
+    return min(fits) if fits else 0
+
+def step_amount(spare, target, task, bids):
+    """
+    returns the weight units to add, negative to remove, that bring the spare
+    tasks of the task's (cpu, memory) shape to the target. bids are the
+    (cpu, memory, weight) of each bid's instances. Scaling out counts on the
+    bid that holds the fewest tasks per weight unit and scaling in on the one
+    that holds the most, so a step doesn't leave less than the target
+    whichever bids the fleet picks. None when the task fits on no bid.
+    """
+    fits = [
+        tasks / float(weight) for tasks, weight in (
+            (tasks_per_instance((cpu, memory), task), weight) for cpu, memory, weight in bids
+        ) if tasks > 0
+    ]
+    if not fits:
+        return None
+    deficit = target - spare
+    if deficit > 0:
+        return int(math.ceil(deficit / min(fits)))
+    return -int(math.floor(-deficit / max(fits)))
+
+def placement_amount(resource, missing, task, bids):
+    """
+    the weight units that make room for missing tasks of the (cpu, memory)
+    shape when placing them ran out of resource. A task that needs a host
+    port or an ENI gets an instance to itself. None when it fits on no bid.
+    """
+    if resource in ONE_TASK_PER_INSTANCE:
+        return missing * max(weight for _, _, weight in bids)
+    return step_amount(-missing, 0, task, bids)
+
+# placement failures running out of these place one task per new instance
+ONE_TASK_PER_INSTANCE = ('PORTS', 'PORTS_UDP', 'ENI')
+
+# seconds between placement failure scale outs, about as long as an instance takes to boot
+PLACEMENT_COOLDOWN = 180
+
+# most weight units one placement failure scales out by
+PLACEMENT_MAX_STEP = 4
+
+# the container instance attribute marking when the scaler drained an instance
+DRAIN_ATTRIBUTE = 'drained_at'
+
+# seconds a drained instance gets to empty before it's terminated anyway
+DRAIN_TIMEOUT = 900
+
+# (cpu units, memory MiB) of instance types, kept while the lambda is warm
+INSTANCE_TYPES = {}
+
+# share of an instance's memory ECS can place tasks in, the rest is the OS and agent's
+REGISTERED_MEMORY = 0.9
+
+# the metric the forecast models
+DEMAND_METRIC = 'Desired Cluster Tasks'
+
+# cloudwatch only keeps sub minute periods this long, a query reaching further
+# back than this can't ask for them
+HIGH_RESOLUTION_RETENTION = timedelta(hours=3)
+
+def bid_instances(bids, ec2):
+    """ the (cpu, memory, weight) of each bid's instances, described once while the lambda is warm """
+    missing = sorted({bid['instance_type'] for bid in bids} - set(INSTANCE_TYPES))
+    if missing:
+        pager = ec2.get_paginator('describe_instance_types')
+        for page in pager.paginate(InstanceTypes=missing):
+            for instance_type in page['InstanceTypes']:
+                INSTANCE_TYPES[instance_type['InstanceType']] = (
+                    instance_type['VCpuInfo']['DefaultVCpus'] * 1024,
+                    instance_type['MemoryInfo']['SizeInMiB'] * REGISTERED_MEMORY
+                )
+    return [
+        INSTANCE_TYPES[bid['instance_type']] + (bid.get('weight', 1),)
+        for bid in bids if bid['instance_type'] in INSTANCE_TYPES
+    ]
+
+
 class SpotScaler: #pylint: disable=R0902
     """
     This will scale the spot fleet based on a custom assignment of our
     cloudwatch metrics
     """
-    def __init__(self):
-        self.ssm = boto3.client('ssm')
-        self.cw = boto3.client('cloudwatch')
-        self.ec2 = boto3.client('ec2')
-        self.ecs = boto3.client('ecs')
-        self.cfn = boto3.client('cloudformation')
-        self.lambdy = boto3.client('lambda')
+    def __init__(self, spot_fleet=None):
+        self.cw = clients.client('cloudwatch')
+        self.ec2 = clients.client('ec2')
+        self.ecs = clients.client('ecs')
+        self.cfn = clients.client('cloudformation')
+        self.lambdy = clients.client('lambda')
         self.threshold_in = os.environ.get('SCALE_IN_THRESHOLD', 7)
         self.threshold_out = os.environ.get('SCALE_OUT_THRESHOLD', 2)
         self.scale_cooldown = os.environ.get('SCALE_COOLDOWN', 300)
@@ -51,48 +201,208 @@ class SpotScaler: #pylint: disable=R0902
         self.min_weight = int(os.environ.get('MIN_WEIGHT', '1'))
         self.max_weight = int(os.environ.get('MAX_WEIGHT', '10'))
         self.scale_metric = os.environ.get('SCALE_METRIC', 'Schedulable Cluster Tasks')
-        self.enabled = self.str2bool(os.environ.get('ENABLED', 'TRUE'))
-        self.spot_fleet = os.environ.get('SPOT_FLEET')
+        self.metric_period = int(os.environ.get('METRIC_PERIOD', 4*60))
+        self.forecast_minutes = int(os.environ.get('FORECAST_MINUTES', '0'))
+        self.step_scaling = str2bool(os.environ.get('STEP_SCALING', 'FALSE'))
+        self.target_headroom = float(os.environ.get(
+            'TARGET_HEADROOM',
+            (float(self.threshold_in) + float(self.threshold_out)) / 2
+        ))
+        self.bids = json.loads(os.environ.get('FLEET_BIDS', '[]'))
+        self.enabled = str2bool(os.environ.get('ENABLED', 'TRUE'))
+        self.controller = str2bool(os.environ.get('CONTROLLER', 'FALSE'))
+        self.drain_scale_in = str2bool(os.environ.get('DRAIN_SCALE_IN', 'FALSE'))
+        self.spot_fleet = spot_fleet or os.environ.get('SPOT_FLEET')
         self.cluster_name = os.environ.get('CLUSTER_NAME')
         self.version = os.environ.get('VERSION')
-        self.ssm_path = '/ecs-maestro/{}/{}/scaletime'.format(self.cluster_name, self.version)
+        self.state = state.state_store()
+        self.state_key = '{}/{}'.format(self.cluster_name, self.version)
         self.deactivate = os.environ.get('STATUS', 'active') == 'inactive'
-
-    def last_scale_date(self):
-        """ Gets the last scale date from SSM """
-        try:
-            res = self.ssm.get_parameters(
-                Names=[self.ssm_path]
+        # what the reads gathered, the decision runs on these
+        self._metrics = None
+        self._demand = None
+        self._state = None
+        self._target_capacity = None
+        self._version_instances = None
+        self._task_counts = {}
+        self.collector = ClusterCollector(self)
+        self.drainer = Drainer(self)
+        self.placement = PlacementScaler(self)
+        # this one first, then a scaler for each of the other SPOT_FLEETS
+        self.fleet_scalers = [self]
+        if spot_fleet is None:
+            self.fleet_scalers.extend(
+                SpotScaler(fleet) for fleet in fleet_ids(os.environ.get('SPOT_FLEETS', ''))
+                if fleet != self.spot_fleet
             )
-            return datetime.strptime(
-                res['Parameters'][0]['Value'],
-                "%Y-%m-%d %H:%M:%S.%f"
+
+    def read_fleet_state(self):
+        """
+        reads the cooldown and the fleet's target capacity together,
+        once a decision needs them. The metrics are read before, in one call
+        of their own, so a decision to hold costs nothing more.
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            reads = [executor.submit(self.read_state), executor.submit(self._read_fleet)]
+            for future in reads:
+                future.result()
+
+    def read_state(self):
+        """ reads the end of the cooldown, with the token to take the next one with """
+        self._state = self.state.read(self.state_key)
+        return self._state
+
+    def _read_fleet(self):
+        """ reads the spot fleet's target capacity """
+        self._target_capacity = self.ec2.describe_spot_fleet_requests(
+            SpotFleetRequestIds=[self.spot_fleet]
+        )['SpotFleetRequestConfigs'][0]['SpotFleetRequestConfig']['TargetCapacity']
+        return self._target_capacity
+
+    def read_metrics(self):
+        """
+        reads the scale metric, the largest task for step scaling and the
+        demand history the forecast hasn't seen, all in one get_metric_data
+        call, keeping the latest value of each. As a controller the metrics
+        are collected in process and only the history is read.
+        """
+        now = datetime.now(timezone.utc)
+        queries = {}
+        collected = {}
+        if self.controller:
+            collected = self.collector.collect_metrics(now)
+        else:
+            queries['scale'] = (self.scale_metric, self.metric_period, 'Average', now - timedelta(
+                seconds=max(self.metric_period, 60)
+            ))
+            if self.step_scaling:
+                since = now - timedelta(minutes=5)
+                queries['cpu'] = ('Largest Task CPU', 60, 'Maximum', since)
+                queries['memory'] = ('Largest Task Memory', 60, 'Maximum', since)
+        window = forecast.history_window(self.cluster_name, DEMAND_METRIC, now=now) \
+            if self.forecast_minutes else None
+        history = []
+        if window is not None:
+            if self.metric_period < 60 and window[0] < now - HIGH_RESOLUTION_RETENTION:
+                # a cold start's days of history can't share a call with sub minute periods
+                history = self._demand_history(window)
+            else:
+                queries['demand'] = (DEMAND_METRIC, forecast.PERIOD, 'Average', window[0])
+        points = self._metric_data(queries, now) if queries else {}
+        self._metrics = dict(collected, **{
+            queries[query_id][0]: latest_value(values, queries[query_id][1], now)
+            for query_id, values in points.items() if query_id != 'demand' and values
+        })
+        if self.forecast_minutes:
+            self._demand = forecast.update_model(
+                self.cluster_name, DEMAND_METRIC, history + points.get('demand', []), now=now
             )
-        except botocore.exceptions.ClientError:
-            return datetime.utcnow() - timedelta(minutes=2)
-        except ValueError:
-            return datetime.utcnow() - timedelta(minutes=2)
+        return self._metrics
 
-    @staticmethod
-    def str2bool(v):
-        """ cleans env vars """
-        return v.lower() in ("yes", "true", "t", "1")
+    def _metric_data(self, queries, end):
+        """
+        runs the {id: (metric, period, stat, start)} queries in one call,
+        returns their points by id. Each start is rounded down to its period,
+        since a datapoint is labelled with the start of its period.
+        """
+        starts = {
+            query_id: period_start(start, period) for query_id, (_, period, _, start) in queries.items()
+        }
+        kwargs = {
+            'MetricDataQueries': [{
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/ECS',
+                        'MetricName': name,
+                        'Dimensions': [{'Name': 'ClusterName', 'Value': self.cluster_name}]
+                    },
+                    'Period': period,
+                    'Stat': stat
+                }
+            } for query_id, (name, period, stat, _) in sorted(queries.items())],
+            'StartTime': min(starts.values()),
+            'EndTime': end,
+            'ScanBy': 'TimestampAscending'
+        }
+        points = {query_id: [] for query_id in queries}
+        while True:
+            res = self.cw.get_metric_data(**kwargs)
+            for result in res['MetricDataResults']:
+                start = starts[result['Id']]
+                # the call starts at the earliest query, each keeps its own window
+                points[result['Id']].extend(
+                    point for point in zip(result['Timestamps'], result['Values']) if point[0] >= start
+                )
+            if not res.get('NextToken'):
+                return points
+            kwargs['NextToken'] = res['NextToken']
 
-    def set_date(self):
-        """ Sets date to ssm """
+    def _demand_history(self, window):
+        """ reads the forecast's history on its own, a failure only loses the forecast """
         try:
-            self.ssm.delete_parameter(
-                Name=self.ssm_path
+            return forecast.metric_history(
+                self.cw, forecast.history_query(self.cluster_name, DEMAND_METRIC), *window
             )
         except botocore.exceptions.ClientError:
-            logger.info("Couldn't delete %s", self.ssm_path)
+            logger.exception("Couldn't read the demand history, scaling without the forecast")
+            return []
 
-        self.ssm.put_parameter(
-            Name=self.ssm_path,
-            Value=self.cooldown_time(),
-            Overwrite=True,
-            Type='String'
+    def decision(self):
+        """ how much the metrics read say to scale by, sized by the step when step scaling """
+        metric = self.get_metric()
+        logger.info("Metric: %s", str(metric))
+        if metric is None:
+            logger.info("No data for %s, not scaling", self.scale_metric)
+            return 0
+        expected = None
+        if self.forecast_minutes:
+            expected = metric - self.expected_growth()
+            logger.info("Expected in %s minutes: %s", self.forecast_minutes, str(expected))
+        amount = decide(
+            metric,
+            self.threshold_in,
+            self.threshold_out,
+            self.scale_amount_down,
+            self.scale_amount_up,
+            expected
+        )
+        if amount and self.step_scaling:
+            amount = self.step(metric if expected is None else min(metric, expected), amount)
+        return amount
+
+    def last_scale_date(self):
+        """ when the cooldown ends, read once per invocation """
+        if self._state is None:
+            self.read_state()
+        return datetime.utcfromtimestamp(self._state[0])
+
+    def take_cooldown(self):
+        """
+        starts the next cooldown if the last one is over, returns whether it
+        did. Of overlapping invocations only one takes it, so only one scales.
+        """
+        if self._state is None:
+            self.read_state()
+        taken = self.state.acquire(self.state_key, int(self.scale_cooldown), read=self._state)
+        # whether or not it was taken, what was read is stale now
+        self._state = None
+        return taken
+
+    def fleet_capacity(self):
+        """ the spot fleet's target capacity, described once per invocation """
+        if self._target_capacity is None:
+            self._read_fleet()
+        return self._target_capacity
+
+    def set_fleet_capacity(self, target, **kwargs):
+        """ sets the spot fleet's target capacity, kwargs go to modify_spot_fleet_request """
+        self.ec2.modify_spot_fleet_request(
+            SpotFleetRequestId=self.spot_fleet,
+            TargetCapacity=target,
+            **kwargs
         )
+        self._target_capacity = target
 
     def deactivate_stack(self):
         '''
@@ -102,15 +412,19 @@ class SpotScaler: #pylint: disable=R0902
         delete_stack()
         '''
         logger.info('deactivate stack')
-        if self.last_scale_date() > datetime.utcnow():
-            logger.info("Last scale date: %s", str(self.last_scale_date()))
+        last_scale_date = self.last_scale_date()
+        if last_scale_date > datetime.utcnow():
+            logger.info("Last scale date: %s", str(last_scale_date))
             return
         # if self.drain_asg():
-        #     self.set_date()
         #     return
-        if self.drain_spot():
-            logger.info('Draining spot fleet...')
-            self.set_date()
+        # only a drain step starts a cooldown, checking for an empty version doesn't
+        draining = [scaler for scaler in self.fleet_scalers if scaler.fleet_capacity() > 0]
+        if draining:
+            if self.take_cooldown():
+                for scaler in draining:
+                    if scaler.drain_spot():
+                        logger.info('Draining spot fleet %s...', scaler.spot_fleet)
             return
 
         if self.cluster_version_empty():
@@ -118,14 +432,22 @@ class SpotScaler: #pylint: disable=R0902
             self.delete_stack()
             logger.info("Delete the stack----")
 
+    def version_instances(self):
+        """ this version's active container instance arns, listed once per invocation """
+        if self._version_instances is None:
+            arns = []
+            pager = self.ecs.get_paginator('list_container_instances')
+            for page in pager.paginate(
+                    cluster=self.cluster_name,
+                    status='ACTIVE',
+                    filter='attribute:asg_version == {}'.format(self.version)):
+                arns.extend(page['containerInstanceArns'])
+            self._version_instances = arns
+        return self._version_instances
+
     def cluster_version_empty(self):
         """ Returns if this version of the cluster no longer has instances """
-        instances = self.ecs.list_container_instances(
-            cluster=self.cluster_name,
-            filter='attribute:asg_version == {}'.format(self.version),
-            status='ACTIVE'
-        ).get('containerInstanceArns', [])
-        return len(instances) == 0
+        return not self.version_instances()
 
     def delete_stack(self):
         """ Delete the cloudformation stack by kicking off lambda """
@@ -150,45 +472,31 @@ class SpotScaler: #pylint: disable=R0902
 
     def drain_spot(self):
         """ Modify the spot fleet """
-        target_cap = self.ec2.describe_spot_fleet_requests(
-            SpotFleetRequestIds=[self.spot_fleet]
-        )['SpotFleetRequestConfigs'][0]['SpotFleetRequestConfig']['TargetCapacity']
+        target_cap = self.fleet_capacity()
         logger.info(target_cap)
         if target_cap > 0:
-            self.ec2.modify_spot_fleet_request(
-                SpotFleetRequestId=self.spot_fleet,
-                TargetCapacity=target_cap - self.scale_amount_down
-            )
+            self.set_fleet_capacity(target_cap - self.scale_amount_down)
             return True
         return False
 
     def scale_spot(self, amount):
         """ Scale the spot fleet out """
-        current_target_size = self.ec2.describe_spot_fleet_requests(
-            SpotFleetRequestIds=[self.spot_fleet]
-        )['SpotFleetRequestConfigs'][0]['SpotFleetRequestConfig']['TargetCapacity']
+        current_target_size = self.fleet_capacity()
 
-        new_target_size = current_target_size + amount
-
-        if new_target_size < self.min_weight:
-            new_target_size = self.min_weight
-
-        if new_target_size > self.max_weight:
-            new_target_size = self.max_weight
+        new_target_size = target_capacity(
+            current_target_size, amount, self.min_weight, self.max_weight
+        )
 
         if new_target_size == current_target_size:
             logger.info('Not scaling because target size is at the min / max.')
             return
 
-        if self.has_running_tasks() and new_target_size == 0:
+        if new_target_size == 0 and self.has_running_tasks():
             logger.info('Not scaling because this cluster still has tasks')
             return
 
         try:
-            self.ec2.modify_spot_fleet_request(
-                SpotFleetRequestId=self.spot_fleet,
-                TargetCapacity=new_target_size
-            )
+            self.set_fleet_capacity(new_target_size)
             logger.info("TargetCapacity: %s", str(current_target_size))
             logger.info("Scaling spot fleet by %s", str(amount))
             logger.info("Adding the two: %s", str(current_target_size + amount))
@@ -196,59 +504,352 @@ class SpotScaler: #pylint: disable=R0902
             logger.error('failed to modify spot instances')
 
     def scale(self, amount):
-        """ Scales the spot fleet but checks the date first """
+        """ Scales the spot fleet once it has taken the cooldown """
         logger.info("Will scale again after: %s", str(self.last_scale_date()))
-        if self.last_scale_date() > datetime.utcnow():
+        if not self.take_cooldown():
             logger.info("Cooldown in effect...")
             return
-        self.scale_spot(amount)
-        self.set_date()
         logger.info("Set the new time")
+        scalers = self.fleet_scalers
+        # one decision for the cluster, split between its fleets
+        for scaler, share in zip(scalers, split_amount(amount, len(scalers))):
+            if share < 0 and scaler.drain_scale_in:
+                scaler.drainer.drain(share)
+            elif share:
+                scaler.scale_spot(share)
 
     def get_metric(self):
-        """ Get our average scale metric statistics for the cluster  """
-        res = self.cw.get_metric_statistics(
-            Namespace='AWS/ECS',
-            Period=4*60,
-            MetricName=self.scale_metric,
-            StartTime=(
-                datetime.now() - timedelta(minutes=4)
-            ),
-            EndTime=datetime.now(),
-            Dimensions=[{'Name': 'ClusterName', 'Value': self.cluster_name}],
-            Statistics=['Average']
+        """
+        the latest average of the scale metric for the cluster. Periods under
+        a minute read the high resolution metrics the sampling metrics lambda
+        sends, looking back a minute and taking the latest period. None when
+        cloudwatch has no data for it.
+        """
+        if self._metrics is None:
+            self.read_metrics()
+        return self._metrics.get(self.scale_metric)
+
+    def expected_growth(self):
+        """
+        how many more tasks the demand forecast expects the cluster to want
+        within FORECAST_MINUTES than it wanted in the last period
+        """
+        if self._metrics is None:
+            self.read_metrics()
+        if self._demand is None:
+            return 0
+        return max(self._demand.peak(self.forecast_minutes * 60) - self._demand.last, 0)
+
+    def step(self, spare, amount):
+        """
+        resizes a scaling decision so one step restores the target headroom,
+        keeping the fixed amount when the step can't be sized
+        """
+        try:
+            bids = bid_instances(self.bids, self.ec2)
+        except botocore.exceptions.ClientError:
+            logger.exception("Couldn't size the step, scaling by the fixed amount")
+            return amount
+        task = self._metrics or {}
+        if 'Largest Task Memory' not in task:
+            return amount
+        step = step_amount(
+            spare,
+            self.target_headroom,
+            (task.get('Largest Task CPU', 0), task['Largest Task Memory']),
+            bids
         )
-        logger.info(res)
-        return res['Datapoints'][0]['Average']
+        if step is None:
+            return amount
+        # the thresholds decide the direction, the step only how far
+        return max(step, 1) if amount > 0 else min(step, 0)
 
     def has_running_tasks(self):
-        """ checks to see if the cluster has running tasks """
-        res = self.ecs.list_tasks(
-            cluster=self.cluster_name,
-            desiredStatus='RUNNING'
+        """
+        checks whether this version's instances run or are starting any tasks,
+        from their task counters. Instances are described 100 at a time, and
+        only until one has tasks; the counts are kept for the invocation.
+        """
+        arns = self.version_instances()
+        for i in range(0, len(arns), 100):
+            chunk = arns[i:i + 100]
+            missing = [arn for arn in chunk if arn not in self._task_counts]
+            if missing:
+                for container_instance in self.ecs.describe_container_instances(
+                        cluster=self.cluster_name,
+                        containerInstances=missing
+                ).get('containerInstances', []):
+                    self._task_counts[container_instance['containerInstanceArn']] = \
+                        ContainerInstanceStats(container_instance).tasks
+            if any(self._task_counts.get(arn) for arn in chunk):
+                return True
+        return False
+
+    def send_api_metrics(self):
+        """ logs this invocation's api calls, publishing them with API_METRICS on """
+        clients.report(
+            'Scaler API calls',
+            lambda metrics: self.cw.put_metric_data(Namespace='AWS/ECS', MetricData=metrics),
+            {'ClusterName': self.cluster_name or 'local'}
         )
-        logger.info(res)
-        return len(res['taskArns']) > 0
 
-    def cooldown_time(self):
-        """ Calculates cooldown time of the cluster scale events """
-        return str(timedelta(seconds=self.scale_cooldown) + datetime.utcnow())
+
+class ClusterCollector:
+    """
+    Measures the cluster in process for the scaler, the way the metrics
+    lambda does, through the scaler's clients
+    """
+    def __init__(self, scaler):
+        self.scaler = scaler
+
+    def collect_metrics(self, timestamp):
+        """
+        measures the cluster the way the metrics lambda does and publishes
+        the metrics, returning the cluster wide ones by name. A failed publish
+        only costs the dashboards, the decision still runs on them.
+        """
+        stats = self.cluster_stats()
+        metrics = stats.metric_data(timestamp)
+        try:
+            stats.publish(metrics, timestamp)
+        except botocore.exceptions.ClientError:
+            logger.exception("Couldn't publish the cluster metrics")
+        TASK_DEFINITIONS.save()
+        return {
+            metric['MetricName']: metric['Value']
+            for metric in metrics if len(metric['Dimensions']) == 1
+        }
+
+    def cluster_stats(self):
+        """ the cluster's stats, sharing the scaler's clients """
+        scaler = self.scaler
+        return ClusterStats(scaler.cluster_name, ecs=scaler.ecs, cw=scaler.cw, ec2=scaler.ec2)
+
+
+class Drainer:
+    """
+    Scales the spot fleet in by draining the instances that are cheapest to
+    repack, see drain.py, for the scaler it's given
+    """
+    def __init__(self, scaler):
+        self.scaler = scaler
+        self.timeout = int(os.environ.get('DRAIN_TIMEOUT', DRAIN_TIMEOUT))
+        self._draining = None
+
+    def fleet_instances(self):
+        """ the spot fleet's running instances, {instance id: instance type} """
+        instances = {}
+        kwargs = {'SpotFleetRequestId': self.scaler.spot_fleet}
+        while True:
+            res = self.scaler.ec2.describe_spot_fleet_instances(**kwargs)
+            instances.update(
+                (instance['InstanceId'], instance['InstanceType']) for instance in res['ActiveInstances']
+            )
+            if not res.get('NextToken'):
+                return instances
+            kwargs['NextToken'] = res['NextToken']
+
+    def instance_weight(self, instance_type):
+        """ the fleet weight an instance of the type counts as """
+        for bid in self.scaler.bids:
+            if bid['instance_type'] == instance_type:
+                return bid.get('weight', 1)
+        return 1
+
+    def draining_instances(self):
+        """ this version's instances the scaler drained that are still registered """
+        if self._draining is None:
+            arns = []
+            pager = self.scaler.ecs.get_paginator('list_container_instances')
+            for page in pager.paginate(
+                    cluster=self.scaler.cluster_name,
+                    status='DRAINING',
+                    filter='attribute:{} exists and attribute:asg_version == {}'.format(
+                        DRAIN_ATTRIBUTE, self.scaler.version
+                    )):
+                arns.extend(page['containerInstanceArns'])
+            self._draining = [
+                ContainerInstanceStats(container_instance)
+                for container_instance in self.scaler.collector.cluster_stats().describe_container_instances(arns)
+            ] if arns else []
+        return self._draining
+
+    def drain(self, amount):
+        """
+        scales in by draining the fleet's instances that are cheapest to
+        repack, see drain.py. finish_drains() terminates them once their
+        tasks have moved, until then no more are drained.
+        """
+        current = self.scaler.fleet_capacity()
+        units = current - target_capacity(current, amount, self.scaler.min_weight, self.scaler.max_weight)
+        if units <= 0:
+            logger.info('Not scaling because target size is at the min / max.')
+            return
+        if self.draining_instances():
+            logger.info('Not draining more until the drained instances are gone')
+            return
+        instances = self.scaler.collector.cluster_stats().container_instances
+        fleet = self.fleet_instances()
+        chosen = drain.choose(
+            [
+                drain.Candidate(
+                    instance.arn,
+                    instance.ec2_instance_id,
+                    self.instance_weight(fleet[instance.ec2_instance_id]),
+                    instance.tasks,
+                    instance.total_cpu - instance.available_cpu,
+                    instance.total_memory - instance.available_memory
+                ) for instance in instances if instance.ec2_instance_id in fleet
+            ],
+            {instance.arn: [instance.available_cpu, instance.available_memory] for instance in instances},
+            units
+        )
+        if not chosen:
+            logger.info("No instance's tasks fit on the rest of the cluster, not draining")
+            return
+        drained_at = str(int(time.time()))
+        for i in range(0, len(chosen), 10):
+            arns = [candidate.arn for candidate in chosen[i:i + 10]]
+            self.scaler.ecs.put_attributes(cluster=self.scaler.cluster_name, attributes=[{
+                'name': DRAIN_ATTRIBUTE,
+                'value': drained_at,
+                'targetType': 'container-instance',
+                'targetId': arn
+            } for arn in arns])
+            self.scaler.ecs.update_container_instances_state(
+                cluster=self.scaler.cluster_name,
+                containerInstances=arns,
+                status='DRAINING'
+            )
+        logger.info("Draining %s", ", ".join(candidate.instance_id for candidate in chosen))
+
+    def finish_drains(self):
+        """
+        terminates the drained instances once their tasks have gone, or
+        DRAIN_TIMEOUT after they were drained. The fleet's target drops first
+        without terminating anything, so the fleet doesn't replace them.
+        """
+        try:
+            now = time.time()
+            done = [
+                instance for instance in self.draining_instances()
+                if not instance.tasks or
+                now - float(dict(instance.attributes).get(DRAIN_ATTRIBUTE) or 0) >= self.timeout
+            ]
+            if not done:
+                return
+            fleet = self.fleet_instances()
+            done = [instance for instance in done if instance.ec2_instance_id in fleet]
+            if not done:
+                return
+            units = sum(self.instance_weight(fleet[instance.ec2_instance_id]) for instance in done)
+            new_target_size = target_capacity(
+                self.scaler.fleet_capacity(), -units, self.scaler.min_weight, self.scaler.max_weight
+            )
+            self.scaler.set_fleet_capacity(new_target_size, ExcessCapacityTerminationPolicy='noTermination')
+            for instance in done:
+                self.scaler.ecs.deregister_container_instance(
+                    cluster=self.scaler.cluster_name, containerInstance=instance.arn, force=True
+                )
+            self.scaler.ec2.terminate_instances(InstanceIds=[instance.ec2_instance_id for instance in done])
+            self._draining = [instance for instance in self._draining if instance not in done]
+            logger.info("Terminated drained %s", ", ".join(instance.ec2_instance_id for instance in done))
+        except botocore.exceptions.ClientError:
+            logger.exception("Couldn't finish draining")
+
+
+class PlacementScaler:
+    """
+    Scales the spot fleet out for the scaler as soon as ECS can't place a
+    service's tasks, by enough capacity for them
+    """
+    def __init__(self, scaler):
+        self.scaler = scaler
+        self.key = '{}/placement'.format(scaler.cluster_name)
+        self.cooldown = int(os.environ.get('PLACEMENT_COOLDOWN', PLACEMENT_COOLDOWN))
+        self.max_step = int(os.environ.get('PLACEMENT_MAX_STEP', PLACEMENT_MAX_STEP))
+
+    def step(self, resource, service_arn):
+        """
+        how far to scale out for a service ECS couldn't place tasks for,
+        sized from its missing tasks and their shape when the bids are known
+        """
+        service = self.scaler.ecs.describe_services(
+            cluster=self.scaler.cluster_name, services=[service_arn]
+        )['services'][0]
+        missing = max(
+            service['desiredCount'] - service.get('runningCount', 0) - service.get('pendingCount', 0), 1
+        )
+        try:
+            bids = bid_instances(self.scaler.bids, self.scaler.ec2)
+        except botocore.exceptions.ClientError:
+            logger.exception("Couldn't size the step, scaling by the fixed amount")
+            bids = []
+        if not bids:
+            amount = int(self.scaler.scale_amount_up)
+        else:
+            stats = ServiceStats(service, ecs=self.scaler.ecs)
+            amount = placement_amount(resource, missing, (stats.cpu_per_pod, stats.memory_per_pod), bids)
+            if amount is None:
+                logger.info("%s's tasks don't fit on any bid, not scaling", service_arn)
+                return 0
+        logger.info("%s is missing %s tasks for want of %s", service_arn, missing, resource)
+        return min(max(amount, 1), self.max_step)
+
+    def failure(self, event):
+        """
+        scales out for an ECS placement failure without waiting for the
+        cooldown. Only failures for want of a resource are capacity, and a
+        burst of them scales out once.
+        """
+        detail = event.get('detail', {})
+        kind, _, resource = detail.get('reason', '').partition(':')
+        if detail.get('eventName') != 'SERVICE_TASK_PLACEMENT_FAILURE' or kind != 'RESOURCE':
+            logger.info("Ignoring %s %s", detail.get('eventName'), detail.get('reason'))
+            return
+        read = self.scaler.state.read(self.key)
+        if read[0] > time.time():
+            logger.info("Already scaled out for a placement failure")
+            return
+        amount = self.step(resource, event.get('resources', [''])[0])
+        if amount and self.scaler.state.acquire(self.key, self.cooldown, read=read):
+            logger.info("Scaling out %s for the placement failure", amount)
+            self.scaler.scale_spot(amount)
 
 
 def lambda_handler(event, context): #pylint: disable=W0613
-    """ lambda init """
+    """ lambda init, ECS events are placement failures and the rest the schedule """
     spot_scaler = SpotScaler()
+    try:
+        if event.get('source') == 'aws.ecs':
+            place(spot_scaler, event)
+        else:
+            run(spot_scaler)
+    finally:
+        spot_scaler.send_api_metrics()
+
+def place(spot_scaler, event):
+    """ reacts to a placement failure, unless the stack is on its way out """
+    if spot_scaler.deactivate or not spot_scaler.enabled:
+        logger.info('Not scaling for placement failures.')
+        return
+    spot_scaler.placement.failure(event)
+
+def run(spot_scaler):
+    """ runs one scaling decision """
     if spot_scaler.deactivate:
+        spot_scaler.read_fleet_state()
         spot_scaler.deactivate_stack()
         return
     if spot_scaler.enabled:
-        metric = spot_scaler.get_metric()
-        logger.info("Metric: %s", str(metric))
-        if metric > float(spot_scaler.threshold_in):
-            spot_scaler.scale(-int(spot_scaler.scale_amount_down))
-            logger.info('Scaling down %s', str(spot_scaler.scale_amount_down))
-        if metric < float(spot_scaler.threshold_out):
-            spot_scaler.scale(int(spot_scaler.scale_amount_up))
-            logger.info('Scaling up %s', str(spot_scaler.scale_amount_up))
+        if spot_scaler.drain_scale_in:
+            for scaler in spot_scaler.fleet_scalers:
+                scaler.drainer.finish_drains()
+        spot_scaler.read_metrics()
+        amount = spot_scaler.decision()
+        if amount:
+            spot_scaler.read_fleet_state()
+            spot_scaler.scale(amount)
+            logger.info('Scaling %s %s', 'up' if amount > 0 else 'down', str(abs(amount)))
     else:
         logging.info('Scaling not enabled.')
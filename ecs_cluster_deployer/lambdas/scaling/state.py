@@ -0,0 +1,226 @@
+"""
+
+Scaler State
+Where the spot scaler keeps the end of its cooldown. Each store reads a key's
+value along with a token, and swaps in a new value only while the token still
+matches. acquire() builds a lease on that: the first invocation to swap an
+expired cooldown for a new one gets to scale, an overlapping one that read
+the same cooldown loses the swap and leaves the fleet alone.
+
+Values are cooldown ends in epoch seconds. Pick the store with SCALER_STATE:
+
+    ssm                    /ecs-maestro/<key>/scaletime parameters (the default)
+    dynamodb:<table>       an item per key, written with conditional puts
+    file:<path>            a JSON file, locked while it's swapped
+    memory                 this process only, for tests
+
+SSM can't make a put conditional, so its swap checks the version the put
+returned: only the invocation whose put made the next version wins.
+Its write throughput is low, so DynamoDB suits accounts with many clusters.
+
+"""
+
+import os
+import abc
+import json
+import time
+import fcntl
+import threading
+from datetime import datetime
+import botocore
+try:
+    from ..common import clients
+except (ImportError, ValueError):
+    from common import clients
+
+# the format cooldowns were written in before they were epoch seconds
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class StateStore(abc.ABC):
+    """ compare and swap over keyed cooldown ends """
+    @abc.abstractmethod
+    def read(self, key):
+        """ returns the key's value, 0 when it has none, and the token to swap it with """
+
+    @abc.abstractmethod
+    def swap(self, key, token, value):
+        """ writes the value if the key hasn't changed since the read that returned token """
+
+    def acquire(self, key, seconds, now=None, read=None):
+        """
+        takes the cooldown lease for seconds when the last one has run out,
+        returns whether this caller got it. read is a (value, token) pair
+        already read for the key, which saves reading it again.
+        """
+        now = time.time() if now is None else now
+        value, token = read or self.read(key)
+        if value > now:
+            return False
+        return self.swap(key, token, now + seconds)
+
+
+class SsmStateStore(StateStore):
+    """ a String parameter per key, swapped by checking the version each put makes """
+    def __init__(self, ssm=None, prefix='/ecs-maestro'):
+        self._ssm = ssm
+        self.prefix = prefix
+
+    @property
+    def ssm(self):
+        """ the ssm client, created on first use """
+        if self._ssm is None:
+            self._ssm = clients.client('ssm')
+        return self._ssm
+
+    def name(self, key):
+        """ the parameter the key is kept in """
+        return "{}/{}/scaletime".format(self.prefix, key)
+
+    def read(self, key):
+        try:
+            parameter = self.ssm.get_parameter(Name=self.name(key))['Parameter']
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] != 'ParameterNotFound':
+                raise
+            return 0, None
+        return parse_value(parameter['Value']), parameter['Version']
+
+    def swap(self, key, token, value):
+        try:
+            version = self.ssm.put_parameter(
+                Name=self.name(key),
+                Value=repr(float(value)),
+                Overwrite=token is not None,
+                Type='String'
+            )['Version']
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'ParameterAlreadyExists':
+                return False
+            raise
+        return token is None or version == token + 1
+
+
+class DynamoDBStateStore(StateStore):
+    """ an item per key, swapped with a conditional put """
+    def __init__(self, table, dynamodb=None):
+        self.table = table
+        self._dynamodb = dynamodb
+
+    @property
+    def dynamodb(self):
+        """ the dynamodb client, created on first use """
+        if self._dynamodb is None:
+            self._dynamodb = clients.client('dynamodb')
+        return self._dynamodb
+
+    def read(self, key):
+        item = self.dynamodb.get_item(
+            TableName=self.table,
+            Key={'key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if not item:
+            return 0, None
+        return float(item['until']['N']), item['until']['N']
+
+    def swap(self, key, token, value):
+        condition = {
+            'ConditionExpression': 'attribute_not_exists(#key)',
+            'ExpressionAttributeNames': {'#key': 'key'}
+        }
+        if token is not None:
+            condition = {
+                'ConditionExpression': '#until = :token',
+                'ExpressionAttributeNames': {'#until': 'until'},
+                'ExpressionAttributeValues': {':token': {'N': token}}
+            }
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table,
+                Item={'key': {'S': key}, 'until': {'N': repr(float(value))}},
+                **condition
+            )
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+
+class MemoryStateStore(StateStore):
+    """ keys in a dict, for tests and a single process """
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def read(self, key):
+        with self._lock:
+            return self.values.get(key, (0, 0))
+
+    def swap(self, key, token, value):
+        with self._lock:
+            if self.values.get(key, (0, 0))[1] != token:
+                return False
+            self.values[key] = (value, token + 1)
+            return True
+
+
+class FileStateStore(StateStore):
+    """ every key in one JSON file, locked while it's read and swapped """
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self, stream):
+        stream.seek(0)
+        text = stream.read()
+        return json.loads(text) if text else {}
+
+    def read(self, key):
+        with open(self.path, 'a+', encoding='utf-8') as stream:
+            fcntl.flock(stream, fcntl.LOCK_SH)
+            value, version = self._load(stream).get(key, (0, 0))
+        return value, version
+
+    def swap(self, key, token, value):
+        with open(self.path, 'a+', encoding='utf-8') as stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            values = self._load(stream)
+            if values.get(key, (0, 0))[1] != token:
+                return False
+            values[key] = (value, token + 1)
+            stream.seek(0)
+            stream.truncate()
+            json.dump(values, stream)
+        return True
+
+
+def parse_value(value):
+    """ a stored cooldown end in epoch seconds, reading the old date format too """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return (datetime.strptime(value, DATE_FORMAT) - datetime(1970, 1, 1)).total_seconds()
+    except ValueError:
+        return 0
+
+
+BACKENDS = ('ssm', 'dynamodb:<table>', 'file:<path>', 'memory')
+
+def state_store(backend=None):
+    """ returns the store for the SCALER_STATE env var """
+    backend = backend or os.environ.get('SCALER_STATE', 'ssm')
+    kind, _, location = backend.partition(':')
+    if kind == 'ssm':
+        return SsmStateStore()
+    if kind == 'dynamodb' and location:
+        return DynamoDBStateStore(location)
+    if kind == 'file' and location:
+        return FileStateStore(location)
+    if kind == 'memory':
+        return MemoryStateStore()
+    raise ValueError("Unknown scaler state {}, expected one of {}".format(
+        backend, ", ".join(BACKENDS)
+    ))
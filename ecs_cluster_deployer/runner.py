@@ -6,8 +6,8 @@ import time
 import sys
 import os
 import subprocess
-import boto3
 import botocore
+from ecs_cluster_deployer.lambdas.common import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -16,7 +16,7 @@ logger.setLevel(logging.INFO)
 class Runner:
     """ Deploys CloudFormation Stacks for us """
     def __init__(self):
-        self.cf = boto3.client('cloudformation', region_name=os.environ['AWS_DEFAULT_REGION'])
+        self.cf = clients.client('cloudformation', region_name=os.environ['AWS_DEFAULT_REGION'])
         self.stack_name = ""
 
     @property
@@ -47,6 +47,40 @@ cluster:
         type: string
         regex: (sg)+-[0-9a-fA-F]+
         minlength: 11
+    event_driven_metrics:
+      type: boolean
+      excludes: metrics_sample_interval
+    metrics_collector:
+      type: string
+      allowed:
+        - cluster
+        - shared
+        - account
+        - scaler
+    metrics_owner:
+      type: string
+    metrics_backend:
+      type: string
+      allowed:
+        - cloudwatch
+        - emf
+    metrics_sample_interval:
+      type: integer
+      allowed:
+        - 5
+        - 10
+        - 30
+    record_snapshots:
+      type: boolean
+    scaling_forecast_minutes:
+      type: integer
+      min: 1
+      max: 60
+    scaler_state:
+      type: string
+      allowed:
+        - ssm
+        - dynamodb
 
 """
 def validate_cluster(cluster_obj):
@@ -2,8 +2,8 @@
 import os
 import logging
 import zipfile
-import boto3
 from botocore.client import ClientError
+from ecs_cluster_deployer.lambdas.common import clients
 
 logger = logging.getLogger()
 logging.basicConfig()
@@ -22,7 +22,7 @@ class PushArtifacts:
         self.bucket = ecs_obj.s3_bucket
         self.version = ecs_obj.version
         self.region = ecs_obj.region
-        self.s3 = boto3.resource('s3', region_name=self.region)
+        self.s3 = clients.resource('s3', region_name=self.region)
         self.upload_artifacts()
 
     @staticmethod
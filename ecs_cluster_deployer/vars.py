@@ -8,8 +8,8 @@ sane python scripts.
 import os
 import logging
 from troposphere import Template, Parameter
-import boto3
 import yaml
+from ecs_cluster_deployer.lambdas.common import clients
 from ecs_cluster_deployer.runner import Runner
 
 logger = logging.getLogger()
@@ -37,7 +37,7 @@ class ECSVars(Runner):
         self.base = self.open_vars_file()
 
         # try to gether information about the vpc / subnet
-        self.ec2 = boto3.client('ec2', region_name=self.region)
+        self.ec2 = clients.client('ec2', region_name=self.region)
         self.get_vpc_info()
         self.get_subnet_info()
 
@@ -96,7 +96,7 @@ class ECSVars(Runner):
     @property
     def account(self):
         """ Discover the account """
-        sts = boto3.client('sts')
+        sts = clients.client('sts')
         res = sts.get_caller_identity()
         return res['Account']
 
@@ -0,0 +1,36 @@
+"""
+Benchmarks the capacity engine on a large cluster.
+
+    python -m tests.benchmark.bench_capacity
+"""
+import time
+import random
+from ecs_cluster_deployer.lambdas.metrics.capacity import CapacityEngine
+
+
+def main(instances=5000, shapes=1000):
+    """ measures every shape against every instance, numpy and pure python """
+    rand = random.Random(42)
+    cpu = [rand.randrange(0, 4096) for _ in range(instances)]
+    memory = [rand.randrange(0, 16384) for _ in range(instances)]
+    task_shapes = [(rand.randrange(0, 2048), rand.randrange(0, 8192)) for _ in range(shapes)]
+
+    timings = {}
+    answers = {}
+    for use_numpy in (True, False):
+        engine = CapacityEngine(cpu, memory, use_numpy=use_numpy)
+        start = time.perf_counter()
+        headroom = engine.headroom(task_shapes)
+        timings[use_numpy] = time.perf_counter() - start
+        answers[use_numpy] = headroom['per_shape']
+        print("{:<12} {} instances x {} shapes: {:.3f}s (worst case {})".format(
+            'numpy' if engine.use_numpy else 'pure python',
+            instances, shapes, timings[use_numpy], headroom['worst_case']
+        ))
+    print("speedup: {:.1f}x, same answers: {}".format(
+        timings[False] / timings[True], answers[True] == answers[False]
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Benchmarks client construction, boto3 per object against the cached factory.
+
+A metrics run used to build a client for every service it described.
+
+    python -m tests.benchmark.bench_clients
+"""
+import time
+import boto3
+from ecs_cluster_deployer.lambdas.common import clients
+
+
+def main(constructions=500):
+    """ builds an ecs client per service the way a metrics run does """
+    start = time.perf_counter()
+    for _ in range(constructions):
+        boto3.client('ecs', region_name='us-west-2')
+    uncached = time.perf_counter() - start
+
+    clients.clear()
+    start = time.perf_counter()
+    for _ in range(constructions):
+        clients.client('ecs', region_name='us-west-2')
+    cached = time.perf_counter() - start
+
+    print("{} clients, boto3: {:.3f}s ({:.2f}ms each)".format(
+        constructions, uncached, uncached * 1000 / constructions
+    ))
+    print("{} clients, factory: {:.3f}s ({:.3f}ms each)".format(
+        constructions, cached, cached * 1000 / constructions
+    ))
+
+
+if __name__ == '__main__':
+    main()
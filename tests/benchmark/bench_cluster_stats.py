@@ -0,0 +1,37 @@
+"""
+Benchmarks ClusterStats collection against a stubbed ECS client.
+
+    python -m tests.benchmark.bench_cluster_stats
+"""
+import time
+from unittest.mock import patch
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+from tests.benchmark.stubs import StubECS, synthetic_cluster
+
+
+def collect(max_in_flight, latency):
+    """ runs one full collection and returns wall time and api calls """
+    # every run starts cold, like a fresh lambda
+    TASK_DEFINITIONS.clear()
+    with patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.clients'):
+        stats = ClusterStats('bench', max_in_flight=max_in_flight)
+    stats.ecs = StubECS(*synthetic_cluster(), latency=latency)
+    start = time.perf_counter()
+    stats.cluster_pod_dimensions #pylint: disable=W0104
+    return time.perf_counter() - start, stats.ecs.calls
+
+
+def main(latency=0.02):
+    """ compares sequential collection with the concurrent fan out """
+    sequential, calls = collect(1, latency)
+    print("sequential:         {:.2f}s ({} calls)".format(sequential, calls))
+    for max_in_flight in (5, 10, 20):
+        elapsed, calls = collect(max_in_flight, latency)
+        print("max_in_flight={:<3}   {:.2f}s ({} calls, {:.1f}x)".format(
+            max_in_flight, elapsed, calls, sequential / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
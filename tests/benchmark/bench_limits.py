@@ -0,0 +1,38 @@
+"""
+Benchmarks the rate limiter against a throttling api.
+
+Many threads call a stubbed api that allows 20 calls a second, once straight
+and once through an AIMD family limiter set a little over that limit, the way
+a misconfigured or shared account would be.
+
+    python -m tests.benchmark.bench_limits
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ecs_cluster_deployer.lambdas.common.limits import FamilyLimiter
+from tests.benchmark.stubs import StubClient
+
+
+def run(limiter, threads, calls, rate):
+    """ makes the calls from the threads, returns throughput and throttles """
+    client = StubClient(latency=0.02, rate=rate, limiter=limiter)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: client.call('DescribeServices'), range(calls)))
+    elapsed = time.perf_counter() - start
+    return calls / elapsed, client.throttled
+
+
+def main(threads=40, calls=600, rate=20):
+    """ compares the throughput and throttling with and without the limiter """
+    for name, limiter in (
+            ('unlimited', None),
+            ('aimd', FamilyLimiter(rate * 1.5, rate, threads))):
+        throughput, throttled = run(limiter, threads, calls, rate)
+        print("{:<10} {} calls from {} threads, limit {}/s: {:.1f} calls/s, {} throttled".format(
+            name, calls, threads, rate, throughput, throttled
+        ))
+
+
+if __name__ == '__main__':
+    main()
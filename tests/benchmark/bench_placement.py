@@ -0,0 +1,48 @@
+"""
+Benchmarks the placement simulator on a large constrained cluster.
+
+    python -m tests.benchmark.bench_placement
+"""
+import time
+import random
+from ecs_cluster_deployer.lambdas.metrics.placement import PlacementSimulator
+from ecs_cluster_deployer.lambdas.metrics.snapshot import InstanceRecord, ServiceRecord
+
+CONSTRAINTS = [
+    (),
+    (('memberOf', 'attribute:asg_version == v2'),),
+    (('memberOf', 'attribute:ecs.instance-type =~ m5.*'),),
+    (('memberOf', 'attribute:ecs.availability-zone in [us-west-2a, us-west-2b]'),),
+    (('distinctInstance', None),),
+]
+
+
+def main(instances=5000, services=2000):
+    """ places every service against every instance it is allowed on """
+    rand = random.Random(42)
+    records = [InstanceRecord(
+        'ci-{}'.format(i), 4096, 16384, rand.randrange(0, 4096), rand.randrange(0, 16384),
+        None, tuple(sorted({
+            'asg_version': rand.choice(['v1', 'v2']),
+            'ecs.instance-type': rand.choice(['m5.large', 'm5.xlarge', 'c5.large']),
+            'ecs.availability-zone': rand.choice(['us-west-2a', 'us-west-2b', 'us-west-2c']),
+        }.items()))
+    ) for i in range(instances)]
+    service_records = [ServiceRecord(
+        'svc-{}'.format(i), 'task:{}'.format(i), 2, 2,
+        rand.choice([128, 256, 512, 1024]), rand.choice([256, 512, 1024, 2048]),
+        rand.choice(CONSTRAINTS)
+    ) for i in range(services)]
+
+    for use_numpy in (True, False):
+        start = time.perf_counter()
+        simulator = PlacementSimulator(records, use_numpy=use_numpy)
+        placeable = simulator.placeable_tasks(service_records)
+        print("{:<12} {} instances x {} services: {:.3f}s (worst case {})".format(
+            'numpy' if simulator.use_numpy else 'pure python',
+            instances, services, time.perf_counter() - start, placeable['worst_case']
+        ))
+
+
+if __name__ == '__main__':
+    main()
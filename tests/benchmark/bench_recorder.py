@@ -0,0 +1,37 @@
+"""
+Benchmarks recording a snapshot of a large cluster to a local directory.
+
+    python -m tests.benchmark.bench_recorder
+"""
+import os
+import time
+import tempfile
+import tracemalloc
+from ecs_cluster_deployer.lambdas.metrics.recorder import SnapshotRecorder
+from tests.benchmark.bench_snapshot import build_stats
+from tests.benchmark.stubs import synthetic_cluster
+
+
+def main(instances=10000, services=2000, task_definitions=500):
+    """ records one snapshot, reporting the time, size and peak memory """
+    stats = build_stats(*synthetic_cluster(instances, services, task_definitions))
+    metrics = stats.metric_data()
+    with tempfile.TemporaryDirectory() as directory:
+        recorder = SnapshotRecorder(directory)
+        start = time.perf_counter()
+        path = recorder.record(stats.snapshot, metrics)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(path)
+
+        tracemalloc.start()
+        recorder.record(stats.snapshot, metrics)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print("{} instances / {} services: {:.3f}s, {:.0f} KB compressed, {:.1f} MB peak".format(
+        instances, services, elapsed, size / 1024.0, peak / 1024.0 / 1024.0
+    ))
+
+
+if __name__ == '__main__':
+    main()
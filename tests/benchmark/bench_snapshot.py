@@ -0,0 +1,73 @@
+"""
+Benchmarks building a ClusterSnapshot and the memory its records take.
+
+    python -m tests.benchmark.bench_snapshot
+"""
+import sys
+import time
+import tracemalloc
+from unittest.mock import MagicMock, patch
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import (
+    ClusterStats,
+    ContainerInstanceStats,
+    ServiceStats
+)
+from ecs_cluster_deployer.lambdas.metrics.snapshot import InstanceRecord
+from tests.benchmark.stubs import synthetic_cluster
+
+
+def build_stats(instances, services, task_definitions):
+    """ loads ClusterStats from the synthetic describe responses """
+    with patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.clients'):
+        stats = ClusterStats('bench')
+    ecs = MagicMock()
+    stats._container_instances = [ContainerInstanceStats(ci) for ci in instances] #pylint: disable=W0212
+    stats._services = [ #pylint: disable=W0212
+        ServiceStats(
+            svc,
+            ecs=ecs,
+            container_definitions=task_definitions[svc['taskDefinition']]['containerDefinitions']
+        ) for svc in services
+    ]
+    return stats
+
+
+def per_instance_memory(instances):
+    """ bytes allocated per InstanceRecord """
+    wrapped = [ContainerInstanceStats(ci) for ci in instances]
+    for ci in wrapped:
+        # parse the resources first so only the records are measured
+        ci.registered, ci.remaining #pylint: disable=W0104
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    records = [InstanceRecord.from_stats(ci) for ci in wrapped]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / len(records), sys.getsizeof(records[0])
+
+
+def main(instances=5000, services=2000):
+    """ times the derived metrics and reports record sizes """
+    cluster = synthetic_cluster(instances=instances, services=services, task_definitions=500)
+    stats = build_stats(*cluster)
+    start = time.perf_counter()
+    stats.service_requirements #pylint: disable=W0104
+    stats.desired_pods #pylint: disable=W0104
+    stats.cluster_pod_dimensions #pylint: disable=W0104
+    stats.total_cpu #pylint: disable=W0104
+    stats.available_memory #pylint: disable=W0104
+    print("snapshot + derived metrics, {} instances / {} services: {:.3f}s".format(
+        instances, services, time.perf_counter() - start
+    ))
+    allocated, slot_size = per_instance_memory(cluster[0])
+    print("InstanceRecord: {} bytes (object), {:.0f} bytes allocated per record".format(
+        slot_size, allocated
+    ))
+    print("raw container instance dict: {} bytes (top level only)".format(
+        sys.getsizeof(cluster[0][0])
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+End to end benchmark of the metrics path on an ECS scale synthetic cluster.
+
+Collects and publishes one cluster's metrics against stubbed ECS and
+CloudWatch clients that simulate latency and throttling, then writes the
+wall time, api calls and peak memory as JSON. Exits non zero when the run
+doesn't fit the collection budget, so it can gate a deploy.
+
+    python -m tests.benchmark.bench_suite --instances 10000 --services 2000 \\
+        --task-definitions 500 --output bench.json
+"""
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from unittest.mock import patch
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+from tests.benchmark.stubs import StubECS, StubCloudWatch, synthetic_cluster
+
+# the metrics lambda runs every minute
+BUDGET = 60
+
+
+def run(cluster, args, trace_memory=False):
+    """ collects and publishes once from a cold cache, returns the measurements """
+    TASK_DEFINITIONS.clear()
+    with patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.clients'):
+        stats = ClusterStats('bench', max_in_flight=args.max_in_flight)
+    stats.ecs = StubECS(*cluster, latency=args.latency, rate=args.rate)
+    stats.cw = stats.publisher.cw = StubCloudWatch(latency=args.latency)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    stats.snapshot #pylint: disable=W0104
+    collected = time.perf_counter()
+    stats.send_cluster_metrics()
+    finished = time.perf_counter()
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'wall_seconds': round(finished - start, 3),
+        'collect_seconds': round(collected - start, 3),
+        'compute_seconds': round(finished - collected, 3),
+        'api_calls': stats.ecs.calls + stats.cw.calls,
+        'api_calls_by_operation': dict(sorted(
+            (stats.ecs.operations + stats.cw.operations).items()
+        )),
+        'throttled': stats.ecs.throttled,
+        'metrics': stats.cw.metrics,
+        'peak_memory_mb': None if peak is None else round(peak / 1024.0 / 1024.0, 1),
+    }
+
+
+def main(argv=None):
+    """ runs the suite and writes the results """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--instances', type=int, default=10000)
+    parser.add_argument('--services', type=int, default=2000)
+    parser.add_argument('--task-definitions', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per api call')
+    parser.add_argument('--rate', type=float, default=20, help='ECS calls per second before throttling')
+    parser.add_argument('--max-in-flight', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=BUDGET, help='seconds the run has to fit in')
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc run")
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    args = parser.parse_args(argv)
+
+    cluster = synthetic_cluster(args.instances, args.services, args.task_definitions)
+    result = run(cluster, args)
+    if not args.no_memory:
+        # tracemalloc slows everything down, so peak memory gets its own run
+        result['peak_memory_mb'] = run(cluster, args, trace_memory=True)['peak_memory_mb']
+
+    report = {
+        'config': {
+            'instances': args.instances,
+            'services': args.services,
+            'task_definitions': args.task_definitions,
+            'latency': args.latency,
+            'rate': args.rate,
+            'max_in_flight': args.max_in_flight,
+        },
+        'results': result,
+        'budget_seconds': args.budget,
+        'within_budget': result['wall_seconds'] <= args.budget,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + "\n")
+    print(output)
+    return 0 if report['within_budget'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Stubbed AWS clients for the benchmarks.
+
+These answer like the real ECS api does, sleeping for a fixed latency on each
+call so that the wall clock numbers look like a run against a real cluster.
+With a rate set, calls over it are throttled and retried after a backoff,
+the way botocore retries a ThrottlingException. With a limiter set, every
+attempt goes through it first, the way the client factory's hooks do.
+"""
+import time
+import threading
+from collections import Counter
+
+
+class StubPaginator:
+    """ Paginates a list the same way botocore does """
+    def __init__(self, client, operation, key, items, page_size=100): #pylint: disable=R0913
+        self.client = client
+        self.operation = operation
+        self.key = key
+        self.items = items
+        self.page_size = page_size
+
+    def paginate(self, **kwargs):
+        """ yields pages of arns """
+        page_size = kwargs.get('PaginationConfig', {}).get('PageSize', self.page_size)
+        for i in range(0, len(self.items), page_size):
+            self.client.call(self.operation)
+            yield {self.key: self.items[i:i + page_size]}
+
+
+class StubClient:
+    """
+    Counts calls per operation and waits like the network would. rate is
+    the sustained calls per second allowed before throttling, with a burst
+    of the same size.
+    """
+    def __init__(self, latency=0.02, rate=None, backoff=0.05, limiter=None):
+        self.latency = latency
+        self.rate = rate
+        self.backoff = backoff
+        self.limiter = limiter
+        self.calls = 0
+        self.operations = Counter()
+        self.throttled = 0
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def call(self, operation):
+        """ counts the call, retrying with a backoff while it is throttled """
+        attempt = 0
+        while not self._attempt():
+            attempt += 1
+            time.sleep(self.backoff * 2 ** min(attempt, 5))
+        with self._lock:
+            self.calls += 1
+            self.operations[operation] += 1
+        time.sleep(self.latency)
+
+    def _attempt(self):
+        if self.limiter is None:
+            return self._take()
+        self.limiter.acquire()
+        taken = self._take()
+        self.limiter.release(throttled=not taken)
+        return taken
+
+    def _take(self):
+        if not self.rate:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.throttled += 1
+            return False
+
+
+class StubECS(StubClient):
+    """ ECS client that serves a synthetic cluster """
+    def __init__(self, container_instances, services, task_definitions, latency=0.02, rate=None): #pylint: disable=R0913
+        super().__init__(latency=latency, rate=rate)
+        self.container_instances = {ci['containerInstanceArn']: ci for ci in container_instances}
+        self.services = {svc['serviceArn']: svc for svc in services}
+        self.task_definitions = task_definitions
+
+    def get_paginator(self, name):
+        """ returns a paginator for the list calls """
+        if name == 'list_container_instances':
+            return StubPaginator(self, name, 'containerInstanceArns', list(self.container_instances))
+        if name == 'list_services':
+            return StubPaginator(self, name, 'serviceArns', list(self.services))
+        raise NotImplementedError(name)
+
+    def describe_container_instances(self, cluster, containerInstances): #pylint: disable=W0613,C0103
+        """ describes up to 100 container instances """
+        self.call('describe_container_instances')
+        return {'containerInstances': [self.container_instances[arn] for arn in containerInstances]}
+
+    def describe_services(self, cluster, services): #pylint: disable=W0613
+        """ describes up to 10 services """
+        self.call('describe_services')
+        return {'services': [self.services[arn] for arn in services]}
+
+    def describe_task_definition(self, taskDefinition): #pylint: disable=C0103
+        """ describes a single task definition """
+        self.call('describe_task_definition')
+        return {'taskDefinition': self.task_definitions[taskDefinition]}
+
+
+class StubCloudWatch(StubClient):
+    """ CloudWatch client that counts the metrics it is sent """
+    def __init__(self, latency=0.02, rate=None):
+        super().__init__(latency=latency, rate=rate)
+        self.metrics = 0
+
+    def put_metric_data(self, Namespace, MetricData): #pylint: disable=W0613,C0103
+        """ accepts a batch of metrics """
+        self.call('put_metric_data')
+        with self._lock:
+            self.metrics += len(MetricData)
+
+
+def synthetic_cluster(instances=100, services=600, task_definitions=200):
+    """ builds the describe responses for a cluster of the given size """
+    container_instances = [{
+        'containerInstanceArn': 'arn:aws:ecs:us-west-2:123456789012:container-instance/{}'.format(i),
+        'attributes': [
+            {'name': 'asg_version', 'value': 'v{}'.format(1 + i % 2)},
+            {'name': 'ecs.instance-type', 'value': ('m5.large', 'c5.xlarge', 'r5.large')[i % 3]},
+            {'name': 'ecs.availability-zone', 'value': 'us-west-2{}'.format('abc'[i % 3])},
+        ],
+        'registeredResources': [
+            {'name': 'CPU', 'integerValue': 2048},
+            {'name': 'MEMORY', 'integerValue': 7680},
+            {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': ['22', '2375', '2376', '51678']},
+        ],
+        'remainingResources': [
+            {'name': 'CPU', 'integerValue': 2048 - (i * 64) % 2048},
+            {'name': 'MEMORY', 'integerValue': 7680 - (i * 256) % 7680},
+            {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': ['22', '2375', '2376', '51678'] + (
+                ['80'] if i % 4 == 0 else []
+            )},
+        ],
+    } for i in range(instances)]
+    definitions = {
+        'arn:aws:ecs:us-west-2:123456789012:task-definition/task-{}:1'.format(i): {
+            'containerDefinitions': [{
+                'name': 'app',
+                'cpu': 64 * (1 + i % 8),
+                'memoryReservation': 128 * (1 + i % 16),
+                'portMappings': [{'containerPort': 80, 'hostPort': 80 if i % 10 == 0 else 0}],
+            }],
+            'networkMode': 'awsvpc' if i % 10 == 5 else 'bridge',
+            'placementConstraints': [{
+                'type': 'memberOf', 'expression': 'attribute:asg_version == v2'
+            }] if i % 5 == 1 else [],
+        } for i in range(task_definitions)
+    }
+    task_definition_arns = list(definitions)
+    service_list = [{
+        'serviceArn': 'arn:aws:ecs:us-west-2:123456789012:service/svc-{}'.format(i),
+        'taskDefinition': task_definition_arns[i % len(task_definition_arns)],
+        'desiredCount': 1 + i % 3,
+        'runningCount': 1 + i % 3,
+        'pendingCount': 0,
+    } for i in range(services)]
+    return container_instances, service_list, definitions
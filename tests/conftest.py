@@ -0,0 +1,9 @@
+import pytest
+from ecs_cluster_deployer.lambdas.common import clients
+
+@pytest.fixture(autouse=True)
+def fresh_clients():
+    # cached clients would outlive the mocks of the test that created them
+    clients.clear()
+    yield
+    clients.clear()
@@ -0,0 +1,113 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import AccountCollector, lambda_handler
+
+def cluster(name, tags):
+    return {
+        'clusterName': name,
+        'tags': [{'key': key, 'value': value} for key, value in tags.items()]
+    }
+
+@pytest.fixture
+def collector():
+    collector = AccountCollector(tag='ecs-maestro:metrics=a')
+    collector.ecs = MagicMock()
+    collector.cw = MagicMock()
+    paginator = MagicMock()
+    paginator.paginate.return_value = [{'clusterArns': ['arn/a', 'arn/b']}, {'clusterArns': ['arn/c']}]
+    collector.ecs.get_paginator.return_value = paginator
+    collector.ecs.describe_clusters.return_value = {'clusters': [
+        cluster('a', {'ecs-maestro:metrics': 'a'}),
+        cluster('b', {'ecs-maestro:metrics': 'b'}),
+        cluster('c', {'ecs-maestro:metrics': 'a', 'team': 'kloudcover'}),
+    ]}
+    return collector
+
+def test_tag_filter(collector):
+    # b is owned by another account collector
+    assert collector.cluster_names == ['a', 'c']
+    collector.ecs.describe_clusters.assert_called_once_with(
+        clusters=['arn/a', 'arn/b', 'arn/c'], include=['TAGS']
+    )
+    collector.tag = 'team'
+    assert collector.cluster_names == ['c']
+
+def test_named_clusters():
+    collector = AccountCollector(clusters=['a', 'b'])
+    collector.ecs = MagicMock()
+    assert collector.cluster_names == ['a', 'b']
+    collector.ecs.list_clusters.assert_not_called()
+
+def test_collect_shares_clients(collector):
+    with patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.ClusterStats') as fake_stats:
+        fake_stats.return_value.send_cluster_metrics.side_effect = [None, Exception('boom')]
+        results = collector.collect()
+    assert sorted(results.values()) == [False, True]
+    for call in fake_stats.call_args_list:
+        assert call[1] == {'ecs': collector.ecs, 'cw': collector.cw, 'ec2': collector.ec2}
+
+@patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.AccountCollector')
+def test_handler_modes(fake_collector, monkeypatch):
+    monkeypatch.delenv('EVENT_DRIVEN', raising=False)
+    monkeypatch.setenv('CLUSTER', 'boston')
+    lambda_handler({}, {})
+    fake_collector.assert_called_with(clusters=['boston'], tag=None)
+
+    monkeypatch.delenv('CLUSTER')
+    monkeypatch.setenv('CLUSTERS', 'boston, kloudcover')
+    monkeypatch.setenv('CLUSTER_TAG', 'ecs-maestro:metrics=boston')
+    lambda_handler({}, {})
+    fake_collector.assert_called_with(clusters=['boston', 'kloudcover'], tag='ecs-maestro:metrics=boston')
+    fake_collector.return_value.collect.assert_called_with()
+
+def test_sample_loop(collector, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    collector.publisher = MagicMock(storage_resolution=None)
+    resolutions = []
+    with patch.object(collector, 'collect') as fake_collect:
+        fake_collect.side_effect = lambda names: resolutions.append(collector.publisher.storage_resolution)
+        assert collector.sample(10, 60) == 6
+    fake_collect.assert_called_with(['a', 'c'])
+    # the cluster list is only looked up once
+    collector.ecs.describe_clusters.assert_called_once()
+    assert resolutions == [1] * 6
+    # what's published after the samples is standard resolution again
+    assert collector.publisher.storage_resolution is None
+
+def test_sample_duration(monkeypatch):
+    from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import sample_duration
+    monkeypatch.delenv('SAMPLE_DURATION', raising=False)
+    assert sample_duration({}) == 60
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 40000
+    assert sample_duration(context) == 30
+
+def test_sample_reuses_cluster_state(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('time.time', lambda: clock[0])
+    monkeypatch.setattr('time.sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    monkeypatch.delenv('EVENT_DRIVEN', raising=False)
+    collector = AccountCollector(clusters=['a'])
+    collector.ecs = MagicMock()
+    collector.publisher = MagicMock()
+    pages = {
+        'list_container_instances': [{'containerInstanceArns': ['ci-1']}],
+        'list_services': [{'serviceArns': []}],
+    }
+    collector.ecs.get_paginator.side_effect = lambda name: MagicMock(**{'paginate.return_value': pages[name]})
+    collector.ecs.describe_container_instances.return_value = {'containerInstances': [{
+        'containerInstanceArn': 'ci-1',
+        'status': 'ACTIVE',
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 4096}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 1024}, {'name': 'MEMORY', 'integerValue': 2048}]
+    }]}
+    assert collector.sample(20, 60) == 3
+    assert collector.publisher.publish.call_count == 3
+    # listed once, described every sample
+    assert [call[0][0] for call in collector.ecs.get_paginator.call_args_list] == [
+        'list_container_instances', 'list_services'
+    ]
+    assert collector.ecs.describe_container_instances.call_count == 3
+    assert collector.stats('a').cluster_name == 'a'
@@ -0,0 +1,98 @@
+import json
+import datetime
+import pytest
+from ecs_cluster_deployer.lambdas.metrics.recorder import SnapshotRecorder
+from ecs_cluster_deployer.lambdas.metrics.snapshot import (
+    ClusterSnapshot,
+    InstanceRecord,
+    ServiceRecord
+)
+from ecs_cluster_deployer import backtest
+from ecs_cluster_deployer.backtest import Policy, simulate
+from ecs_cluster_deployer.lambdas.scaling.scale_spot import decide, target_capacity
+
+def test_decide():
+    assert decide(10, 7, 2, 1, 2) == -1
+    assert decide(1, 7, 2, 1, 2) == 2
+    assert decide(5, 7, 2, 1, 2) == 0
+    assert decide(7, 7, 2, 1, 2) == 0
+
+def test_target_capacity():
+    assert target_capacity(5, 2, 1, 10) == 7
+    assert target_capacity(9, 2, 1, 10) == 10
+    assert target_capacity(1, -1, 1, 10) == 1
+
+def test_steady_demand():
+    result = simulate([18] * 60, Policy(), tasks_per_unit=4)
+    assert result.capacity[0] == 5
+    assert result.unschedulable_minutes == 0
+    assert result.instance_hours == pytest.approx(5)
+
+def test_boot_delay():
+    policy = Policy(threshold_out=0, scale_out=2, cooldown=600)
+    result = simulate([4] * 2 + [12] * 10, policy, tasks_per_unit=4, boot_minutes=3)
+    # the spike at minute 2 is only covered once the new capacity boots
+    assert result.capacity[:6] == [1, 1, 1, 1, 1, 3]
+    assert result.unschedulable_minutes == 3
+    assert result.scale_events == 1
+
+def test_cooldown():
+    policy = Policy(threshold_out=0, scale_out=1, cooldown=300)
+    result = simulate([4] + [40] * 20, policy, tasks_per_unit=4, boot_minutes=1)
+    assert result.scale_events == 4
+
+def test_scale_in_cancels_booting():
+    policy = Policy(threshold_in=3, threshold_out=0, scale_in=2, scale_out=2, cooldown=60)
+    result = simulate([8, 9, 0, 0, 0, 0], policy, tasks_per_unit=4, boot_minutes=5)
+    # capacity that was still booting goes first, what's running stays
+    assert max(result.capacity) == 2
+    assert result.capacity[-1] == 1
+
+def test_policy_grid():
+    grid = backtest.policy_grid(threshold_in=[5, 7], cooldown=[60, 300, 600])
+    assert len(grid) == 6
+    assert Policy(threshold_in=5, cooldown=600) in grid
+
+def test_sweep():
+    results = backtest.sweep([4, 12, 12, 12], [Policy(), Policy(scale_out=4)], 4, processes=1)
+    assert [result['policy']['scale_out'] for result in results] == [2, 4]
+    assert 'capacity' not in results[0]
+
+def test_load_snapshots(tmp_path):
+    recorder = SnapshotRecorder(str(tmp_path))
+    start = datetime.datetime(2020, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    instances = [InstanceRecord('arn-1', 2048, 4096, 1024, 2048)]
+    for minute, desired in ((0, 3), (1, 5), (3, 6)):
+        snapshot = ClusterSnapshot.build(
+            'kloudcover', instances, [ServiceRecord('web', 'web:1', desired, desired, 256, 512)]
+        )
+        metrics = [
+            {'MetricName': 'Schedulable Cluster Tasks', 'Value': 8 - desired, 'Dimensions': []},
+            {
+                'MetricName': 'Schedulable Cluster Tasks', 'Value': 1,
+                'Dimensions': [{'Name': 'TaskShape', 'Value': '1024/2048'}]
+            },
+        ]
+        recorder.record(snapshot, metrics, start + datetime.timedelta(minutes=minute))
+    history = backtest.load_snapshots(str(tmp_path))
+    # the missing minute carries the last snapshot over
+    assert history.demand == [3, 5, 5, 6]
+    assert history.tasks_per_unit == 8
+    assert history.timestamps[0] == datetime.datetime(2020, 1, 1, 12, 0)
+
+def test_main(tmp_path, capsys):
+    path = tmp_path / 'history.csv'
+    path.write_text(
+        "timestamp,demand\n"
+        "2020-01-01T12:00:00,4\n"
+        "2020-01-01T12:01:00,12\n"
+        "2020-01-01T12:02:30,12\n"
+    )
+    assert backtest.main([
+        '--csv', str(path), '--tasks-per-unit', '4', '--scale-out', '1,2', '--processes', '1',
+        '--curve'
+    ]) == 0
+    output = json.loads(capsys.readouterr().out)
+    assert output['minutes'] == 3
+    assert len(output['results']) == 2
+    assert output['capacity'][0] == ['2020-01-01T12:00:00', 4, 1]
@@ -0,0 +1,78 @@
+import random
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics.capacity import CapacityEngine
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats, ContainerInstanceStats
+
+def legacy_spaces(cpu, memory, shape):
+    total = 0
+    for available_cpu, available_memory in zip(cpu, memory):
+        try:
+            cpu_spaces = available_cpu / shape[0]
+        except ZeroDivisionError:
+            cpu_spaces = available_cpu
+        try:
+            mem_spaces = available_memory / shape[1]
+        except ZeroDivisionError:
+            mem_spaces = available_memory
+        total += min(cpu_spaces, mem_spaces)
+    return total
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_spaces(use_numpy):
+    engine = CapacityEngine([1024, 512, 0], [2048, 256, 1024], use_numpy=use_numpy)
+    assert engine.spaces([(256, 512), (0, 1024), (512, 0)]) == [4, 2, 3]
+    assert engine.spaces([]) == []
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_matches_legacy_loop(use_numpy):
+    rand = random.Random(7)
+    cpu = [rand.randrange(0, 4096) for _ in range(300)]
+    memory = [rand.randrange(0, 16384) for _ in range(300)]
+    shapes = [(rand.choice([0, 128, 256, 1000]), rand.choice([0, 64, 512, 3000])) for _ in range(600)]
+    engine = CapacityEngine(cpu, memory, use_numpy=use_numpy)
+    for shape, spaces in zip(shapes, engine.spaces(shapes, whole=False)):
+        assert spaces == pytest.approx(legacy_spaces(cpu, memory, shape))
+
+def test_python_matches_instance_loop():
+    rand = random.Random(11)
+    cpu = [rand.randrange(0, 4096) for _ in range(500)] + [0, 512, 0]
+    memory = [rand.randrange(0, 16384) for _ in range(500)] + [0, 0, 1024]
+    shapes = [(rand.randrange(1, 2048), rand.randrange(1, 8192)) for _ in range(200)]
+    engine = CapacityEngine(cpu, memory, use_numpy=False)
+    for whole in (True, False):
+        expected = [engine._total(engine.instance_spaces(shape, whole), whole) for shape in shapes]
+        assert engine.spaces(shapes, whole=whole) == pytest.approx(expected)
+
+def test_python_overcommitted():
+    engine = CapacityEngine([-256, 1024], [2048, 2048], use_numpy=False)
+    assert engine.spaces([(256, 512)]) == [3]
+
+def test_headroom():
+    engine = CapacityEngine([1024, 1024], [1024, 4096])
+    headroom = engine.headroom([(256, 256), (512, 2048)])
+    assert headroom['per_shape'] == {(256, 256): 8, (512, 2048): 2}
+    assert headroom['worst_shape'] == (512, 2048)
+    assert headroom['worst_case'] == 2
+    assert CapacityEngine([], []).headroom([])['worst_case'] is None
+
+def service(cpu, memory, desired=1):
+    svc = MagicMock()
+    svc.cpu_per_pod = cpu
+    svc.memory_per_pod = memory
+    svc.desired = desired
+    return svc
+
+def test_cluster_headroom():
+    stats = ClusterStats('default')
+    stats._services = [service(256, 512), service(256, 512), service(512, 1024), service(128, 128, 0)]
+    for svc in stats._services:
+        svc.containers = [MagicMock(cpu=svc.cpu_per_pod, memory=svc.memory_per_pod)]
+    stats._container_instances = [ContainerInstanceStats({
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 4096}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 1024}, {'name': 'MEMORY', 'integerValue': 1536}]
+    })]
+    assert stats.task_shapes == [(256, 512), (512, 1024)]
+    assert stats.largest_pod.cpu_per_pod == 512
+    assert stats.shape_headroom['worst_case'] == 1
+    assert stats.cluster_pod_dimensions == (1.5, 3 / 4.5)
@@ -0,0 +1,113 @@
+import pytest
+import botocore
+from botocore.stub import Stubber
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.common import clients
+from ecs_cluster_deployer.lambdas.common.clients import ApiStats
+
+@pytest.fixture
+def stats():
+    return ApiStats()
+
+@pytest.fixture
+def ecs(stats):
+    aws_client = botocore.session.get_session().create_client(
+        'ecs', region_name='us-west-2',
+        aws_access_key_id='testing', aws_secret_access_key='testing'
+    )
+    return clients.instrument(aws_client, stats)
+
+def test_counts_calls(ecs, stats):
+    with Stubber(ecs) as stubber:
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        stubber.add_response('describe_clusters', {'clusters': []})
+        ecs.list_clusters()
+        ecs.list_clusters()
+        ecs.describe_clusters(clusters=['kloudcover'])
+    summary = stats.summary()
+    assert summary['ecs.ListClusters']['calls'] == 2
+    assert summary['ecs.DescribeClusters']['calls'] == 1
+    assert sum(summary['ecs.ListClusters']['histogram'].values()) == 2
+    assert summary['ecs.ListClusters']['p99'] is not None
+
+def test_counts_errors(ecs, stats):
+    with Stubber(ecs) as stubber:
+        stubber.add_client_error('list_clusters', 'ServerException', http_status_code=500)
+        with pytest.raises(botocore.exceptions.ClientError):
+            ecs.list_clusters()
+    assert stats.summary()['ecs.ListClusters']['errors'] == 1
+
+def test_counts_throttles(ecs, stats):
+    operation = ecs.meta.service_model.operation_model('ListClusters')
+    throttled = (MagicMock(), {'Error': {'Code': 'ThrottlingException'}})
+    stats.needs_retry(operation=operation, response=throttled)
+    stats.needs_retry(operation=operation, response=(MagicMock(), {}))
+    stats.needs_retry(operation=operation, response=None)
+    assert stats.summary()['ecs.ListClusters']['throttles'] == 1
+
+def test_call_without_response(ecs, stats):
+    model = ecs.meta.service_model.operation_model('ListClusters')
+    context = {}
+    stats.before_call(model=model, context=context)
+    stats.after_call_error(exception=Exception('timeout'), context=context)
+    assert stats.summary()['ecs.ListClusters']['errors'] == 1
+    # calls that never went through before-call aren't recorded
+    stats.after_call_error(exception=Exception('timeout'), context={})
+    assert stats.summary()['ecs.ListClusters']['calls'] == 1
+
+def test_percentile():
+    operation = clients.OperationStats()
+    for seconds in [0.005] * 98 + [0.3, 20]:
+        operation.observe(seconds)
+    assert operation.percentile(50) == 0.01
+    assert operation.percentile(99) == 0.5
+    assert operation.percentile(100) == float('inf')
+
+def test_metric_data(ecs, stats):
+    with Stubber(ecs) as stubber:
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        ecs.list_clusters()
+    metrics = stats.metric_data({'FunctionName': 'metrics'})
+    assert [m['MetricName'] for m in metrics] == [
+        'API Calls', 'API Latency', 'API Retries', 'API Throttles', 'API Errors'
+    ]
+    assert metrics[0]['Dimensions'] == [
+        {'Name': 'FunctionName', 'Value': 'metrics'},
+        {'Name': 'Service', 'Value': 'ecs'},
+        {'Name': 'Operation', 'Value': 'ListClusters'},
+    ]
+    assert metrics[0]['Value'] == 1
+
+def test_report(monkeypatch, ecs):
+    monkeypatch.setattr(clients, 'API_STATS', ApiStats())
+    clients.instrument(ecs, clients.API_STATS)
+    publish = MagicMock()
+    with Stubber(ecs) as stubber:
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        ecs.list_clusters()
+    clients.report('API calls', publish)
+    publish.assert_not_called()
+    assert clients.API_STATS.summary() == {}
+
+    monkeypatch.setenv('API_METRICS', 'true')
+    with Stubber(ecs) as stubber:
+        stubber.add_response('list_clusters', {'clusterArns': []})
+        ecs.list_clusters()
+    clients.report('API calls', publish, {'Stage': 'Deploy'})
+    assert len(publish.call_args[0][0]) == 5
+    assert clients.API_STATS.summary() == {}
+
+def test_clients_are_cached(monkeypatch):
+    monkeypatch.setenv('MAX_POOL_CONNECTIONS', '10')
+    ecs = clients.client('ecs', region_name='us-west-2')
+    assert clients.client('ecs', region_name='us-west-2') is ecs
+    assert clients.client('ecs', region_name='us-east-1') is not ecs
+    assert ecs.meta.config.max_pool_connections == 10
+    assert ecs.meta.config.retries['mode'] == 'adaptive'
+    # a smaller pool reuses the client, a bigger one replaces it
+    assert clients.client('ecs', region_name='us-west-2', max_pool_connections=5) is ecs
+    bigger = clients.client('ecs', region_name='us-west-2', max_pool_connections=40)
+    assert bigger is not ecs
+    assert bigger.meta.config.max_pool_connections == 40
+    assert clients.client('ecs', region_name='us-west-2') is bigger
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import pytest
+from unittest.mock import ANY, MagicMock, patch
+from ecs_cluster_deployer.lambdas.metrics.cluster_state import ClusterState
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats, lambda_handler
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+
+ARN = 'arn:aws:ecs:us-west-2:601394826940:{}'
+
+def recorded_events():
+    with open(os.path.join(os.path.dirname(__file__), 'events', 'ecs_events.json')) as stream:
+        return json.load(stream)
+
+def container_instance(name, cpu=2048, memory=3904):
+    return {
+        'containerInstanceArn': ARN.format('container-instance/kloudcover/' + name),
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 3904}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': cpu}, {'name': 'MEMORY', 'integerValue': memory}],
+        'status': 'ACTIVE',
+        'version': 1
+    }
+
+def service(name, desired=1, status='ACTIVE'):
+    return {
+        'serviceArn': ARN.format('service/kloudcover/' + name),
+        'serviceName': name,
+        'taskDefinition': ARN.format('task-definition/{}:1'.format(name)),
+        'desiredCount': desired,
+        'status': status
+    }
+
+@pytest.fixture
+def state():
+    TASK_DEFINITIONS.clear()
+    stats = ClusterStats('kloudcover')
+    stats.ecs = MagicMock()
+    stats.ecs.describe_task_definition.return_value = {'taskDefinition': {
+        'containerDefinitions': [{'name': 'app', 'cpu': 128, 'memory': 256}]
+    }}
+    stats.list_container_instance_arns = MagicMock(return_value=[])
+    stats.list_service_arns = MagicMock(return_value=[])
+    stats.describe_container_instances = MagicMock(return_value=[
+        container_instance('ci-1'), container_instance('ci-3')
+    ])
+    stats.describe_services = MagicMock(return_value=[service('drone'), service('wordpress')])
+    return ClusterState(stats, reconcile_interval=600)
+
+def test_first_sync_reconciles(state):
+    stats = state.sync()
+    assert state.last_reconcile is not None
+    assert len(stats.container_instances) == 2
+    assert stats.desired_pods == 2
+
+def test_replay_recorded_events(state):
+    state.sync()
+    state.stats.describe_container_instances.reset_mock()
+    state.stats.describe_services.reset_mock()
+
+    state.replay(recorded_events())
+    ci_1 = state.container_instances[ARN.format('container-instance/kloudcover/ci-1')]
+    # the out of order version 12 event doesn't clobber version 14
+    assert ci_1['version'] == 14
+    # draining instances drop out of the capacity
+    assert ARN.format('container-instance/kloudcover/ci-3') not in state.container_instances
+
+    state.stats.describe_container_instances.return_value = [container_instance('ci-2', cpu=512)]
+    state.stats.describe_services.return_value = [service('drone', desired=3), service('wordpress', desired=2)]
+    stats = state.sync()
+
+    # only the changed instance and services are described
+    state.stats.describe_container_instances.assert_called_once_with(
+        [ARN.format('container-instance/kloudcover/ci-2')]
+    )
+    state.stats.describe_services.assert_called_once_with(
+        [ARN.format('service/kloudcover/drone'), 'wordpress']
+    )
+    state.stats.list_container_instance_arns.assert_called_once_with()
+    assert stats.available_cpu == 1024 + 512
+    assert stats.desired_pods == 5
+
+def test_quiet_tick_makes_no_calls(state):
+    state.sync()
+    state.stats.describe_services.reset_mock()
+    state.stats.describe_container_instances.reset_mock()
+    state.sync()
+    state.stats.describe_services.assert_not_called()
+    state.stats.describe_container_instances.assert_not_called()
+
+def test_deleted_services_are_removed(state):
+    state.sync()
+    state.apply({
+        'detail-type': 'ECS Service Action',
+        'resources': [ARN.format('service/kloudcover/drone'), ARN.format('service/kloudcover/wordpress')]
+    })
+    state.stats.describe_services.return_value = [service('drone', status='INACTIVE')]
+    state.sync()
+    assert state.services == {}
+
+def test_periodic_reconcile(state):
+    state.sync()
+    state.last_reconcile = time.time() - 601
+    state.sync()
+    assert state.stats.list_service_arns.call_count == 2
+
+@patch('botocore.client.BaseClient._make_api_call')
+@patch('ecs_cluster_deployer.lambdas.metrics.cluster_metrics.cluster_state')
+def test_event_driven_handler(fake_state, fake_api, monkeypatch):
+    monkeypatch.setenv('EVENT_DRIVEN', 'true')
+    monkeypatch.setenv('CLUSTER', 'kloudcover')
+    event = recorded_events()[0]
+    known = MagicMock()
+    monkeypatch.setattr(
+        'ecs_cluster_deployer.lambdas.metrics.cluster_metrics.CLUSTER_STATES',
+        {'kloudcover': known}
+    )
+    lambda_handler(event, {})
+    known.apply.assert_called_once_with(event)
+    fake_state.assert_not_called()
+
+    lambda_handler({'source': 'aws.events', 'detail-type': 'Scheduled Event'}, {})
+    fake_state.return_value.sync.return_value.send_cluster_metrics.assert_called_once_with(ANY)
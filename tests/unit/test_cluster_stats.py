@@ -7,6 +7,11 @@ from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import (
     ContainerStats,
     ContainerInstanceStats
 )
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+
+@pytest.fixture(autouse=True)
+def clear_task_definitions():
+    TASK_DEFINITIONS.clear()
 
 @pytest.fixture
 def stat_obj():
@@ -80,3 +85,140 @@ def test_container_instance_init():
     assert container_instance.total_memory == 123
     assert container_instance.available_cpu == 2
     assert container_instance.available_memory == 2
+    assert container_instance.available_resources == {}
+
+def test_resource_requirements():
+    container = ContainerStats({'name': 'infer', 'cpu': 0, 'resourceRequirements': [
+        {'type': 'GPU', 'value': '2'},
+        {'type': 'InferenceAccelerator', 'value': 'device_1'},
+    ]})
+    assert container.resource_requirements == {'GPU': 2, 'InferenceAccelerator': 1}
+    container_instance = ContainerInstanceStats({
+        'registeredResources': [
+            {'name': 'CPU', 'integerValue': 2048},
+            {'name': 'MEMORY', 'integerValue': 4096},
+            {'name': 'GPU', 'type': 'STRINGSET', 'stringSetValue': ['gpu-0', 'gpu-1']},
+        ],
+        'remainingResources': [
+            {'name': 'CPU', 'integerValue': 2048},
+            {'name': 'MEMORY', 'integerValue': 4096},
+            {'name': 'GPU', 'type': 'STRINGSET', 'stringSetValue': ['gpu-1']},
+            {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': ['22']},
+        ]
+    })
+    assert container_instance.total_resources == {'GPU': 2}
+    assert container_instance.available_resources == {'GPU': 1}
+
+def fake_paginator(key, arns):
+    paginator = MagicMock()
+    paginator.paginate.return_value = [{key: arns}]
+    return paginator
+
+def test_concurrent_collection(stat_obj):
+    service_arns = ['svc-{}'.format(i) for i in range(25)]
+    stat_obj.ecs = MagicMock()
+    stat_obj.ecs.get_paginator.side_effect = lambda name: {
+        'list_services': fake_paginator('serviceArns', service_arns),
+        'list_container_instances': fake_paginator('containerInstanceArns', ['ci-1', 'ci-2']),
+    }[name]
+    stat_obj.ecs.describe_services.side_effect = lambda cluster, services: {
+        'services': [{
+            'serviceArn': arn,
+            'taskDefinition': 'task-{}'.format(int(arn.split('-')[1]) % 3),
+            'desiredCount': 1,
+        } for arn in services]
+    }
+    stat_obj.ecs.describe_task_definition.return_value = {
+        'taskDefinition': {
+            'containerDefinitions': [{'name': 'boston', 'cpu': 10, 'memory': 128}]
+        }
+    }
+    stat_obj.ecs.describe_container_instances.return_value = {'containerInstances': [{
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 4096}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 1024}, {'name': 'MEMORY', 'integerValue': 2048}]
+    }]}
+
+    assert [svc._svc['serviceArn'] for svc in stat_obj.services] == service_arns
+    assert stat_obj.ecs.describe_services.call_count == 3
+    # one describe per distinct task definition, not per service
+    assert stat_obj.ecs.describe_task_definition.call_count == 3
+    assert stat_obj.service_requirements == {'cpu': 250, 'memory': 3200}
+    assert len(stat_obj.container_instances) == 1
+
+def test_fan_out_sequential(stat_obj):
+    stat_obj.max_in_flight = 1
+    assert stat_obj._fan_out(lambda x: x * 2, [1, 2, 3]) == [2, 4, 6]
+    stat_obj.max_in_flight = 4
+    assert stat_obj._fan_out(lambda x: x * 2, range(10)) == list(range(0, 20, 2))
+
+def container_instance(arn, instance_type, cpu, memory):
+    return {
+        'containerInstanceArn': arn,
+        'attributes': [{'name': 'ecs.instance-type', 'value': instance_type}],
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 4096}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': cpu}, {'name': 'MEMORY', 'integerValue': memory}]
+    }
+
+def test_detailed_metrics(stat_obj, monkeypatch):
+    monkeypatch.delenv('DETAILED_METRICS', raising=False)
+    TASK_DEFINITIONS.put('task:1', {'containerDefinitions': [{'name': 'web', 'cpu': 256, 'memory': 512}]})
+    stat_obj.load([
+        container_instance('ci-1', 'm5.large', 1024, 2048),
+        container_instance('ci-2', 'm5.large', 512, 1024),
+        container_instance('ci-3', 'c5.large', 0, 0),
+    ], [{'serviceName': 'web', 'taskDefinition': 'task:1', 'desiredCount': 2, 'runningCount': 1}])
+    stat_obj.publisher = MagicMock()
+    metrics = stat_obj.send_cluster_metrics()
+    assert metrics == stat_obj.publisher.publish.call_args[0][0]
+    stat_obj.publisher.flush.assert_called_once_with()
+
+    def value(name, **dimensions):
+        expected = [{'Name': 'ClusterName', 'Value': 'default'}] + [
+            {'Name': key, 'Value': dimension} for key, dimension in dimensions.items()
+        ]
+        return [m['Value'] for m in metrics if m['MetricName'] == name and m['Dimensions'] == expected]
+
+    assert value('Schedulable Cluster Tasks') == [6.0]
+    assert value('Desired Cluster Tasks') == [2]
+    assert value('Largest Task Memory') == [512]
+    assert value('Desired Tasks', ServiceName='web') == [2]
+    assert value('Memory Reserved', ServiceName='web') == [1024]
+    assert value('Schedulable Tasks', ServiceName='web') == [6]
+    assert value('Container Instances', InstanceType='m5.large') == [2]
+    assert value('Available CPU', InstanceType='m5.large') == [1536]
+    assert value('Available Memory', InstanceType='c5.large') == [0]
+    assert len({m['Timestamp'] for m in metrics}) == 1
+
+    shared = MagicMock()
+    monkeypatch.setenv('DETAILED_METRICS', 'false')
+    stat_obj.send_cluster_metrics(shared)
+    assert [m['MetricName'] for m in shared.publish.call_args[0][0]] == [
+        'Schedulable Cluster Tasks',
+        'Scheduled Percentage',
+        'Worst Case Schedulable Tasks',
+        'Desired Cluster Tasks',
+        'Largest Task CPU',
+        'Largest Task Memory',
+        'Bottleneck Schedulable Tasks',
+        'Bottleneck Schedulable Tasks',
+    ]
+    shared.flush.assert_not_called()
+
+def test_records_snapshot(stat_obj):
+    TASK_DEFINITIONS.put('task:1', {'containerDefinitions': [{'name': 'web', 'cpu': 256, 'memory': 512}]})
+    stat_obj.load(
+        [container_instance('ci-1', 'm5.large', 1024, 2048)],
+        [{'serviceName': 'web', 'taskDefinition': 'task:1', 'desiredCount': 1}]
+    )
+    stat_obj.publisher = MagicMock()
+    stat_obj.recorder = MagicMock()
+    stat_obj.send_cluster_metrics()
+    snapshot, metrics, timestamp = stat_obj.recorder.record.call_args[0]
+    assert snapshot is stat_obj.snapshot
+    assert metrics == stat_obj.publisher.publish.call_args[0][0]
+    assert metrics[0]['Timestamp'] == timestamp
+
+    # a failed recording doesn't stop the metrics
+    stat_obj.recorder.record.side_effect = OSError('disk full')
+    stat_obj.send_cluster_metrics()
+    assert stat_obj.publisher.flush.call_count == 2
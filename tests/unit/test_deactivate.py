@@ -4,6 +4,7 @@ import datetime
 import boto3
 import botocore
 from ecs_cluster_deployer.lambdas.scaling.scale_spot import SpotScaler, lambda_handler
+from ecs_cluster_deployer.lambdas.scaling.state import MemoryStateStore
 from pprint import pprint
 
 @pytest.fixture
@@ -25,6 +26,8 @@ def test_deactivate(base_obj):
     })
     assert base_obj.cluster_version_empty()
 
+    # the list is kept for the invocation, so start a new one
+    base_obj._version_instances = None
     base_obj.ecs.list_container_instances = MagicMock(return_value={
         'containerInstanceArns': ['boston']
     })
@@ -36,3 +39,23 @@ def test_remove_stack(base_obj):
     base_obj.ecs.list_container_instances = MagicMock(return_value={
         'containerInstanceArns': []
     })
+
+def test_deactivate_empty_version_skips_cooldown(base_obj):
+    base_obj.state = MemoryStateStore()
+    base_obj._target_capacity = 0
+    base_obj._version_instances = []
+    base_obj.delete_stack = MagicMock()
+    base_obj.deactivate_stack()
+    base_obj.delete_stack.assert_called_once_with()
+    assert base_obj.state.values == {}
+
+def test_deactivate_drains_under_cooldown(base_obj):
+    base_obj.state = MemoryStateStore()
+    base_obj.scale_cooldown = '60'
+    base_obj._target_capacity = 4
+    base_obj.ec2.modify_spot_fleet_request = MagicMock()
+    base_obj.deactivate_stack()
+    base_obj.ec2.modify_spot_fleet_request.assert_called_once()
+    # the drain took the cooldown, so the next pass waits it out
+    base_obj.deactivate_stack()
+    base_obj.ec2.modify_spot_fleet_request.assert_called_once()
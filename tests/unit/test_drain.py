@@ -0,0 +1,41 @@
+from ecs_cluster_deployer.lambdas.scaling.drain import Candidate, choose, place
+
+def test_place():
+    free = {'a': [1024, 2048], 'b': [512, 512]}
+    assert place(3, (512, 512), free)
+    assert free == {'a': [0, 1024], 'b': [0, 0]}
+    # what doesn't all fit leaves the free capacity alone
+    assert not place(1, (512, 512), free)
+    assert free == {'a': [0, 1024], 'b': [0, 0]}
+
+def test_choose_cheapest():
+    candidates = [
+        Candidate('busy', 'i-1', 1, 4, 1024, 2048),
+        Candidate('empty', 'i-2', 1, 0, 0, 0),
+        Candidate('light', 'i-3', 1, 1, 256, 512),
+    ]
+    free = {'busy': [1024, 2048], 'empty': [2048, 4096], 'light': [1792, 3584], 'other': [512, 1024]}
+    assert [c.arn for c in choose(candidates, free, 2)] == ['empty', 'light']
+    # the busy one's tasks only fit once the others stay
+    assert [c.arn for c in choose(candidates, free, 3)] == ['empty', 'light']
+
+def test_choose_weight():
+    candidates = [
+        Candidate('big', 'i-1', 2, 0, 0, 0),
+        Candidate('small', 'i-2', 1, 1, 256, 512),
+    ]
+    free = {'big': [4096, 8192], 'small': [1792, 3584], 'other': [1024, 2048]}
+    # the empty instance weighs more than there is to remove
+    assert [c.arn for c in choose(candidates, free, 1)] == ['small']
+    assert [c.arn for c in choose(candidates, free, 3)] == ['big', 'small']
+
+def test_choose_chained():
+    candidates = [
+        Candidate('a', 'i-1', 1, 1, 1024, 1024),
+        Candidate('b', 'i-2', 1, 1, 1024, 1024),
+    ]
+    free = {'a': [1024, 1024], 'b': [1024, 1024], 'c': [1024, 1024]}
+    # a's task would move onto b, so once b drains too only one of them fits on c
+    assert [c.arn for c in choose(candidates, free, 2)] == ['a']
+    free['d'] = [1024, 1024]
+    assert [c.arn for c in choose(candidates, free, 2)] == ['a', 'b']
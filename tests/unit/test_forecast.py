@@ -0,0 +1,80 @@
+import math
+import datetime
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.scaling import forecast
+from ecs_cluster_deployer.lambdas.scaling.forecast import HoltWinters
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+def demand(periods, start=START, period=forecast.PERIOD):
+    """ a daily cycle between 20 and 100 tasks, growing by a task an hour """
+    points = []
+    for i in range(periods):
+        timestamp = start + datetime.timedelta(seconds=i * period)
+        hours = (timestamp - START).total_seconds() / 3600
+        points.append((timestamp, 60 + 40 * math.sin(2 * math.pi * hours / 24) + hours))
+    return points
+
+def response(points, token=None):
+    res = {'MetricDataResults': [{
+        'Id': 'history',
+        'Timestamps': [timestamp for timestamp, _ in points],
+        'Values': [value for _, value in points]
+    }]}
+    if token:
+        res['NextToken'] = token
+    return res
+
+@pytest.fixture(autouse=True)
+def models(monkeypatch):
+    monkeypatch.setattr(forecast, 'MODELS', {})
+
+def test_forecasts_the_daily_cycle():
+    history = demand(3 * 288)
+    model = forecast.fit(history[:2 * 288])
+    for step in (1, 6, 12):
+        assert model.forecast(step) == pytest.approx(history[2 * 288 + step - 1][1], abs=3)
+
+def test_peak():
+    model = HoltWinters()
+    model.fit(demand(2 * 288))
+    # the cycle is rising at midnight, so the peak is the furthest period
+    assert model.peak(600) == model.forecast(2)
+    assert model.peak(1) == model.forecast(1)
+
+def test_gaps_follow_the_trend():
+    model = HoltWinters(beta=0.5)
+    model.update(START, 10)
+    model.update(START + datetime.timedelta(minutes=5), 12)
+    level = model.level
+    model.update(START + datetime.timedelta(minutes=20), level + 3 * model.trend)
+    assert model.level == pytest.approx(level + 3 * model.trend, rel=0.1)
+
+def test_cached_model():
+    cw = MagicMock()
+    now = START + datetime.timedelta(days=2, seconds=90)
+    history = demand(2 * 288)
+    cw.get_metric_data.side_effect = [response(history[:300], 'next'), response(history[300:])]
+    model = forecast.cached_model(cw, 'kloudcover', 'Desired Cluster Tasks', now=now)
+    assert cw.get_metric_data.call_count == 2
+    assert cw.get_metric_data.call_args[1]['NextToken'] == 'next'
+    assert model.updated == history[-1][0]
+
+    # a warm invocation only reads the periods since
+    later = demand(2, start=history[-1][0] + datetime.timedelta(minutes=5))
+    cw.get_metric_data.side_effect = [response(later)]
+    warm = forecast.cached_model(cw, 'kloudcover', 'Desired Cluster Tasks', now=now + datetime.timedelta(minutes=10))
+    assert warm is model
+    assert cw.get_metric_data.call_args[1]['StartTime'] == later[0][0]
+    assert model.updated == later[-1][0]
+
+    # nothing new within the same period doesn't call cloudwatch at all
+    cw.get_metric_data.reset_mock()
+    forecast.cached_model(cw, 'kloudcover', 'Desired Cluster Tasks', now=now + datetime.timedelta(minutes=10))
+    cw.get_metric_data.assert_not_called()
+
+def test_no_history():
+    cw = MagicMock()
+    cw.get_metric_data.return_value = response([])
+    assert forecast.cached_model(cw, 'kloudcover', 'Desired Cluster Tasks') is None
@@ -0,0 +1,135 @@
+import pytest
+from mock import MagicMock
+from ecs_cluster_deployer.lambdas.common import limits
+from ecs_cluster_deployer.lambdas.common.limits import (
+    FamilyLimiter,
+    RateLimiter,
+    TokenBucket,
+    family
+)
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+def test_family():
+    assert family('ecs', 'DescribeServices') == 'ecs.read'
+    assert family('ecs', 'ListServices') == 'ecs.read'
+    assert family('ecs', 'UpdateService') == 'ecs.write'
+    assert family('cloudformation', 'DescribeStacks') == 'cloudformation.read'
+
+def test_configured_limits(monkeypatch):
+    monkeypatch.setenv('API_RATE_LIMITS', 'ecs.read=5/10/3, ec2.read=2')
+    configured = limits.configured_limits()
+    assert configured['ecs.read'] == (5.0, 10, 3)
+    assert configured['ec2.read'] == (2.0, 2, 2)
+    assert configured['cloudformation.read'] == limits.LIMITS['cloudformation.read']
+
+def test_bucket_waits(clock):
+    bucket = TokenBucket(2, 2, clock=clock, sleep=clock.sleep)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.5)
+    assert clock.now == pytest.approx(0.5)
+    # a second later the bucket is full again, but never over the burst
+    clock.now += 10
+    assert [bucket.take() for _ in range(2)] == [0, 0]
+    assert bucket.take() > 0
+
+def test_aimd(clock):
+    limiter = FamilyLimiter(20, 20, 8, clock=clock, sleep=clock.sleep)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == 10
+    assert limiter.window == 4
+    # the rest of the same congestion doesn't halve it again
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == 10
+    assert limiter.throttles == 2
+    clock.now += limits.DECREASE_COOLDOWN
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.rate == 5
+    assert limiter.window == 2
+    # and it grows back, no further than the configured limits
+    for _ in range(1000):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.rate == 20
+    assert limiter.window == 8
+    assert limiter.in_flight == 0
+
+def test_min_rate(clock):
+    limiter = FamilyLimiter(1, 1, 1, clock=clock, sleep=clock.sleep)
+    for _ in range(5):
+        clock.now += limits.DECREASE_COOLDOWN
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.rate == limits.MIN_RATE
+    assert limiter.window == 1
+
+def test_hooks():
+    limiter = RateLimiter({'ecs.read': (10, 10, 2)})
+    limiter.before_send(event_name='before-send.ecs.DescribeServices', request=None)
+    assert limiter.limiter('ecs.read').in_flight == 1
+    limiter.response_received(
+        event_name='response-received.ecs.DescribeServices',
+        parsed_response={'Error': {'Code': 'ThrottlingException'}},
+        context={}
+    )
+    ecs = limiter.limiter('ecs.read')
+    assert ecs.in_flight == 0
+    assert ecs.throttles == 1
+    assert limiter.stats()['ecs.read']['rate'] == 5
+    # families without limits pass straight through
+    limiter.before_send(event_name='before-send.ecs.UpdateService', request=None)
+    limiter.response_received(event_name='response-received.ecs.UpdateService')
+    assert limiter.limiter('ecs.write') is None
+
+def test_slot_freed_after_error():
+    limiter = RateLimiter({'ecs.read': (10, 10, 1)})
+    limiter.before_send(event_name='before-send.ecs.DescribeServices', request=None)
+    # the response couldn't be parsed, so response-received never fires
+    limiter.after_call(event_name='after-call-error.ecs.DescribeServices', exception=ValueError('bad'))
+    ecs = limiter.limiter('ecs.read')
+    assert ecs.in_flight == 0
+    assert ecs.rate == 10
+    # a connection error gets to response-received without a response
+    limiter.before_send(event_name='before-send.ecs.DescribeServices', request=None)
+    limiter.response_received(
+        event_name='response-received.ecs.DescribeServices',
+        parsed_response=None,
+        exception=ConnectionError('reset')
+    )
+    assert ecs.in_flight == 0
+    limiter.after_call(event_name='after-call-error.ecs.DescribeServices', exception=ConnectionError('reset'))
+    assert ecs.in_flight == 0
+
+def test_client_slot_freed(monkeypatch):
+    import boto3
+    from botocore.awsrequest import AWSResponse
+    limiter = RateLimiter({'ecs.read': (10, 10, 1)})
+    ecs = limits.limit(boto3.client(
+        'ecs', region_name='us-west-2', aws_access_key_id='a', aws_secret_access_key='b'
+    ), limiter)
+    # answers every attempt after the limiter took its slot, with a response that won't parse
+    ecs.meta.events.register(
+        'before-send', lambda **kwargs: AWSResponse('https://ecs', 200, {}, MagicMock(content=b'{}'))
+    )
+    def fail_parse(*args, **kwargs):
+        raise ValueError('bad response')
+    monkeypatch.setattr('botocore.parsers.JSONParser.parse', fail_parse)
+    with pytest.raises(ValueError):
+        ecs.list_clusters()
+    assert limiter.limiter('ecs.read').in_flight == 0
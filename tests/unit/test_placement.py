@@ -0,0 +1,217 @@
+import random
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics.placement import (
+    PlacementSimulator,
+    compile_expression
+)
+from ecs_cluster_deployer.lambdas.metrics.snapshot import InstanceRecord, ServiceRecord
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+from ecs_cluster_deployer.lambdas.metrics.instance_types import ENI_LIMITS, load_eni_limits
+
+def describe_instance_types(limits):
+    ec2 = MagicMock()
+    ec2.get_paginator.return_value.paginate.return_value = [{'InstanceTypes': [
+        {'InstanceType': instance_type, 'NetworkInfo': {'MaximumNetworkInterfaces': limit}}
+        for instance_type, limit in limits.items()
+    ]}]
+    return ec2
+
+def instance(arn, cpu, memory, **attributes):
+    return InstanceRecord(arn, 2048, 4096, cpu, memory, None, tuple(sorted(attributes.items())))
+
+@pytest.mark.parametrize('expression, expected', [
+    ('attribute:asg_version == v2', [False, True, True]),
+    ('attribute:asg_version != v2', [True, False, False]),
+    ('attribute:ecs.instance-type =~ m5.*', [True, True, False]),
+    ('attribute:ecs.instance-type in [c5.large, m5.xlarge]', [False, True, True]),
+    ('attribute:gpu exists', [False, False, True]),
+    ('attribute:gpu !exists', [True, True, False]),
+    ('attribute:asg_version == v2 and not attribute:gpu exists', [False, True, False]),
+    ('(attribute:asg_version == v1 || attribute:gpu exists) && attribute:cores >= 4', [False, False, True]),
+    ("attribute:ecs.instance-type == 'm5.large'", [True, False, False]),
+])
+def test_expressions(expression, expected):
+    instances = [
+        {'asg_version': 'v1', 'ecs.instance-type': 'm5.large', 'cores': '2'},
+        {'asg_version': 'v2', 'ecs.instance-type': 'm5.xlarge', 'cores': '4'},
+        {'asg_version': 'v2', 'ecs.instance-type': 'c5.large', 'cores': '16', 'gpu': 'true'},
+    ]
+    compiled = compile_expression(expression)
+    assert [compiled(attributes) for attributes in instances] == expected
+
+@pytest.mark.parametrize('expression', ['task:group == web', 'attribute:a ==', 'attribute:a == (b'])
+def test_unsupported_expressions(expression):
+    with pytest.raises(ValueError):
+        compile_expression(expression)
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_placeable(use_numpy):
+    simulator = PlacementSimulator([
+        instance('ci-1', 1024, 2048, asg_version='v1'),
+        instance('ci-2', 1024, 2048, asg_version='v2'),
+        instance('ci-3', 512, 512, asg_version='v2'),
+    ], use_numpy=use_numpy)
+    anywhere = ServiceRecord('web', 'task:1', 2, 2, 256, 512)
+    pinned = anywhere._replace(name='health', placement_constraints=(
+        ('memberOf', 'attribute:asg_version == v2'),
+    ))
+    distinct = anywhere._replace(name='agent', running=1, placement_constraints=(
+        ('distinctInstance', None),
+    ))
+    unknown = anywhere._replace(name='grouped', placement_constraints=(
+        ('memberOf', 'task:group == web'),
+    ))
+    assert simulator.placeable(anywhere) == 9
+    assert simulator.placeable(pinned) == 5
+    assert simulator.placeable(distinct) == 2
+    # constraints that can't be evaluated don't restrict anything
+    assert simulator.placeable(unknown) == 9
+    placeable = simulator.placeable_tasks([anywhere, pinned, distinct])
+    assert placeable['per_service'] == {'web': 9, 'health': 5, 'agent': 2}
+    assert placeable['worst_service'] == 'agent'
+
+def test_matches_capacity_without_constraints():
+    rand = random.Random(9)
+    instances = [
+        instance('ci-{}'.format(i), rand.randrange(0, 4096), rand.randrange(0, 8192), asg_version='v1')
+        for i in range(500)
+    ]
+    simulator = PlacementSimulator(instances)
+    for shape in [(128, 256), (0, 512), (1000, 3000)]:
+        service = ServiceRecord('web', 'task:1', 1, 1, shape[0], shape[1])
+        assert simulator.placeable(service) == simulator.capacity.spaces([shape])[0]
+
+def test_cluster_metrics_use_constraints():
+    TASK_DEFINITIONS.clear()
+    TASK_DEFINITIONS.put('task:1', {
+        'containerDefinitions': [{'name': 'health', 'cpu': 256, 'memory': 512}],
+        'placementConstraints': [{'type': 'memberOf', 'expression': 'attribute:asg_version == v2'}]
+    })
+    stats = ClusterStats('default')
+    stats.load([{
+        'containerInstanceArn': 'ci-{}'.format(version),
+        'attributes': [{'name': 'asg_version', 'value': version}],
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 4096}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 1024}, {'name': 'MEMORY', 'integerValue': 2048}]
+    } for version in ('v1', 'v2')], [{
+        'serviceName': 'health',
+        'taskDefinition': 'task:1',
+        'desiredCount': 1,
+        'placementConstraints': [{'type': 'distinctInstance'}]
+    }])
+    assert stats.snapshot.services[0].placement_constraints == (
+        ('distinctInstance', None),
+        ('memberOf', 'attribute:asg_version == v2')
+    )
+    # one eligible instance, which the running task doesn't hold yet
+    assert stats.placeable_tasks['worst_case'] == 1
+    assert stats.cluster_pod_dimensions == (1.0, 0.5)
+    TASK_DEFINITIONS.clear()
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_ports_and_enis(use_numpy):
+    ENI_LIMITS.clear()
+    load_eni_limits(['m5.large', 'c5.xlarge'], describe_instance_types({'m5.large': 3, 'c5.xlarge': 4}))
+    instances = [
+        instance('ci-1', 2048, 4096)._replace(instance_type='m5.large', used_ports=frozenset(['22/tcp', '80/tcp'])),
+        instance('ci-2', 2048, 4096)._replace(instance_type='m5.large', used_ports=frozenset(['22/tcp', '53/udp'])),
+        instance('ci-3', 2048, 4096)._replace(instance_type='c5.xlarge', used_ports=frozenset(['22/tcp'])),
+    ]
+    simulator = PlacementSimulator(instances, use_numpy=use_numpy, eni_in_use=4)
+    web = ServiceRecord('web', 'task:1', 1, 1, 256, 512, (), 'bridge', ('80/tcp',))
+    dns = ServiceRecord('dns', 'task:2', 1, 1, 256, 512, (), 'bridge', ('53/udp',))
+    api = ServiceRecord('api', 'task:3', 4, 4, 256, 512, (), 'awsvpc', ())
+    assert simulator.placeable(web) == 2
+    assert simulator.placeable(dns) == 2
+    # 2 + 2 + 3 ENI slots, 4 of them held by running awsvpc tasks
+    assert simulator.placeable(api) == 3
+    assert simulator.bottlenecks(web) == {'CPU': 24, 'Memory': 24, 'Ports': 2, 'ENI': None}
+    assert simulator.bottleneck_tasks([web, api]) == {'CPU': 24, 'Memory': 24, 'Ports': 2, 'ENI': 3}
+
+    unknown = PlacementSimulator(instances[:1] + [instance('ci-4', 2048, 4096)], use_numpy=use_numpy)
+    assert unknown.eni_available([True, True]) is None
+    ENI_LIMITS.clear()
+
+def test_eni_limits_cached():
+    ENI_LIMITS.clear()
+    ec2 = describe_instance_types({'m5.large': 3})
+    load_eni_limits(['m5.large', None], ec2)
+    load_eni_limits(['m5.large'], ec2)
+    ec2.get_paginator.return_value.paginate.assert_called_once_with(InstanceTypes=['m5.large'])
+    assert ENI_LIMITS == {'m5.large': 3}
+    ENI_LIMITS.clear()
+
+def test_host_ports():
+    from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ContainerStats, ContainerInstanceStats
+    container = ContainerStats({'name': 'web', 'cpu': 0, 'portMappings': [
+        {'containerPort': 80, 'hostPort': 80},
+        {'containerPort': 8080, 'hostPort': 0},
+        {'containerPort': 53, 'protocol': 'udp'},
+    ]})
+    assert container.host_ports('bridge') == ['80/tcp']
+    assert container.host_ports('host') == ['80/tcp', '8080/tcp', '53/udp']
+    assert container.host_ports('awsvpc') == []
+    ci = ContainerInstanceStats({'remainingResources': [
+        {'name': 'CPU', 'integerValue': 1024},
+        {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': ['22', '80']},
+        {'name': 'PORTS_UDP', 'type': 'STRINGSET', 'stringSetValue': ['53']},
+    ]})
+    assert ci.used_ports == frozenset(['22/tcp', '80/tcp', '53/udp'])
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_gpus(use_numpy):
+    instances = [
+        instance('ci-1', 4096, 8192)._replace(resources=(('GPU', 4),)),
+        instance('ci-2', 4096, 8192)._replace(resources=(('GPU', 1),)),
+        instance('ci-3', 4096, 8192),
+    ]
+    simulator = PlacementSimulator(instances, use_numpy=use_numpy)
+    train = ServiceRecord('train', 'task:1', 1, 1, 256, 512, resources=(('GPU', 2),))
+    web = ServiceRecord('web', 'task:2', 1, 1, 256, 512)
+    # only the instance with 4 GPUs fits two tasks, the others have too few
+    assert train.shape == (256, 512, (('GPU', 2),))
+    assert simulator.placeable(train) == 2
+    assert simulator.placeable(web) == 48
+    assert simulator.bottlenecks(train)['GPU'] == 2
+    assert simulator.bottleneck_tasks([train, web]) == {
+        'CPU': 48, 'Memory': 48, 'Ports': None, 'ENI': None, 'GPU': 2
+    }
+    assert simulator.capacity.spaces([web.shape, train.shape]) == [48, 2]
+
+def test_cluster_metrics_count_gpus():
+    TASK_DEFINITIONS.clear()
+    TASK_DEFINITIONS.put('task:1', {'containerDefinitions': [
+        {'name': 'train', 'cpu': 256, 'memory': 512, 'resourceRequirements': [{'type': 'GPU', 'value': '1'}]},
+        {'name': 'sidecar', 'cpu': 0, 'memory': 128, 'resourceRequirements': [{'type': 'GPU', 'value': '1'}]},
+    ]})
+    stats = ClusterStats('default')
+    stats.load([{
+        'containerInstanceArn': 'ci-{}'.format(i),
+        'registeredResources': [
+            {'name': 'CPU', 'integerValue': 8192},
+            {'name': 'MEMORY', 'integerValue': 16384},
+            {'name': 'GPU', 'type': 'STRINGSET', 'stringSetValue': ['gpu-0', 'gpu-1', 'gpu-2', 'gpu-3']},
+        ],
+        'remainingResources': [
+            {'name': 'CPU', 'integerValue': 8192},
+            {'name': 'MEMORY', 'integerValue': 16384},
+            {'name': 'GPU', 'type': 'STRINGSET', 'stringSetValue': gpus},
+            {'name': 'PORTS', 'type': 'STRINGSET', 'stringSetValue': ['22']},
+        ]
+    } for i, gpus in enumerate([['gpu-0', 'gpu-1', 'gpu-2'], ['gpu-3']])], [{
+        'serviceName': 'train',
+        'taskDefinition': 'task:1',
+        'desiredCount': 1,
+    }])
+    assert stats.snapshot.instances[0].resources == (('GPU', 3),)
+    assert stats.snapshot.services[0].resources == (('GPU', 2),)
+    # cpu and memory would fit dozens, the GPUs fit one
+    assert stats.placeable_tasks['worst_case'] == 1
+    assert stats.bottleneck_tasks['GPU'] == 1
+    metrics = stats.cluster_metrics(None)
+    assert {
+        'Name': 'Resource', 'Value': 'GPU'
+    } in [d for m in metrics for d in m['Dimensions'] if m['MetricName'] == 'Bottleneck Schedulable Tasks']
+    TASK_DEFINITIONS.clear()
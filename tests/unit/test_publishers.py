@@ -0,0 +1,94 @@
+import io
+import json
+import datetime
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics.publishers import (
+    CloudWatchPublisher,
+    EmfPublisher,
+    metric_publisher
+)
+
+TIMESTAMP = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+def metric(name, value, **dimensions):
+    return {
+        'MetricName': name,
+        'Dimensions': [{'Name': 'ClusterName', 'Value': 'kloudcover'}] + [
+            {'Name': key, 'Value': dimension} for key, dimension in dimensions.items()
+        ],
+        'Timestamp': TIMESTAMP,
+        'Value': value,
+        'Unit': 'Count'
+    }
+
+def test_cloudwatch_batches():
+    cw = MagicMock()
+    publisher = CloudWatchPublisher(cw, batch_size=3)
+    publisher.publish([metric('m{}'.format(i), i) for i in range(4)])
+    assert cw.put_metric_data.call_count == 1
+    publisher.publish([metric('m4', 4)])
+    publisher.flush()
+    publisher.flush()
+    assert [len(call[1]['MetricData']) for call in cw.put_metric_data.call_args_list] == [3, 2]
+    assert cw.put_metric_data.call_args[1]['Namespace'] == 'AWS/ECS'
+
+def test_emf_log_stream():
+    stream = io.StringIO()
+    publisher = EmfPublisher(stream=stream)
+    publisher.publish([
+        metric('Schedulable Cluster Tasks', 4),
+        metric('Desired Tasks', 2, ServiceName='web'),
+        metric('Running Tasks', 1, ServiceName='web'),
+    ])
+    publisher.flush()
+    documents = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert len(documents) == 2
+    cluster, service = documents
+    assert cluster['Schedulable Cluster Tasks'] == 4
+    assert cluster['ClusterName'] == 'kloudcover'
+    assert service['ServiceName'] == 'web'
+    assert service['Desired Tasks'] == 2 and service['Running Tasks'] == 1
+    emf = service['_aws']
+    assert emf['Timestamp'] == 1577836800000
+    assert emf['CloudWatchMetrics'] == [{
+        'Namespace': 'AWS/ECS',
+        'Dimensions': [['ClusterName', 'ServiceName']],
+        'Metrics': [
+            {'Name': 'Desired Tasks', 'Unit': 'Count'},
+            {'Name': 'Running Tasks', 'Unit': 'Count'}
+        ]
+    }]
+
+def test_emf_document_limit():
+    stream = io.StringIO()
+    publisher = EmfPublisher(stream=stream)
+    publisher.publish([metric('m{}'.format(i), i) for i in range(150)])
+    publisher.flush()
+    documents = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [len(doc['_aws']['CloudWatchMetrics'][0]['Metrics']) for doc in documents] == [100, 50]
+
+def test_backend_from_env(monkeypatch):
+    monkeypatch.delenv('METRICS_BACKEND', raising=False)
+    assert isinstance(metric_publisher(MagicMock()), CloudWatchPublisher)
+    monkeypatch.setenv('METRICS_BACKEND', 'EMF')
+    assert isinstance(metric_publisher(MagicMock()), EmfPublisher)
+    monkeypatch.setenv('METRICS_BACKEND', 'statsd')
+    with pytest.raises(ValueError):
+        metric_publisher(MagicMock())
+
+def test_storage_resolution():
+    cw = MagicMock()
+    publisher = CloudWatchPublisher(cw)
+    publisher.storage_resolution = 1
+    publisher.publish([metric('Schedulable Cluster Tasks', 4)])
+    publisher.flush()
+    assert cw.put_metric_data.call_args[1]['MetricData'][0]['StorageResolution'] == 1
+
+    stream = io.StringIO()
+    publisher = EmfPublisher(stream=stream)
+    publisher.storage_resolution = 1
+    publisher.publish([metric('Schedulable Cluster Tasks', 4)])
+    publisher.flush()
+    document = json.loads(stream.getvalue())
+    assert document['_aws']['CloudWatchMetrics'][0]['Metrics'][0]['StorageResolution'] == 1
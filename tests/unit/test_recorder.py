@@ -0,0 +1,84 @@
+import io
+import gzip
+import json
+import datetime
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics import recorder
+from ecs_cluster_deployer.lambdas.metrics.recorder import SnapshotRecorder, snapshot_recorder
+from ecs_cluster_deployer.lambdas.metrics.snapshot import ClusterSnapshot, InstanceRecord, ServiceRecord
+
+TIMESTAMP = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+def snapshot(instances=3):
+    return ClusterSnapshot.build(
+        'kloudcover',
+        [
+            InstanceRecord('ci-{}'.format(i), 2048, 4096, 1024, 2048, 'm5.large',
+                           (('asg_version', 'v1'),), frozenset(['22/tcp']), (('GPU', 1),))
+            for i in range(instances)
+        ],
+        [
+            ServiceRecord('web', 'task:1', 2, 2, 256, 512, (('distinctInstance', None),)),
+            ServiceRecord('train', 'task:2', 1, 1, 256, 512, resources=(('GPU', 1),)),
+        ]
+    )
+
+def metrics():
+    return [{
+        'MetricName': 'Schedulable Cluster Tasks',
+        'Dimensions': [{'Name': 'ClusterName', 'Value': 'kloudcover'}],
+        'Timestamp': TIMESTAMP,
+        'Value': 12,
+        'Unit': 'Count'
+    }]
+
+def read(stream):
+    with gzip.GzipFile(fileobj=stream) as compressed:
+        return [json.loads(line) for line in compressed]
+
+def test_local(tmp_path):
+    path = SnapshotRecorder(str(tmp_path)).record(snapshot(), metrics(), TIMESTAMP)
+    assert path.startswith(str(tmp_path / 'cluster=kloudcover' / 'dt=2020-01-02' / 'hour=03' / '030405-'))
+    with open(path, 'rb') as stream:
+        blocks = read(stream)
+    assert [block['kind'] for block in blocks] == ['instance', 'service', 'shape', 'metric']
+    instances = blocks[0]
+    assert instances['cluster'] == 'kloudcover'
+    assert instances['timestamp'] == '2020-01-02T03:04:05+00:00'
+    assert instances['rows'] == 3
+    assert instances['arn'] == ['ci-0', 'ci-1', 'ci-2']
+    assert instances['used_ports'] == [['22/tcp']] * 3
+    assert instances['resources'] == [[['GPU', 1]]] * 3
+    assert blocks[1]['name'] == ['web', 'train']
+    assert blocks[1]['placement_constraints'] == [[['distinctInstance', None]], []]
+    assert blocks[2]['resources'] == [[], [['GPU', 1]]]
+    assert blocks[3]['metric'] == ['Schedulable Cluster Tasks']
+    assert blocks[3]['dimensions'] == [{}]
+
+def test_blocks_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, 'BLOCK_ROWS', 2)
+    path = SnapshotRecorder(str(tmp_path)).record(snapshot(5), [], TIMESTAMP)
+    with open(path, 'rb') as stream:
+        blocks = read(stream)
+    assert [(block['kind'], block['rows']) for block in blocks] == [
+        ('instance', 2), ('instance', 2), ('instance', 1), ('service', 2), ('shape', 2)
+    ]
+
+def test_s3():
+    uploaded = {}
+    s3 = MagicMock()
+    s3.upload_fileobj.side_effect = lambda stream, bucket, key: uploaded.update(
+        bucket=bucket, key=key, body=stream.read()
+    )
+    location = SnapshotRecorder('s3://bucket/snapshots/', s3=s3).record(snapshot(), metrics(), TIMESTAMP)
+    assert uploaded['bucket'] == 'bucket'
+    assert uploaded['key'].startswith('snapshots/cluster=kloudcover/dt=2020-01-02/hour=03/')
+    assert location == 's3://bucket/{}'.format(uploaded['key'])
+    assert read(io.BytesIO(uploaded['body']))[0]['rows'] == 3
+
+def test_snapshot_recorder(monkeypatch):
+    monkeypatch.delenv('SNAPSHOT_DESTINATION', raising=False)
+    assert snapshot_recorder() is None
+    monkeypatch.setenv('SNAPSHOT_DESTINATION', 's3://bucket')
+    assert snapshot_recorder().bucket == 'bucket'
+    assert snapshot_recorder().prefix == ''
@@ -3,7 +3,17 @@ import pytest
 import datetime
 import boto3
 import botocore
-from ecs_cluster_deployer.lambdas.scaling.scale_spot import SpotScaler, lambda_handler
+from ecs_cluster_deployer.lambdas.scaling import forecast
+from ecs_cluster_deployer.lambdas.scaling import scale_spot
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TASK_DEFINITIONS
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ContainerInstanceStats
+from ecs_cluster_deployer.lambdas.scaling.scale_spot import (
+    SpotScaler,
+    lambda_handler,
+    placement_amount,
+    step_amount
+)
+from ecs_cluster_deployer.lambdas.scaling.state import MemoryStateStore
 from pprint import pprint
 
 
@@ -12,16 +22,11 @@ from pprint import pprint
 def base_obj(fake_api):
     spot_scaler = SpotScaler()
     spot_scaler.ec2 = MagicMock()
-    spot_scaler.ssm = MagicMock()
+    spot_scaler.state = MemoryStateStore()
     spot_scaler.cw = MagicMock()
-    spot_scaler.ssm_path = '/ecs/my-cluster/scaletime'
 
     return spot_scaler
 
-@pytest.fixture
-def mock_date():
-    return datetime.datetime.now()
-
 def target_cap(num):
     return {
         'SpotFleetRequestConfigs':[{'SpotFleetRequestConfig': {
@@ -29,15 +34,30 @@ def target_cap(num):
         }}]
     }
 
+def metric_data(*results):
+    return {'MetricDataResults': [
+        {'Id': query_id, 'Timestamps': [point[0] for point in points], 'Values': [point[1] for point in points]}
+        for query_id, points in results
+    ]}
+
 def test_metric(base_obj):
     base_obj.scale_metric = 'Schedulable Cluster Tasks'
     base_obj.cluster_name = 'kloudcover'
-    print(base_obj.get_metric())
+    now = datetime.datetime.now(datetime.timezone.utc)
+    base_obj.cw.get_metric_data.return_value = metric_data(('scale', [(now, 3.0)]))
+    assert base_obj.get_metric() == 3.0
+    query = base_obj.cw.get_metric_data.call_args[1]['MetricDataQueries'][0]
+    assert query['MetricStat']['Metric']['MetricName'] == 'Schedulable Cluster Tasks'
+    # the metrics are read once per invocation
+    base_obj.get_metric()
+    assert base_obj.cw.get_metric_data.call_count == 1
 
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_fleet_state')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_metrics')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.deactivate_stack')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.get_metric')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.scale')
-def test_lambda_handler(fake_scale, fake_metric, fake_deactivate,  monkeypatch):
+def test_lambda_handler(fake_scale, fake_metric, fake_deactivate, fake_read_metrics, fake_read_fleet_state, monkeypatch):
     monkeypatch.setenv('STATUS', 'active')
     monkeypatch.setenv('CLUSTER_NAME', 'boston')
     fake_metric.return_value = 1
@@ -48,10 +68,12 @@ def test_lambda_handler(fake_scale, fake_metric, fake_deactivate,  monkeypatch):
     lambda_handler({}, {})
     fake_scale.assert_called_with(-1)
 
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_fleet_state')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_metrics')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.deactivate_stack')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.get_metric')
 @patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.scale')
-def test_lambda_handler_deactive(fake_scale, fake_metric, fake_deactivate,  monkeypatch):
+def test_lambda_handler_deactive(fake_scale, fake_metric, fake_deactivate, fake_read_metrics, fake_read_fleet_state, monkeypatch):
     monkeypatch.setenv('STATUS', 'inactive')
     monkeypatch.setenv('CLUSTER_NAME', 'boston')
     lambda_handler({}, {})
@@ -72,48 +94,159 @@ def test_enabler_active(monkeypatch):
     assert spot_scaler.deactivate
     assert spot_scaler.enabled
 
-def test_cloudwatch(base_obj):
+def test_high_resolution_metric(base_obj):
     base_obj.cluster_name = 'kloudcover'
-    base_obj.cw.get_metric_statistics.return_value = {
-        'Datapoints':[{'Average': 0.0}]
-    }
-    assert base_obj.get_metric() == 0.0
+    base_obj.metric_period = 10
+    now = datetime.datetime.now(datetime.timezone.utc)
+    base_obj.cw.get_metric_data.return_value = metric_data(('scale', [
+        (now - datetime.timedelta(minutes=5), 0.0),
+        (now - datetime.timedelta(seconds=30), 3.0),
+        (now - datetime.timedelta(seconds=20), 4.0),
+        (now - datetime.timedelta(seconds=10), 1.0),
+    ]))
+    assert base_obj.get_metric() == 1.0
+    query = base_obj.cw.get_metric_data.call_args[1]['MetricDataQueries'][0]
+    assert query['MetricStat']['Period'] == 10
+
+class FixedDatetime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2020, 5, 10, 12, 3, 30, tzinfo=datetime.timezone.utc)
+
+def test_period_aligned_metric(base_obj, monkeypatch):
+    monkeypatch.setattr(scale_spot, 'datetime', FixedDatetime)
+    base_obj.cluster_name = 'kloudcover'
+    utc = datetime.timezone.utc
+    # cloudwatch labels each 4 minute bucket with its start, the last full
+    # one starts before now - 240s and the one after it is still filling
+    full = datetime.datetime(2020, 5, 10, 11, 56, tzinfo=utc)
+    partial = datetime.datetime(2020, 5, 10, 12, 0, tzinfo=utc)
+    base_obj.cw.get_metric_data.return_value = metric_data(('scale', [(full, 3.0), (partial, 9.0)]))
+    assert base_obj.get_metric() == 3.0
+    assert base_obj.cw.get_metric_data.call_args[1]['StartTime'] == full
+
+def test_no_metric_data(base_obj):
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.cw.get_metric_data.return_value = metric_data(('scale', []))
+    assert base_obj.get_metric() is None
+    assert base_obj.decision() == 0
+
+def test_one_metric_read(base_obj, monkeypatch):
+    monkeypatch.setattr(forecast, 'MODELS', {})
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.step_scaling = True
+    base_obj.forecast_minutes = 10
+    now = datetime.datetime.now(datetime.timezone.utc)
+    history = [(now - datetime.timedelta(minutes=5 * i), 10.0) for i in range(12, 0, -1)]
+    base_obj.cw.get_metric_data.side_effect = [
+        dict(metric_data(('scale', [(now, 3.0)]), ('cpu', [(now, 256.0)])), NextToken='next'),
+        metric_data(('memory', [(now, 512.0)]), ('demand', history)),
+    ]
+    base_obj.read_metrics()
+    assert base_obj.get_metric() == 3.0
+    assert base_obj._metrics['Largest Task Memory'] == 512.0
+    assert base_obj.expected_growth() >= 0
+    assert forecast.MODELS
+    calls = base_obj.cw.get_metric_data.call_args_list
+    assert len(calls) == 2
+    assert calls[1][1]['NextToken'] == 'next'
+    assert sorted(query['Id'] for query in calls[0][1]['MetricDataQueries']) == [
+        'cpu', 'demand', 'memory', 'scale'
+    ]
+
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.ClusterStats')
+def test_controller_read_metrics(fake_stats, base_obj):
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.controller = True
+    cluster = [{'Name': 'ClusterName', 'Value': 'kloudcover'}]
+    fake_stats.return_value.metric_data.return_value = [
+        {'MetricName': 'Schedulable Cluster Tasks', 'Dimensions': cluster, 'Value': 1.0},
+        {'MetricName': 'Largest Task Memory', 'Dimensions': cluster, 'Value': 512},
+        {
+            'MetricName': 'Schedulable Tasks', 'Value': 9,
+            'Dimensions': cluster + [{'Name': 'ServiceName', 'Value': 'web'}]
+        },
+    ]
+    fake_stats.return_value.publish.side_effect = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'Throttling', 'Message': 'slow down'}}, 'PutMetricData'
+    )
+    # decided on in process, without reading the metrics back
+    assert base_obj.read_metrics() == {'Schedulable Cluster Tasks': 1.0, 'Largest Task Memory': 512}
+    assert base_obj.decision() == 2
+    fake_stats.return_value.publish.assert_called_once()
+    base_obj.cw.get_metric_data.assert_not_called()
+
+def test_split_amount():
+    assert scale_spot.split_amount(5, 2) == [3, 2]
+    assert scale_spot.split_amount(-1, 2) == [-1, 0]
+    assert scale_spot.split_amount(2, 1) == [2]
+
+@patch('botocore.client.BaseClient._make_api_call')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.ClusterStats')
+def test_controller_fleets(fake_stats, fake_api, monkeypatch):
+    monkeypatch.setenv('SPOT_FLEETS', 'sfr-1, sfr-2')
+    monkeypatch.setenv('SPOT_FLEET', 'sfr-1')
+    monkeypatch.setenv('CONTROLLER', 'true')
+    spot_scaler = SpotScaler()
+    assert [scaler.spot_fleet for scaler in spot_scaler.fleet_scalers] == ['sfr-1', 'sfr-2']
+    spot_scaler.cw = MagicMock()
+    spot_scaler.state = MemoryStateStore()
+    for scaler in spot_scaler.fleet_scalers:
+        scaler.ec2 = MagicMock(**{'describe_spot_fleet_requests.return_value': target_cap(1)})
+    fake_stats.return_value.metric_data.return_value = [{
+        'MetricName': 'Schedulable Cluster Tasks',
+        'Dimensions': [{'Name': 'ClusterName', 'Value': 'kloudcover'}],
+        'Value': 0.0
+    }]
+    scale_spot.run(spot_scaler)
+    # the cluster is collected and published once, not once per fleet
+    fake_stats.return_value.publish.assert_called_once()
+    # and the scale out is split between the fleets
+    for scaler in spot_scaler.fleet_scalers:
+        scaler.ec2.modify_spot_fleet_request.assert_called_once_with(
+            SpotFleetRequestId=scaler.spot_fleet, TargetCapacity=2
+        )
+
+def test_read_fleet_state(base_obj):
+    base_obj.state = MagicMock()
+    base_obj.state.read.return_value = (1518361488.926316, 4)
+    base_obj.ec2.describe_spot_fleet_requests.return_value = target_cap(3)
+    base_obj.read_fleet_state()
+    assert base_obj.last_scale_date() == datetime.datetime(2018, 2, 11, 15, 4, 48, 926316)
+    assert base_obj.fleet_capacity() == 3
+    base_obj.last_scale_date()
+    base_obj.fleet_capacity()
+    assert base_obj.state.read.call_count == 1
+    assert base_obj.ec2.describe_spot_fleet_requests.call_count == 1
+
+def test_take_cooldown(base_obj):
+    base_obj.scale_cooldown = '300'
+    assert base_obj.last_scale_date() == datetime.datetime(1970, 1, 1)
+    assert base_obj.take_cooldown()
+    assert base_obj.last_scale_date() > datetime.datetime.utcnow()
+    assert not base_obj.take_cooldown()
+
+def test_overlapping_invocations(base_obj):
+    other = SpotScaler()
+    other.state = base_obj.state
+    other.state_key = base_obj.state_key
+    base_obj.read_state()
+    other.read_state()
+    # both read an expired cooldown, only the first swap takes it
+    assert base_obj.take_cooldown()
+    assert not other.take_cooldown()
 
 @patch('botocore.client.BaseClient._make_api_call')
 def test_deactivate_stack(base_obj):
     base_obj.version = '0.0.6'
     base_obj.cluster_name = 'kloudcover'
     base_obj.ec2 = boto3.client('ec2')
-    base_obj.ssm = boto3.client('ssm')
     base_obj.spot_fleet = 'sfr-529bc17b-6004-4c88-99ea-3cee507e9fd3'
-    base_obj.ssm_path = '/ecs/kloudcover/{}/scaletime'.format(base_obj.version)
     base_obj.deactivate_stack()
-    base_obj.set_date()
-
-def test_test_get_date(base_obj, mock_date):
-    base_obj.ssm.get_parameters.return_value= {
-        'Parameters': [{
-            'Name': '/ecs/my-cluster/scaletime',
-            'Value': '2018-02-11 15:04:48.926316'
-        }]
-    }
-    assert datetime.datetime.utcnow() > base_obj.last_scale_date()
-
-def test_get_date_initial(base_obj, mock_date):
-    base_obj.ssm.get_parameters.return_value= {
-        'Parameters': [{
-            'Name': '/ecs/my-cluster/scaletime',
-            'Value': 'boston'
-        }]
-    }
-    assert datetime.datetime.utcnow() > base_obj.last_scale_date()
 
 def test_scale(base_obj):
-    base_obj.last_scale_date = MagicMock(
-        return_value=datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
-    )
+    base_obj.scale_cooldown = '0'
     base_obj.has_running_tasks = MagicMock(return_value=False)
-    base_obj.set_date = MagicMock()
 
     base_obj.ec2.describe_spot_fleet_requests.return_value = target_cap(1)
     base_obj.spot_fleet = 'sfr-3fa4e925-9f57-483d-be98-d6a14afd81f4'
@@ -124,9 +257,15 @@ def test_scale(base_obj):
         SpotFleetRequestId=base_obj.spot_fleet,
         TargetCapacity=3
     )
+    assert base_obj.fleet_capacity() == 3
+    # only scaling to zero needs to know about running tasks
+    base_obj.has_running_tasks.assert_not_called()
+    # a later invocation describes the fleet again, which is at the min
+    base_obj._target_capacity = None
     base_obj.scale(-1)
     base_obj.scale(-9.0)
     assert base_obj.ec2.modify_spot_fleet_request.call_count == 1
+    assert base_obj.ec2.describe_spot_fleet_requests.call_count == 2
 
 def test_delete(base_obj, monkeypatch):
     monkeypatch.setenv('CLUSTER_NAME', 'kloudcover')
@@ -151,7 +290,272 @@ def test_delete(base_obj, monkeypatch):
     )
 
 def test_has_tasks(base_obj, monkeypatch):
-    base_obj.ecs.list_tasks = MagicMock(return_value={'taskArns': []})
-    base_obj.has_running_tasks() == False
-    base_obj.ecs.list_tasks = MagicMock(return_value={'taskArns': ['1', '2']})
-    base_obj.has_running_tasks() == True
+    base_obj.version = 'v1'
+    base_obj.ecs = MagicMock()
+    arns = ['ci-{}'.format(i) for i in range(250)]
+    base_obj.ecs.get_paginator.return_value.paginate.return_value = [
+        {'containerInstanceArns': arns[:100]}, {'containerInstanceArns': arns[100:]}
+    ]
+    base_obj.ecs.describe_container_instances.side_effect = lambda cluster, containerInstances: {
+        'containerInstances': [
+            {'containerInstanceArn': arn, 'runningTasksCount': 0, 'pendingTasksCount': int(arn == 'ci-120')}
+            for arn in containerInstances
+        ]
+    }
+    assert base_obj.has_running_tasks()
+    # stops at the chunk with a starting task, and the list is shared
+    assert base_obj.ecs.describe_container_instances.call_count == 2
+    assert not base_obj.cluster_version_empty()
+    assert base_obj.has_running_tasks()
+    assert base_obj.ecs.describe_container_instances.call_count == 2
+    assert base_obj.ecs.get_paginator.return_value.paginate.call_count == 1
+    assert base_obj.ecs.get_paginator.return_value.paginate.call_args[1]['filter'] == \
+        'attribute:asg_version == v1'
+
+def test_no_tasks(base_obj):
+    base_obj.ecs = MagicMock()
+    base_obj.ecs.get_paginator.return_value.paginate.return_value = [{'containerInstanceArns': []}]
+    assert not base_obj.has_running_tasks()
+    assert base_obj.cluster_version_empty()
+    base_obj.ecs.describe_container_instances.assert_not_called()
+
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_fleet_state')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_metrics')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.expected_growth')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.get_metric')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.scale')
+def test_forecast_scales_out_ahead(fake_scale, fake_metric, fake_growth, fake_read_metrics, fake_read_fleet_state, monkeypatch):
+    monkeypatch.setenv('STATUS', 'active')
+    monkeypatch.setenv('CLUSTER_NAME', 'boston')
+    monkeypatch.setenv('FORECAST_MINUTES', '10')
+    fake_metric.return_value = 5
+    fake_growth.return_value = 4
+    lambda_handler({}, {})
+    fake_scale.assert_called_with(2)
+
+    # and holds off scaling in when the tasks are about to be needed
+    fake_scale.reset_mock()
+    fake_metric.return_value = 8
+    fake_growth.return_value = 2
+    lambda_handler({}, {})
+    fake_scale.assert_not_called()
+
+def test_expected_growth(base_obj):
+    model = MagicMock(last=10)
+    model.peak.return_value = 14.5
+    base_obj._metrics = {}
+    base_obj._demand = model
+    base_obj.forecast_minutes = 10
+    assert base_obj.expected_growth() == 4.5
+    model.peak.assert_called_with(600)
+    model.peak.return_value = 8
+    assert base_obj.expected_growth() == 0
+    base_obj._demand = None
+    assert base_obj.expected_growth() == 0
+
+def test_step_amount():
+    # an m5.large holds 4 of the tasks, a c5.large only 3 for want of memory
+    m5 = (2048, 8192 * 0.9, 1)
+    c5 = (2048, 4096 * 0.9, 1)
+    task = (512, 1024)
+    assert step_amount(-10, 5, task, [m5]) == 4
+    assert step_amount(-10, 5, task, [m5, c5]) == 5
+    assert step_amount(20, 5, task, [m5, c5]) == -3
+    assert step_amount(6, 5, task, [m5]) == 0
+    # an m5.xlarge weighted 2 holds the same per unit as an m5.large
+    assert step_amount(-10, 5, task, [(4096, 16384 * 0.9, 2)]) == 4
+    assert step_amount(0, 5, (0, 1024), [(1024, 4096, 1)]) == 2
+    assert step_amount(0, 5, (512, 16384), [m5]) is None
+
+def test_step(base_obj, monkeypatch):
+    monkeypatch.setattr(scale_spot, 'INSTANCE_TYPES', {})
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.target_headroom = 4
+    base_obj.bids = [
+        {'instance_type': 'm5.large', 'weight': 1},
+        {'instance_type': 'm5.xlarge', 'weight': 2}
+    ]
+    base_obj._metrics = {'Largest Task CPU': 512.0, 'Largest Task Memory': 1024.0}
+    base_obj.ec2.get_paginator.return_value.paginate.return_value = [{'InstanceTypes': [
+        {'InstanceType': 'm5.large', 'VCpuInfo': {'DefaultVCpus': 2}, 'MemoryInfo': {'SizeInMiB': 8192}},
+        {'InstanceType': 'm5.xlarge', 'VCpuInfo': {'DefaultVCpus': 4}, 'MemoryInfo': {'SizeInMiB': 16384}}
+    ]}]
+    assert base_obj.step(-20, 2) == 6
+    # instance types are only described once
+    assert base_obj.step(1, 2) == 1
+    assert base_obj.ec2.get_paginator.call_count == 1
+    assert base_obj.step(30, -1) == -6
+    # holds rather than scale in past the headroom
+    assert base_obj.step(7, -1) == 0
+    base_obj._metrics = {}
+    assert base_obj.step(-20, 2) == 2
+
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_fleet_state')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_metrics')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.step')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.get_metric')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.scale')
+def test_step_scaling(fake_scale, fake_metric, fake_step, fake_read_metrics, fake_read_fleet_state, monkeypatch):
+    monkeypatch.setenv('STATUS', 'active')
+    monkeypatch.setenv('CLUSTER_NAME', 'boston')
+    monkeypatch.setenv('STEP_SCALING', 'true')
+    fake_metric.return_value = -12
+    fake_step.return_value = 5
+    lambda_handler({}, {})
+    fake_step.assert_called_with(-12, 2)
+    fake_scale.assert_called_with(5)
+
+def placement_event(reason='RESOURCE:MEMORY', event_name='SERVICE_TASK_PLACEMENT_FAILURE'):
+    return {
+        'source': 'aws.ecs',
+        'detail-type': 'ECS Service Action',
+        'resources': ['arn:aws:ecs:us-west-2:601394826940:service/kloudcover/web'],
+        'detail': {
+            'eventType': 'WARN',
+            'eventName': event_name,
+            'clusterArn': 'arn:aws:ecs:us-west-2:601394826940:cluster/kloudcover',
+            'reason': reason
+        }
+    }
+
+def test_placement_amount():
+    bids = [(2048, 7372.8, 1), (4096, 14745.6, 2)]
+    assert placement_amount('MEMORY', 20, (256, 512), bids) == 3
+    # each task needs its own instance, and the fleet may pick the heavier bid
+    assert placement_amount('PORTS', 3, (256, 512), bids) == 6
+    assert placement_amount('CPU', 1, (8192, 512), bids) is None
+
+def test_placement_failure(base_obj, monkeypatch):
+    monkeypatch.setattr(scale_spot, 'INSTANCE_TYPES', {'m5.large': (2048, 7372.8)})
+    TASK_DEFINITIONS.put('web:1', {'containerDefinitions': [{'name': 'web', 'cpu': 256, 'memory': 512}]})
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.placement.key = 'kloudcover/placement'
+    base_obj.bids = [{'instance_type': 'm5.large', 'weight': 1}]
+    base_obj.ecs = MagicMock()
+    base_obj.ecs.describe_services.return_value = {'services': [{
+        'serviceName': 'web', 'taskDefinition': 'web:1',
+        'desiredCount': 22, 'runningCount': 2, 'pendingCount': 0
+    }]}
+    base_obj.ec2.describe_spot_fleet_requests.return_value = target_cap(1)
+    base_obj.spot_fleet = 'sfr-3fa4e925-9f57-483d-be98-d6a14afd81f4'
+
+    base_obj.placement.failure(placement_event())
+    base_obj.ec2.modify_spot_fleet_request.assert_called_once_with(
+        SpotFleetRequestId=base_obj.spot_fleet,
+        TargetCapacity=4
+    )
+    # the rest of the burst is dropped without describing anything
+    base_obj.placement.failure(placement_event())
+    assert base_obj.ecs.describe_services.call_count == 1
+    assert base_obj.ec2.modify_spot_fleet_request.call_count == 1
+    # and the normal cooldown is left alone
+    assert base_obj.take_cooldown()
+
+def test_placement_failure_ignored(base_obj):
+    base_obj.ecs = MagicMock()
+    base_obj.placement.failure(placement_event('ATTRIBUTE'))
+    base_obj.placement.failure(placement_event(event_name='SERVICE_STEADY_STATE'))
+    base_obj.ecs.describe_services.assert_not_called()
+    base_obj.ec2.modify_spot_fleet_request.assert_not_called()
+
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.send_api_metrics')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.SpotScaler.read_metrics')
+@patch('ecs_cluster_deployer.lambdas.scaling.scale_spot.PlacementScaler.failure')
+def test_placement_handler(fake_placement, fake_read_metrics, fake_api_metrics, monkeypatch):
+    monkeypatch.setenv('STATUS', 'active')
+    lambda_handler(placement_event(), {})
+    fake_placement.assert_called_once()
+    fake_read_metrics.assert_not_called()
+    monkeypatch.setenv('STATUS', 'inactive')
+    lambda_handler(placement_event(), {})
+    assert fake_placement.call_count == 1
+
+def drain_instance(arn, instance_id, tasks, available, attributes=()):
+    return {
+        'containerInstanceArn': arn,
+        'ec2InstanceId': instance_id,
+        'runningTasksCount': tasks,
+        'pendingTasksCount': 0,
+        'attributes': [{'name': name, 'value': value} for name, value in attributes],
+        'registeredResources': [
+            {'name': 'CPU', 'type': 'INTEGER', 'integerValue': 2048},
+            {'name': 'MEMORY', 'type': 'INTEGER', 'integerValue': 4096}
+        ],
+        'remainingResources': [
+            {'name': 'CPU', 'type': 'INTEGER', 'integerValue': available[0]},
+            {'name': 'MEMORY', 'type': 'INTEGER', 'integerValue': available[1]}
+        ]
+    }
+
+@pytest.fixture
+def drain_obj(base_obj):
+    base_obj.cluster_name = 'kloudcover'
+    base_obj.version = 'v1'
+    base_obj.drain_scale_in = True
+    base_obj.spot_fleet = 'sfr-3fa4e925-9f57-483d-be98-d6a14afd81f4'
+    base_obj.ecs = MagicMock()
+    base_obj.ec2.describe_spot_fleet_requests.return_value = target_cap(3)
+    base_obj.ec2.describe_spot_fleet_instances.return_value = {'ActiveInstances': [
+        {'InstanceId': 'i-1', 'InstanceType': 'm5.large'},
+        {'InstanceId': 'i-2', 'InstanceType': 'm5.large'},
+        {'InstanceId': 'i-3', 'InstanceType': 'm5.large'},
+    ]}
+    return base_obj
+
+def test_drain(drain_obj):
+    drain_obj.drainer._draining = []
+    drain_obj.ecs.get_paginator.return_value.paginate.return_value = [
+        {'containerInstanceArns': ['ci-1', 'ci-2', 'ci-3']}
+    ]
+    drain_obj.ecs.describe_container_instances.return_value = {'containerInstances': [
+        drain_instance('ci-1', 'i-1', 3, (1280, 2560)),
+        drain_instance('ci-2', 'i-2', 1, (1792, 3584)),
+        drain_instance('ci-3', 'i-3', 2, (1536, 3072)),
+    ]}
+    drain_obj.scale_cooldown = '0'
+    drain_obj.scale(-1)
+    # the instance with the fewest tasks goes, not whichever the fleet picks
+    drain_obj.ecs.update_container_instances_state.assert_called_once_with(
+        cluster='kloudcover', containerInstances=['ci-2'], status='DRAINING'
+    )
+    attribute = drain_obj.ecs.put_attributes.call_args[1]['attributes'][0]
+    assert (attribute['name'], attribute['targetId']) == ('drained_at', 'ci-2')
+    drain_obj.ec2.modify_spot_fleet_request.assert_not_called()
+
+def test_drain_waits(drain_obj):
+    drain_obj.drainer._draining = [MagicMock()]
+    drain_obj.drainer.drain(-1)
+    drain_obj.ecs.update_container_instances_state.assert_not_called()
+
+def test_finish_drains(drain_obj):
+    drain_obj.ecs.get_paginator.return_value.paginate.return_value = [
+        {'containerInstanceArns': ['ci-1', 'ci-2', 'ci-4']}
+    ]
+    drain_obj.ecs.describe_container_instances.return_value = {'containerInstances': [
+        drain_instance('ci-1', 'i-1', 0, (2048, 4096), [('drained_at', '1')]),
+        drain_instance('ci-2', 'i-2', 1, (1792, 3584), [('drained_at', '9999999999')]),
+        # no longer in the fleet
+        drain_instance('ci-4', 'i-4', 0, (2048, 4096), [('drained_at', '1')]),
+    ]}
+    drain_obj.drainer.finish_drains()
+    assert 'asg_version == v1' in drain_obj.ecs.get_paginator.return_value.paginate.call_args[1]['filter']
+    drain_obj.ec2.modify_spot_fleet_request.assert_called_once_with(
+        SpotFleetRequestId=drain_obj.spot_fleet,
+        TargetCapacity=2,
+        ExcessCapacityTerminationPolicy='noTermination'
+    )
+    drain_obj.ecs.deregister_container_instance.assert_called_once_with(
+        cluster='kloudcover', containerInstance='ci-1', force=True
+    )
+    drain_obj.ec2.terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
+    assert [instance.arn for instance in drain_obj.drainer.draining_instances()] == ['ci-2', 'ci-4']
+
+def test_finish_drains_min_weight(drain_obj):
+    drain_obj.min_weight = 3
+    drain_obj.drainer._draining = [
+        ContainerInstanceStats(drain_instance('ci-1', 'i-1', 0, (2048, 4096), [('drained_at', '1')]))
+    ]
+    drain_obj.drainer.finish_drains()
+    # the fleet stays at its min weight, launching a replacement
+    assert drain_obj.ec2.modify_spot_fleet_request.call_args[1]['TargetCapacity'] == 3
+    drain_obj.ec2.terminate_instances.assert_called_once_with(InstanceIds=['i-1'])
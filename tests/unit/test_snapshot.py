@@ -0,0 +1,60 @@
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics.snapshot import (
+    ClusterSnapshot,
+    InstanceRecord,
+    ServiceRecord
+)
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ServiceStats, ContainerInstanceStats
+
+def test_records_are_immutable():
+    record = InstanceRecord('ci-1', 2048, 4096, 1024, 2048)
+    with pytest.raises(AttributeError):
+        record.available_cpu = 0
+    with pytest.raises(AttributeError):
+        record.extra = 1
+    assert not hasattr(record, '__dict__')
+
+def test_snapshot_aggregates():
+    snapshot = ClusterSnapshot.build('boston', [
+        InstanceRecord('ci-1', 2048, 4096, 1024, 2048),
+        InstanceRecord('ci-2', 2048, 4096, 512, 1024),
+    ], [
+        ServiceRecord('a', 'task:1', 2, 2, 128, 512),
+        ServiceRecord('b', 'task:2', 1, 1, 256, 1024),
+        ServiceRecord('c', 'task:3', 1, 1, 512, 1024),
+        ServiceRecord('idle', 'task:4', 0, 0, 4096, 8192),
+    ])
+    assert snapshot.total_cpu == 4096
+    assert snapshot.available_memory == 3072
+    assert snapshot.desired_pods == 4
+    assert snapshot.cpu_requirement == 128 * 2 + 256 + 512
+    assert snapshot.memory_requirement == 512 * 2 + 1024 + 1024
+    # ties go to the last service
+    assert snapshot.largest_pod.name == 'c'
+    assert snapshot.task_shapes == ((128, 512), (256, 1024), (512, 1024))
+    assert len(snapshot.services) == 3
+
+def test_from_stats():
+    service = ServiceStats({
+        'serviceName': 'drone',
+        'taskDefinition': 'drone:1',
+        'desiredCount': 2,
+        'runningCount': 1,
+        'pendingCount': 1
+    }, ecs=MagicMock(), container_definitions=[
+        {'name': 'a', 'cpu': 10, 'memory': 128},
+        {'name': 'b', 'cpu': 20, 'memoryReservation': 256}
+    ])
+    container_instance = ContainerInstanceStats({
+        'containerInstanceArn': 'ci-1',
+        'registeredResources': [{'name': 'CPU', 'integerValue': 2048}, {'name': 'MEMORY', 'integerValue': 123}],
+        'remainingResources': [{'name': 'CPU', 'integerValue': 2}, {'name': 'MEMORY', 'integerValue': 2}]
+    })
+    snapshot = ClusterSnapshot.from_stats('boston', [container_instance], [service])
+    assert snapshot.instances[0].arn == 'ci-1'
+    assert snapshot.instances[0].total_memory == 123
+    record = snapshot.services[0]
+    assert (record.name, record.desired, record.running) == ('drone', 2, 2)
+    assert (record.cpu_per_pod, record.memory_per_pod) == (30, 384)
+    assert record.memory_requirement == 768
@@ -0,0 +1,86 @@
+from mock import MagicMock
+import pytest
+import botocore
+from ecs_cluster_deployer.lambdas.scaling import state
+from ecs_cluster_deployer.lambdas.scaling.state import (
+    DynamoDBStateStore,
+    FileStateStore,
+    MemoryStateStore,
+    SsmStateStore,
+    StateStore,
+    state_store
+)
+
+def client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, 'operation')
+
+@pytest.mark.parametrize('store', [MemoryStateStore(), None])
+def test_one_swap_wins(store, tmp_path):
+    store = store or FileStateStore(str(tmp_path / 'state.json'))
+    assert store.read('kloudcover/1') == (0, 0)
+    first = store.read('kloudcover/1')
+    second = store.read('kloudcover/1')
+    assert store.acquire('kloudcover/1', 300, now=100, read=first)
+    assert not store.acquire('kloudcover/1', 300, now=100, read=second)
+    assert store.read('kloudcover/1')[0] == 400
+    # the cooldown holds until it runs out
+    assert not store.acquire('kloudcover/1', 300, now=399)
+    assert store.acquire('kloudcover/1', 300, now=400)
+
+def test_store_needs_read_and_swap():
+    class ReadOnly(StateStore):
+        def read(self, key):
+            return 0, None
+    with pytest.raises(TypeError):
+        ReadOnly()
+
+def test_ssm_swap():
+    ssm = MagicMock()
+    store = SsmStateStore(ssm)
+    ssm.get_parameter.return_value = {'Parameter': {'Value': '100.0', 'Version': 3}}
+    assert store.read('kloudcover/1') == (100.0, 3)
+    assert ssm.get_parameter.call_args[1]['Name'] == '/ecs-maestro/kloudcover/1/scaletime'
+    ssm.put_parameter.return_value = {'Version': 4}
+    assert store.swap('kloudcover/1', 3, 400)
+    assert ssm.put_parameter.call_args[1]['Overwrite']
+    # another invocation put a version in between
+    ssm.put_parameter.return_value = {'Version': 5}
+    assert not store.swap('kloudcover/1', 3, 400)
+
+def test_ssm_first_swap():
+    ssm = MagicMock()
+    store = SsmStateStore(ssm)
+    ssm.get_parameter.side_effect = client_error('ParameterNotFound')
+    assert store.read('kloudcover/1') == (0, None)
+    assert store.swap('kloudcover/1', None, 400)
+    assert not ssm.put_parameter.call_args[1]['Overwrite']
+    ssm.put_parameter.side_effect = client_error('ParameterAlreadyExists')
+    assert not store.swap('kloudcover/1', None, 400)
+
+def test_parse_value():
+    assert state.parse_value('2018-02-11 15:04:48.926316') == pytest.approx(1518361488.926316)
+    assert state.parse_value('0') == 0
+    assert state.parse_value('boston') == 0
+
+def test_dynamodb_swap():
+    dynamodb = MagicMock()
+    store = DynamoDBStateStore('scaler-state', dynamodb)
+    dynamodb.get_item.return_value = {}
+    assert store.read('kloudcover/1') == (0, None)
+    assert store.swap('kloudcover/1', None, 400)
+    assert dynamodb.put_item.call_args[1]['ConditionExpression'] == 'attribute_not_exists(#key)'
+    dynamodb.get_item.return_value = {'Item': {'key': {'S': 'kloudcover/1'}, 'until': {'N': '400.0'}}}
+    assert store.read('kloudcover/1') == (400.0, '400.0')
+    dynamodb.put_item.side_effect = client_error('ConditionalCheckFailedException')
+    assert not store.swap('kloudcover/1', '400.0', 700)
+    assert dynamodb.put_item.call_args[1]['ExpressionAttributeValues'] == {':token': {'N': '400.0'}}
+
+def test_state_store(monkeypatch, tmp_path):
+    monkeypatch.delenv('SCALER_STATE', raising=False)
+    assert isinstance(state_store(), SsmStateStore)
+    monkeypatch.setenv('SCALER_STATE', 'dynamodb:scaler-state')
+    assert state_store().table == 'scaler-state'
+    assert isinstance(state_store('file:{}'.format(tmp_path / 'state.json')), FileStateStore)
+    assert isinstance(state_store('memory'), MemoryStateStore)
+    with pytest.raises(ValueError):
+        state_store('dynamodb')
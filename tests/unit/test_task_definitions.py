@@ -0,0 +1,78 @@
+import pytest
+from unittest.mock import MagicMock
+from ecs_cluster_deployer.lambdas.metrics.task_definitions import TaskDefinitionCache
+from ecs_cluster_deployer.lambdas.metrics.cluster_metrics import ClusterStats
+
+ARN = 'arn:aws:ecs:us-west-2:601394826940:task-definition/drone-Task-1MUP2TV5749OQ:{}'
+
+def task_definition():
+    return {
+        'taskDefinitionArn': ARN.format(1),
+        'family': 'drone',
+        'containerDefinitions': [{
+            'name': 'boston',
+            'image': 'ktruckenmiller/my-ip',
+            'cpu': 20,
+            'memoryReservation': 256,
+            'environment': [{'name': 'A', 'value': 'B'}]
+        }]
+    }
+
+def test_hit_and_miss():
+    cache = TaskDefinitionCache()
+    assert cache.get(ARN.format(1)) is None
+    cache.put(ARN.format(1), task_definition())
+    assert cache.get(ARN.format(1)) == {
+        'containerDefinitions': [{'name': 'boston', 'cpu': 20, 'memoryReservation': 256}]
+    }
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+    cache.reset_stats()
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 1}
+
+def test_unpinned_arns_not_cached():
+    cache = TaskDefinitionCache()
+    cache.put('drone-Task-1MUP2TV5749OQ', task_definition())
+    assert cache.get('drone-Task-1MUP2TV5749OQ') is None
+
+def test_lru_eviction():
+    cache = TaskDefinitionCache(max_size=2)
+    cache.put(ARN.format(1), task_definition())
+    cache.put(ARN.format(2), task_definition())
+    cache.get(ARN.format(1))
+    cache.put(ARN.format(3), task_definition())
+    assert cache.get(ARN.format(2)) is None
+    assert cache.get(ARN.format(1)) is not None
+    assert cache.get(ARN.format(3)) is not None
+
+def test_disk_copy(tmp_path):
+    path = str(tmp_path / 'task-definitions.json')
+    cache = TaskDefinitionCache(path=path)
+    cache.put(ARN.format(1), task_definition())
+    cache.save()
+    warm = TaskDefinitionCache(path=path)
+    assert warm.get(ARN.format(1))['containerDefinitions'][0]['name'] == 'boston'
+
+def test_steady_state_describes(monkeypatch):
+    stats = ClusterStats('default')
+    stats._container_instances = []
+    stats.ecs = MagicMock()
+    paginator = MagicMock()
+    paginator.paginate.return_value = [{'serviceArns': ['svc-1', 'svc-2']}]
+    stats.ecs.get_paginator.return_value = paginator
+    stats.ecs.describe_services.return_value = {'services': [
+        {'serviceArn': 'svc-1', 'taskDefinition': ARN.format(1), 'desiredCount': 1},
+        {'serviceArn': 'svc-2', 'taskDefinition': ARN.format(2), 'desiredCount': 1},
+    ]}
+    stats.ecs.describe_task_definition.return_value = {'taskDefinition': task_definition()}
+    cache = TaskDefinitionCache()
+    monkeypatch.setattr(
+        'ecs_cluster_deployer.lambdas.metrics.cluster_metrics.TASK_DEFINITIONS', cache
+    )
+    assert stats.service_requirements == {'cpu': 40, 'memory': 512}
+    assert stats.ecs.describe_task_definition.call_count == 2
+
+    stats._services = None
+    stats._snapshot = None
+    assert stats.service_requirements == {'cpu': 40, 'memory': 512}
+    assert stats.ecs.describe_task_definition.call_count == 2
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'size': 2}